@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Time the reference span lookup of assign_barcodes' tag export.
+
+Each assigned read's tags include its first and last aligned reference
+positions. These used to be read from two get_reference_positions() lists,
+which hold every aligned position of the read; aligned_reference_span
+takes them from the alignment's start and end and the CIGAR operations at
+either end. Both are timed on simulated long read alignments of each
+length, and checked to agree.
+"""
+import argparse
+import logging
+from pathlib import Path
+import random
+import sys
+import time
+
+import pandas as pd
+import pysam
+
+BIN_DIR = Path(__file__).resolve().parent.parent / "bin"
+sys.path.insert(0, str(BIN_DIR))
+from assign_barcodes import aligned_reference_span  # noqa: E402,I100,I202
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """Create argument parser."""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--lengths",
+        help="Aligned read lengths to time [1000 10000 50000]",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+    )
+
+    parser.add_argument(
+        "--n_reads",
+        help="Alignments of each length [500]",
+        type=int,
+        default=500,
+    )
+
+    parser.add_argument(
+        "--indel_rate",
+        help="Per base rate of insertions and of deletions [0.03]",
+        type=float,
+        default=0.03,
+    )
+
+    parser.add_argument(
+        "--seed", help="Random seed of the simulation [1]", type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--output",
+        help="Write the timings to this TSV [None]",
+        type=Path,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--verbosity",
+        help="logging level: <=2 logs info, <=3 logs warnings",
+        type=int,
+        default=2,
+    )
+
+    return parser.parse_args()
+
+
+def init_logger(args):
+    """Initiate logger."""
+    logging.basicConfig(
+        format="%(asctime)s -- %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    logging_level = args.verbosity * 10
+    logging.root.setLevel(logging_level)
+
+
+def simulate_alignment(header, length, args, rng):
+    """Simulate a long read alignment with soft clips, indels and introns.
+
+    Some alignments start or end with a deletion, which the first or last
+    aligned position must skip.
+
+    :return: Alignment
+    :rtype: class pysam.AlignedSegment
+    """
+    ops = [(pysam.CSOFT_CLIP, rng.randint(1, 200))]
+    if rng.random() < 0.1:
+        ops.append((pysam.CDEL, rng.randint(1, 5)))
+    aligned = 0
+    while aligned < length:
+        run = min(
+            max(1, int(rng.expovariate(2 * args.indel_rate))),
+            length - aligned)
+        ops.append((pysam.CMATCH, run))
+        aligned += run
+        if aligned < length:
+            if rng.random() < 0.001:
+                ops.append((pysam.CREF_SKIP, rng.randint(50, 5000)))
+            else:
+                op = rng.choice((pysam.CINS, pysam.CDEL))
+                ops.append((op, rng.randint(1, 5)))
+    if rng.random() < 0.1:
+        ops.append((pysam.CDEL, rng.randint(1, 5)))
+    ops.append((pysam.CSOFT_CLIP, rng.randint(1, 200)))
+
+    align = pysam.AlignedSegment(header)
+    align.query_name = "read"
+    align.reference_id = 0
+    align.reference_start = rng.randint(0, 1000)
+    align.cigartuples = ops
+    align.mapping_quality = 60
+    return align
+
+
+def time_per_read(func, aligns):
+    """Time a function on each alignment.
+
+    :return: Results and microseconds per alignment
+    :rtype: list, float
+    """
+    start = time.perf_counter()
+    results = [func(align) for align in aligns]
+    return results, (time.perf_counter() - start) / len(aligns) * 1e6
+
+
+def main(args):
+    """Run entry point."""
+    init_logger(args)
+    rng = random.Random(args.seed)
+    header = pysam.AlignmentHeader.from_dict({
+        "HD": {"VN": "1.6"},
+        "SQ": [{"SN": "chr1", "LN": 10 * max(args.lengths) + 10000}]})
+
+    rows = []
+    for length in args.lengths:
+        aligns = [
+            simulate_alignment(header, length, args, rng)
+            for _ in range(args.n_reads)]
+        positions, positions_us = time_per_read(
+            lambda align: (
+                align.get_reference_positions()[0],
+                align.get_reference_positions()[-1]),
+            aligns)
+        spans, span_us = time_per_read(aligned_reference_span, aligns)
+        if spans != positions:
+            raise ValueError(
+                f"Reference spans of {length} bp alignments differ from "
+                "get_reference_positions()")
+        rows.append((
+            length, round(positions_us, 2), round(span_us, 2),
+            round(positions_us / span_us, 1)))
+        logger.info(
+            f"{length} bp: get_reference_positions {positions_us:.1f} us, "
+            f"aligned_reference_span {span_us:.1f} us per read")
+
+    summary = pd.DataFrame(rows, columns=[
+        "length", "get_reference_positions_us", "aligned_reference_span_us",
+        "speedup"])
+    print(summary.to_string(index=False))
+    if args.output:
+        summary.to_csv(args.output, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    main(args)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""Compare assign_barcodes' reused UMIs with re-aligned ones.
+
+extract_barcode.py --extract_umi stores the UMI it aligned with the
+barcode as temporary ur and uy tags, which assign_barcodes.py reuses when
+the barcode was corrected by substitutions alone. Each contig's
+extract_barcode output BAM of a run_benchmarks.py work directory is
+assigned twice: as is, and with the ur and uy tags removed, so that every
+UMI is re-aligned. The fraction of assigned reads that reused their UMI,
+the agreement of the UMIs of both runs and, given the simulation's
+truth.tsv, the edit distance of each run's UMIs to the simulated UMIs are
+reported.
+"""
+import argparse
+import logging
+from pathlib import Path
+import re
+import subprocess
+import sys
+import time
+
+import editdistance as ed
+import pandas as pd
+import pysam
+
+
+logger = logging.getLogger(__name__)
+
+BIN_DIR = Path(__file__).resolve().parent.parent / "bin"
+REUSED = re.compile(r"Reused the extracted UMI of (\d+) of")
+
+
+def parse_args():
+    """Create argument parser."""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "work_dir",
+        help="run_benchmarks.py work directory of one read count, with the \
+        <contig>.bc_extract.bam files and whitelist_index",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "whitelist",
+        help="Whitelist of the simulated reads",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--truth",
+        help="truth.tsv of the simulated reads [None]",
+        type=Path,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--output",
+        help="Write the comparison of each contig to this TSV [None]",
+        type=Path,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--verbosity",
+        help="logging level: <=2 logs info, <=3 logs warnings",
+        type=int,
+        default=2,
+    )
+
+    return parser.parse_args()
+
+
+def init_logger(args):
+    """Initiate logger."""
+    logging.basicConfig(
+        format="%(asctime)s -- %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    logging_level = args.verbosity * 10
+    logging.root.setLevel(logging_level)
+
+
+def strip_umi_tags(bam_in, bam_out):
+    """Copy a BAM without the ur and uy tags of extract_barcode.py."""
+    with pysam.AlignmentFile(str(bam_in), "rb") as f_in, \
+            pysam.AlignmentFile(str(bam_out), "wb", template=f_in) as f_out:
+        for align in f_in:
+            align.set_tag("ur", None)
+            align.set_tag("uy", None)
+            f_out.write(align)
+    pysam.index(str(bam_out))
+
+
+def assign(bam, contig, name, args):
+    """Run assign_barcodes.py on a contig's BAM.
+
+    :return: Read IDs and UMIs of the assigned reads, number of reads that
+        reused their UMI, and wall time
+    :rtype: class pandas.DataFrame, int, float
+    """
+    work_dir = args.work_dir
+    tags = work_dir / f"{name}.tags.tsv"
+    cmd = [
+        sys.executable, str(BIN_DIR / "assign_barcodes.py"),
+        str(bam), str(args.whitelist),
+        "--contig", contig,
+        "-t", "1",
+        "--output_bam", str(work_dir / f"{name}.bam"),
+        "--output_tags", str(tags),
+        "--output_counts", str(work_dir / f"{name}.counts.tsv"),
+        "--whitelist_index", str(work_dir / "whitelist_index"),
+    ]
+    start = time.perf_counter()
+    log = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+        check=True).stdout
+    wall = time.perf_counter() - start
+    reused = REUSED.search(log)
+    df = pd.read_csv(tags, sep="\t", usecols=["read_id", "UR"])
+    return df, int(reused.group(1)) if reused else 0, wall
+
+
+def mean_distance(umis, truth):
+    """Mean edit distance of UMIs to the simulated UMIs of their reads."""
+    df = umis.merge(truth, on="read_id")
+    if not len(df):
+        return None
+    return sum(
+        ed.eval(a, b) for a, b in zip(df["UR"], df["umi"])) / len(df)
+
+
+def main(args):
+    """Run entry point."""
+    init_logger(args)
+    truth = None
+    if args.truth:
+        truth = pd.read_csv(args.truth, sep="\t", usecols=["read_id", "umi"])
+
+    rows = []
+    for bam in sorted(args.work_dir.glob("*.bc_extract.bam")):
+        contig = bam.name[:-len(".bc_extract.bam")]
+        stripped = args.work_dir / f"{contig}.bc_extract.no_umi.bam"
+        strip_umi_tags(bam, stripped)
+
+        reuse, n_reused, reuse_wall = assign(
+            bam, contig, f"{contig}.umi_reuse", args)
+        realign, _, realign_wall = assign(
+            stripped, contig, f"{contig}.umi_realign", args)
+        both = reuse.merge(realign, on="read_id", suffixes=("", "_realign"))
+        row = {
+            "contig": contig,
+            "assigned": len(reuse),
+            "reused": n_reused,
+            "reuse_rate": round(n_reused / len(reuse), 4)
+            if len(reuse) else None,
+            "same_reads": len(both) == len(reuse) == len(realign),
+            "umi_agreement": round(
+                (both["UR"] == both["UR_realign"]).mean(), 4)
+            if len(both) else None,
+            "reuse_seconds": round(reuse_wall, 2),
+            "realign_seconds": round(realign_wall, 2),
+        }
+        if truth is not None:
+            row["reuse_truth_ed"] = mean_distance(reuse, truth)
+            row["realign_truth_ed"] = mean_distance(realign, truth)
+        rows.append(row)
+        logger.info(
+            f"{contig}: {row['reuse_rate']} of assigned reads reused their "
+            f"UMI, {row['umi_agreement']} of UMIs agree with re-alignment")
+
+    summary = pd.DataFrame(rows)
+    print(summary.to_string(index=False))
+    if args.output:
+        summary.to_csv(args.output, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    main(args)
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+"""Time the read processing scripts in bin/ on simulated data.
+
+For each read count, reads are simulated with simulate_reads.py (once; the
+fixtures are reused by later runs) and the scripts are run in workflow
+order, each on the output of the previous one:
+
+    adapter_scan_vsearch -> (reads.fastq.gz)
+    extract_barcode -> assign_barcodes -> cluster_umis  (per contig)
+    gene_expression -> process_matrix
+
+The wall time, reads/s and peak memory of each script, and of each stage
+reported by its --profile output, are written to summary.tsv and
+summary.json in the output directory. Passing the summary.json of an
+earlier run with --baseline reports the scripts that got slower, and
+--compare_engines compares the adapter configurations that each of
+--engines finds in the same reads.
+"""
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+import subprocess
+import sys
+import time
+
+import pandas as pd
+import pysam
+
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+BIN_DIR = BENCHMARK_DIR.parent / "bin"
+SUPERLIST = BENCHMARK_DIR.parent / "data" / "737K-august-2016.txt.gz"
+SCRIPTS = [
+    "adapter_scan_vsearch",
+    "extract_barcode",
+    "assign_barcodes",
+    "cluster_umis",
+    "gene_expression",
+    "process_matrix",
+]
+
+
+def parse_args():
+    """Create argument parser."""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--output_dir",
+        help="Directory for simulated data, script outputs and the summary \
+        [benchmark_results]",
+        type=Path,
+        default=Path("benchmark_results"),
+    )
+
+    parser.add_argument(
+        "--sizes",
+        help="Numbers of reads to benchmark [10000 100000 1000000]",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+    )
+
+    parser.add_argument(
+        "--scripts",
+        help=f"Scripts to benchmark [{' '.join(SCRIPTS)}]",
+        nargs="+",
+        choices=SCRIPTS,
+        default=SCRIPTS,
+    )
+
+    parser.add_argument(
+        "--engines",
+        help="adapter_scan_vsearch --engine values to benchmark [vsearch]",
+        nargs="+",
+        choices=["vsearch", "vsearch_persistent", "native"],
+        default=["vsearch"],
+    )
+
+    parser.add_argument(
+        "-t", "--threads", help="Threads to use [4]", type=int, default=4
+    )
+
+    parser.add_argument(
+        "--seed", help="Random seed of the simulation [1]", type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--min_full_length",
+        help="Fail if adapter_scan_vsearch labels a smaller fraction of the \
+        simulated reads full_len, as the stranding path would then go \
+        unbenchmarked [0.8]",
+        type=float,
+        default=0.8,
+    )
+
+    parser.add_argument(
+        "--compare_engines",
+        help="Compare the adapter configurations found by each of \
+        --engines with those of the first, read by read, and write the \
+        label and configuration agreement and reads/s of each engine to \
+        engine_comparison.tsv",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--baseline",
+        help="summary.json of an earlier run to compare wall times with \
+        [None]",
+        type=Path,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max_slowdown",
+        help="Report scripts whose wall time exceeds the baseline by more \
+        than this factor, and exit with status 1 if there are any [1.2]",
+        type=float,
+        default=1.2,
+    )
+
+    parser.add_argument(
+        "--verbosity",
+        help="logging level: <=2 logs info, <=3 logs warnings",
+        type=int,
+        default=2,
+    )
+
+    return parser.parse_args()
+
+
+def init_logger(args):
+    """Initiate logger."""
+    logging.basicConfig(
+        format="%(asctime)s -- %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    logging_level = args.verbosity * 10
+    logging.root.setLevel(logging_level)
+
+
+def simulate(size, args):
+    """Simulate reads and fixtures for a read count, unless already done.
+
+    :return: Directory of the simulated data
+    :rtype: class pathlib.Path
+    """
+    sim_dir = args.output_dir / str(size) / "simulated"
+    done = sim_dir / ".done"
+    if not done.exists():
+        logger.info(f"Simulating {size} reads")
+        subprocess.run([
+            sys.executable, str(BENCHMARK_DIR / "simulate_reads.py"),
+            "--n_reads", str(size),
+            "--seed", str(args.seed),
+            "--output_dir", str(sim_dir),
+            "--verbosity", str(args.verbosity),
+        ], check=True)
+        done.touch()
+    return sim_dir
+
+
+def run_script(script, script_args, work_dir, name):
+    """Run a bin/ script with --profile and time it.
+
+    :param script: Name of the script in bin/, without extension
+    :type script: str
+    :param script_args: Arguments for the script
+    :type script_args: list
+    :param work_dir: Directory to run the script in
+    :type work_dir: class pathlib.Path
+    :param name: Name of this run, used for its profile and log files
+    :type name: str
+    :return: Wall time of the run and the profile written by the script
+    :rtype: float, dict
+    """
+    profile = work_dir / f"{name}.profile.json"
+    cmd = [sys.executable, str(BIN_DIR / f"{script}.py")] + [
+        str(arg) for arg in script_args] + ["--profile", profile.name]
+    logger.debug(" ".join(cmd))
+    start = time.perf_counter()
+    with open(work_dir / f"{name}.log", "w") as log:
+        subprocess.run(
+            cmd, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT,
+            check=True)
+    wall = time.perf_counter() - start
+    with open(profile) as f:
+        return wall, json.load(f)
+
+
+def check_full_length(path, args):
+    """Check that most simulated reads are stranded as full length.
+
+    :param path: Read configuration TSV of adapter_scan_vsearch
+    :type path: class pathlib.Path
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    """
+    labels = pd.read_csv(path, sep="\t", usecols=["lab"])["lab"]
+    fraction = (labels == "full_len").mean() if len(labels) else 0.0
+    logger.info(f"{path.name}: {fraction:.1%} of reads full_len")
+    if fraction < args.min_full_length:
+        raise ValueError(
+            f"Only {fraction:.1%} of the reads in {path} are full_len; "
+            "the simulated adapters do not match the workflow's.")
+
+
+def compare_engines(size, wall_times, args):
+    """Compare the adapter configurations of each engine with the first.
+
+    The read configuration tables of the engines are joined on the read ID
+    of each (sub)read, so that reads found by only one engine disagree.
+
+    :param size: Number of simulated reads
+    :type size: int
+    :param wall_times: Wall time of adapter_scan_vsearch by engine
+    :type wall_times: dict
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: A row per engine
+    :rtype: list
+    """
+    work_dir = args.output_dir / str(size) / "work"
+    columns = ["read_id", "orig_adapter_config", "adapter_config", "lab"]
+    tables = {
+        engine: pd.read_csv(
+            work_dir / f"adapt_scan.{engine}.tsv", sep="\t",
+            usecols=columns).set_index("read_id")
+        for engine in args.engines}
+    reference = args.engines[0]
+    rows = []
+    for engine in args.engines:
+        df = tables[reference].join(
+            tables[engine], how="outer", lsuffix="_ref")
+        same_lab = df["lab"] == df["lab_ref"]
+        same_config = same_lab & (
+            df["orig_adapter_config"] == df["orig_adapter_config_ref"]) & (
+            df["adapter_config"] == df["adapter_config_ref"])
+        full_len = tables[engine]["lab"] == "full_len"
+        wall = wall_times[engine]
+        rows.append({
+            "n_reads": size,
+            "engine": engine,
+            "reference": reference,
+            "subreads": len(tables[engine]),
+            "full_len": round(full_len.mean(), 4),
+            "label_agreement": round(same_lab.mean(), 4),
+            "config_agreement": round(same_config.mean(), 4),
+            "seconds": round(wall, 3),
+            "reads_per_second": round(size / wall, 1) if wall > 0 else None,
+        })
+        logger.info(
+            f"{engine} vs {reference} ({size} reads): "
+            f"{same_lab.mean():.2%} labels and {same_config.mean():.2%} "
+            f"configurations agree, {size / wall:.0f} reads/s")
+    return rows
+
+
+def concat_tsv(paths, output):
+    """Concatenate TSV files, keeping the header of the first one."""
+    with open(output, "w") as f_out:
+        for i, path in enumerate(paths):
+            with open(path) as f_in:
+                if i > 0:
+                    f_in.readline()
+                f_out.writelines(f_in)
+
+
+def benchmark_size(size, args):
+    """Run the benchmarked scripts on simulated data of one read count.
+
+    :return: (script, variant, wall seconds, profiles) tuples, with one
+        profile for each run of the script
+    :rtype: list
+    """
+    sim_dir = simulate(size, args).resolve()
+    work_dir = args.output_dir / str(size) / "work"
+    work_dir.mkdir(parents=True, exist_ok=True)
+    with pysam.AlignmentFile(str(sim_dir / "aligned.bam"), "rb") as bam:
+        contigs = list(bam.references)
+    results = []
+
+    if "adapter_scan_vsearch" in args.scripts:
+        for engine in args.engines:
+            logger.info(f"{size} reads: adapter_scan_vsearch ({engine})")
+            wall, profile = run_script("adapter_scan_vsearch", [
+                sim_dir / "reads.fastq.gz",
+                "-t", args.threads,
+                "--engine", engine,
+                "--output_fastq", f"adapt_scan.{engine}.fastq.gz",
+                "--output_tsv", f"adapt_scan.{engine}.tsv",
+            ], work_dir, f"adapter_scan_vsearch.{engine}")
+            check_full_length(work_dir / f"adapt_scan.{engine}.tsv", args)
+            results.append(("adapter_scan_vsearch", engine, wall, [profile]))
+
+    # The remaining scripts run per contig, on the output of the previous
+    # script; their time is summed over contigs
+    per_contig = {
+        script: (0.0, []) for script in [
+            "extract_barcode", "assign_barcodes", "cluster_umis"]
+        if script in args.scripts}
+    read_tags = []
+    if "assign_barcodes" in per_contig:
+        # Like the workflow, index the whitelist once for all contigs
+        subprocess.run([
+            sys.executable, str(BIN_DIR / "index_whitelist.py"),
+            str(sim_dir / "whitelist.tsv"), str(work_dir / "whitelist_index"),
+            "--verbosity", str(args.verbosity),
+        ], check=True)
+    for contig in contigs:
+        if "extract_barcode" in per_contig:
+            logger.info(f"{size} reads: extract_barcode ({contig})")
+            wall, profile = run_script("extract_barcode", [
+                sim_dir / "aligned.bam", SUPERLIST,
+                "--contig", contig,
+                "-t", args.threads,
+                "--extract_umi",
+                "--output_bam", f"{contig}.bc_extract.bam",
+                "--output_barcodes", f"{contig}.uncorrected_bc_counts.tsv",
+            ], work_dir, f"extract_barcode.{contig}")
+            total, profiles = per_contig["extract_barcode"]
+            per_contig["extract_barcode"] = (
+                total + wall, profiles + [profile])
+
+        if "assign_barcodes" in per_contig:
+            logger.info(f"{size} reads: assign_barcodes ({contig})")
+            wall, profile = run_script("assign_barcodes", [
+                f"{contig}.bc_extract.bam", sim_dir / "whitelist.tsv",
+                "--contig", contig,
+                "-t", 1,
+                "--output_bam", f"{contig}.bc_assign.bam",
+                "--output_tags", f"{contig}.bc_ur_tags.npz",
+                "--output_counts", f"{contig}.bc_assign_counts.tsv",
+                "--whitelist_index", "whitelist_index",
+            ], work_dir, f"assign_barcodes.{contig}")
+            pysam.index(str(work_dir / f"{contig}.bc_assign.bam"))
+            total, profiles = per_contig["assign_barcodes"]
+            per_contig["assign_barcodes"] = (
+                total + wall, profiles + [profile])
+
+        if "cluster_umis" in per_contig:
+            logger.info(f"{size} reads: cluster_umis ({contig})")
+            wall, profile = run_script("cluster_umis", [
+                f"{contig}.bc_assign.bam",
+                "--chrom", contig,
+                "--threads", args.threads,
+                "--gene_assigns", sim_dir / "gene_assigns.tsv",
+                "--transcript_assigns", sim_dir / "transcript_assigns.tsv",
+                "--bc_ur_tags", f"{contig}.bc_ur_tags.npz",
+                "--output", f"{contig}.tagged.bam",
+                "--output_read_tags", f"{contig}.read_tags.tsv",
+            ], work_dir, f"cluster_umis.{contig}")
+            total, profiles = per_contig["cluster_umis"]
+            per_contig["cluster_umis"] = (total + wall, profiles + [profile])
+            read_tags.append(work_dir / f"{contig}.read_tags.tsv")
+
+    for script, (wall, profiles) in per_contig.items():
+        results.append((script, "", wall, profiles))
+
+    if "gene_expression" in args.scripts:
+        if read_tags:
+            concat_tsv(read_tags, work_dir / "read_tags.tsv")
+        logger.info(f"{size} reads: gene_expression")
+        wall, profile = run_script("gene_expression", [
+            "--read_tags", "read_tags.tsv",
+            "--output_prefix", "sample",
+        ], work_dir, "gene_expression")
+        results.append(("gene_expression", "", wall, [profile]))
+
+    if "process_matrix" in args.scripts:
+        logger.info(f"{size} reads: process_matrix")
+        wall, profile = run_script("process_matrix", [
+            "--gene_counts", "sample.gene_expression.counts.tsv",
+            "--transcript_counts", "sample.transcript_expression.counts.tsv",
+            "--min_genes", 1,
+            "--min_cells", 1,
+            "--max_mito", 100,
+            "--output_prefix", "sample",
+        ], work_dir, "process_matrix")
+        results.append(("process_matrix", "", wall, [profile]))
+
+    return results
+
+
+def peak_rss_mb(profile):
+    """Peak memory of a profiled run, preferring the sampled process tree."""
+    rss = profile["peak_rss_mb"]
+    return rss.get("sampled_total", max(rss["self"], rss["children"]))
+
+
+def summarize(size, script, variant, wall, profiles):
+    """Summarise the runs of a script as a row per script and stage.
+
+    Stage times and reads are summed over runs, e.g. contigs.
+    """
+    rows = [{
+        "n_reads": size,
+        "script": script,
+        "variant": variant,
+        "stage": "total",
+        "seconds": round(wall, 3),
+        "reads": size,
+        "reads_per_second": round(size / wall, 1) if wall > 0 else None,
+        "peak_rss_mb": max(peak_rss_mb(p) for p in profiles),
+    }]
+    stages = {}
+    for profile in profiles:
+        for section in ["stages", "worker_stages"]:
+            for name, stage in profile.get(section, {}).items():
+                key = name if section == "stages" else f"worker:{name}"
+                seconds, reads = stages.get(key, (0.0, 0))
+                stages[key] = (seconds + stage["seconds"],
+                               reads + stage["reads"])
+    for key, (seconds, reads) in stages.items():
+        rows.append({
+            "n_reads": size,
+            "script": script,
+            "variant": variant,
+            "stage": key,
+            "seconds": round(seconds, 3),
+            "reads": reads,
+            "reads_per_second": (
+                round(reads / seconds, 1) if reads and seconds > 0 else None),
+            "peak_rss_mb": None,
+        })
+    return rows
+
+
+def compare_with_baseline(summary, args):
+    """Report scripts slower than in the baseline summary.
+
+    :return: Whether any script exceeded --max_slowdown
+    :rtype: bool
+    """
+    with open(args.baseline) as f:
+        baseline = pd.DataFrame(json.load(f))
+    key = ["n_reads", "script", "variant", "stage"]
+    df = summary[summary["stage"] == "total"].merge(
+        baseline[baseline["stage"] == "total"], on=key,
+        suffixes=("", "_baseline"))
+    df["slowdown"] = df["seconds"] / df["seconds_baseline"]
+
+    regressed = False
+    for row in df.itertuples():
+        status = "ok"
+        if row.slowdown > args.max_slowdown:
+            status = "SLOWER"
+            regressed = True
+        logger.info(
+            f"{row.script} {row.variant} ({row.n_reads} reads): "
+            f"{row.seconds:.2f}s vs {row.seconds_baseline:.2f}s "
+            f"({row.slowdown:.2f}x) {status}")
+    return regressed
+
+
+def main(args):
+    """Run entry point."""
+    init_logger(args)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    os.environ.setdefault("PYTHONHASHSEED", "0")
+
+    rows = []
+    comparison = []
+    for size in args.sizes:
+        results = benchmark_size(size, args)
+        for script, variant, wall, profiles in results:
+            rows.extend(summarize(size, script, variant, wall, profiles))
+        if args.compare_engines and "adapter_scan_vsearch" in args.scripts:
+            comparison.extend(compare_engines(size, {
+                variant: wall for script, variant, wall, _ in results
+                if script == "adapter_scan_vsearch"}, args))
+    summary = pd.DataFrame(rows)
+    summary.to_csv(args.output_dir / "summary.tsv", sep="\t", index=False)
+    with open(args.output_dir / "summary.json", "w") as f:
+        json.dump(rows, f, indent=4)
+    logger.info(f"Wrote summary to {args.output_dir / 'summary.tsv'}")
+    if comparison:
+        pd.DataFrame(comparison).to_csv(
+            args.output_dir / "engine_comparison.tsv", sep="\t",
+            index=False)
+
+    if args.baseline and compare_with_baseline(summary, args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    main(args)
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+"""Simulate 10x-like ONT reads and alignment fixtures for benchmarking."""
+import argparse
+import gzip
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pysam
+
+
+logger = logging.getLogger(__name__)
+
+ADAPTER1_SEQ = "CTACACGACGCTCTTCCGATCT"
+# Reverse complement of the TSO, as it reads at the 3' end of a stranded
+# read; the workflow's adapter2_seq
+ADAPTER2_SEQ = "ATGTACTCTGCGTTGATACCACTGCTT"
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+COMPLEMENT_TRANS = str.maketrans("ACGT", "TGCA")
+
+# Cigar operations recorded by mutate()
+OP_MATCH, OP_INS, OP_DEL = 0, 1, 2
+
+
+def parse_args():
+    """Create argument parser."""
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--output_dir",
+        help="Directory to write the simulated reads and fixtures to \
+        [simulated]",
+        type=Path,
+        default=Path("simulated"),
+    )
+
+    parser.add_argument(
+        "-n", "--n_reads", help="Number of reads [10000]", type=int,
+        default=10000,
+    )
+
+    parser.add_argument(
+        "--n_cells", help="Number of cell barcodes [500]", type=int,
+        default=500,
+    )
+
+    parser.add_argument(
+        "--n_genes", help="Number of genes [500]", type=int, default=500,
+    )
+
+    parser.add_argument(
+        "--n_contigs", help="Number of reference contigs [2]", type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--reads_per_molecule",
+        help="Mean number of reads sequenced from each cDNA molecule, i.e. \
+        sharing a barcode and UMI [2.0]",
+        type=float,
+        default=2.0,
+    )
+
+    parser.add_argument(
+        "--intergenic_fraction",
+        help="Fraction of molecules from outside annotated genes [0.05]",
+        type=float,
+        default=0.05,
+    )
+
+    parser.add_argument(
+        "--error_rate",
+        help="Per-base error rate; errors are split 40:30:30 between \
+        substitutions, insertions and deletions [0.05]",
+        type=float,
+        default=0.05,
+    )
+
+    parser.add_argument(
+        "--superlist",
+        help="Barcode superlist to draw cell barcodes from \
+        [data/737K-august-2016.txt.gz]",
+        type=Path,
+        default=Path(__file__).resolve().parents[1] / "data" /
+        "737K-august-2016.txt.gz",
+    )
+
+    parser.add_argument(
+        "--barcode_length", help="Cell barcode length [16]", type=int,
+        default=16,
+    )
+
+    parser.add_argument(
+        "--umi_length", help="UMI length [12]", type=int, default=12,
+    )
+
+    parser.add_argument(
+        "--seed", help="Random seed [1]", type=int, default=1,
+    )
+
+    parser.add_argument(
+        "--verbosity",
+        help="logging level: <=2 logs info, <=3 logs warnings",
+        type=int,
+        default=2,
+    )
+
+    return parser.parse_args()
+
+
+def init_logger(args):
+    """Initiate logger."""
+    logging.basicConfig(
+        format="%(asctime)s -- %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    logging_level = args.verbosity * 10
+    logging.root.setLevel(logging_level)
+
+
+def revcomp(seq):
+    """Reverse complement a sequence of ACGT bases."""
+    return seq.translate(COMPLEMENT_TRANS)[::-1]
+
+
+def random_seq(rng, n):
+    """Draw a uniformly random sequence of n bases."""
+    return BASES[rng.integers(0, 4, n)].tobytes().decode()
+
+
+def mutate(seq, rate, rng):
+    """Add ONT-like substitution and indel errors to a sequence.
+
+    :param seq: Sequence to mutate
+    :type seq: str
+    :param rate: Per-base error rate
+    :type rate: float
+    :param rng: Random number generator
+    :type rng: class numpy.random.Generator
+    :return: Mutated sequence and the operations aligning it to the
+        original sequence, one of OP_MATCH, OP_INS or OP_DEL per column
+    :rtype: str, class numpy.ndarray
+    """
+    bases = np.frombuffer(seq.encode(), dtype=np.uint8).copy()
+    u = rng.random(len(bases))
+    sub = u < 0.4 * rate
+    ins = (u >= 0.4 * rate) & (u < 0.7 * rate)
+    dele = (u >= 0.7 * rate) & (u < rate)
+
+    # Substitute with one of the other three bases
+    if sub.any():
+        codes = np.searchsorted(BASES, bases[sub])
+        bases[sub] = BASES[(codes + rng.integers(1, 4, sub.sum())) % 4]
+
+    ops = np.full(len(bases), OP_MATCH, dtype=np.uint8)
+    ops[dele] = OP_DEL
+    # Insert a random base before each insertion position
+    ins_pos = np.flatnonzero(ins)
+    if len(ins_pos):
+        bases = np.insert(
+            bases, ins_pos, BASES[rng.integers(0, 4, len(ins_pos))])
+        ops = np.insert(ops, ins_pos, OP_INS)
+        dele = np.insert(dele, ins_pos, False)
+
+    return bases[~dele].tobytes().decode(), ops
+
+
+def ops_to_cigar(ops):
+    """Run-length encode alignment operations as (op, length) tuples."""
+    if len(ops) == 0:
+        return []
+    boundaries = np.flatnonzero(ops[1:] != ops[:-1]) + 1
+    starts = np.r_[0, boundaries]
+    lengths = np.diff(np.r_[starts, len(ops)])
+    return [
+        (int(op), int(n)) for op, n in zip(ops[starts], lengths)]
+
+
+def simulate_qualities(rng, n):
+    """Draw ONT-like base qualities as a phred+33 string."""
+    q = np.clip(rng.normal(18, 6, n), 2, 40).astype(np.uint8)
+    return (q + 33).tobytes().decode()
+
+
+def load_cell_barcodes(args, rng):
+    """Sample cell barcodes from the superlist.
+
+    :return: Cell barcodes and their relative abundances
+    :rtype: list, class numpy.ndarray
+    """
+    with gzip.open(args.superlist, "rt") as f:
+        superlist = [line.strip() for line in f]
+    idx = rng.choice(len(superlist), size=args.n_cells, replace=False)
+    barcodes = sorted(superlist[i] for i in idx)
+    weights = rng.lognormal(0, 1, args.n_cells)
+    return barcodes, weights / weights.sum()
+
+
+def simulate_reference(args, rng):
+    """Simulate contigs with single-exon genes between intergenic spacers.
+
+    :return: Contig sequences keyed by name and genes, as dicts with name,
+        transcript, contig, start, end and strand
+    :rtype: dict, list
+    """
+    genes = []
+    contigs = {}
+    per_contig = np.array_split(np.arange(args.n_genes), args.n_contigs)
+    # A few mitochondrial genes so that process_matrix has some to filter
+    n_mito = max(1, args.n_genes // 50)
+    for c, gene_ids in enumerate(per_contig, 1):
+        name = f"chr{c}"
+        parts = []
+        pos = 0
+        for g in gene_ids:
+            spacer = int(rng.integers(2000, 6000))
+            length = int(rng.integers(1000, 4000))
+            parts.append(random_seq(rng, spacer + length))
+            prefix = "MT-" if g < n_mito else ""
+            genes.append({
+                "name": f"{prefix}GENE{g:05d}",
+                "transcript": f"TX{g:05d}",
+                "contig": name,
+                "start": pos + spacer,
+                "end": pos + spacer + length,
+                "strand": "+" if rng.random() < 0.5 else "-",
+            })
+            pos += spacer + length
+        parts.append(random_seq(rng, 2000))
+        contigs[name] = "".join(parts)
+    return contigs, genes
+
+
+def write_reference(contigs, genes, args):
+    """Write the reference FASTA and gene annotation GTF."""
+    with open(args.output_dir / "reference.fasta", "w") as f:
+        for name, seq in contigs.items():
+            f.write(f">{name}\n")
+            for i in range(0, len(seq), 80):
+                f.write(seq[i:i + 80] + "\n")
+    pysam.faidx(str(args.output_dir / "reference.fasta"))
+
+    with open(args.output_dir / "genes.gtf", "w") as f:
+        for gene in genes:
+            attrs = (
+                f'gene_id "{gene["name"]}"; gene_name "{gene["name"]}"; '
+                f'transcript_id "{gene["transcript"]}";')
+            for feature in ["gene", "transcript", "exon"]:
+                f.write("\t".join([
+                    gene["contig"], "simulated", feature,
+                    str(gene["start"] + 1), str(gene["end"]), ".",
+                    gene["strand"], ".", attrs]) + "\n")
+
+
+def simulate_molecules(contigs, genes, barcodes, cell_weights, args, rng):
+    """Simulate the cDNA molecules that reads are sequenced from.
+
+    Each molecule is the 3' end of a transcript (or an intergenic
+    fragment), tagged with a cell barcode and UMI. Gene expression follows
+    a Zipf-like distribution.
+
+    :return: Molecules as dicts with barcode, umi, gene, transcript, contig,
+        start, end and the genomic strand of the transcript
+    :rtype: list
+    """
+    n_molecules = max(1, int(round(args.n_reads / args.reads_per_molecule)))
+    gene_weights = 1 / np.arange(1, len(genes) + 1)
+    gene_weights = rng.permutation(gene_weights / gene_weights.sum())
+    cells = rng.choice(len(barcodes), size=n_molecules, p=cell_weights)
+    gene_idx = rng.choice(len(genes), size=n_molecules, p=gene_weights)
+    intergenic = rng.random(n_molecules) < args.intergenic_fraction
+    lengths = rng.integers(200, 1500, n_molecules)
+
+    molecules = []
+    for i in range(n_molecules):
+        gene = genes[gene_idx[i]]
+        if intergenic[i]:
+            contig = gene["contig"]
+            # Place intergenic fragments in the spacer upstream of the gene
+            end = gene["start"] - int(rng.integers(0, 500))
+            start = max(0, end - int(lengths[i]))
+            strand = "+" if rng.random() < 0.5 else "-"
+            name, transcript = "NA", "-"
+        else:
+            contig = gene["contig"]
+            length = min(int(lengths[i]), gene["end"] - gene["start"])
+            strand = gene["strand"]
+            # cDNA covers the 3' end of the transcript
+            if strand == "+":
+                start, end = gene["end"] - length, gene["end"]
+            else:
+                start, end = gene["start"], gene["start"] + length
+            name, transcript = gene["name"], gene["transcript"]
+        molecules.append({
+            "barcode": barcodes[cells[i]],
+            "umi": random_seq(rng, args.umi_length),
+            "gene": name,
+            "transcript": transcript,
+            "contig": contig,
+            "start": start,
+            "end": end,
+            "strand": strand,
+        })
+    return molecules
+
+
+def split_ops(ops, start, end):
+    """Split the alignment operations of a mutated sequence by segment.
+
+    :param ops: Operations from mutate()
+    :type ops: class numpy.ndarray
+    :param start: Start of the segment in the original sequence
+    :type start: int
+    :param end: End of the segment in the original sequence
+    :type end: int
+    :return: Number of mutated bases before and after the segment and the
+        operations of the segment, trimmed to start and end with a match,
+        plus the number of original bases trimmed from either end
+    :rtype: int, int, class numpy.ndarray, int, int
+    """
+    # Insertions are assigned to the segment of the preceding base
+    orig = np.cumsum(ops != OP_INS) - 1
+    emitted = ops != OP_DEL
+    segment = (orig >= start) & (orig < end)
+    n_before = int(emitted[orig < start].sum())
+    n_after = int(emitted[orig >= end].sum())
+    ops = ops[segment]
+
+    # Alignments start and end with a match; clip insertions and skip
+    # deleted reference bases at either end
+    match = np.flatnonzero(ops == OP_MATCH)
+    head, tail = ops[:match[0]], ops[match[-1] + 1:]
+    n_before += int((head == OP_INS).sum())
+    n_after += int((tail == OP_INS).sum())
+    return n_before, n_after, ops[match[0]:match[-1] + 1], \
+        int((head == OP_DEL).sum()), int((tail == OP_DEL).sum())
+
+
+def simulate_read(molecule, contigs, args, rng):
+    """Simulate a sequencing read of a molecule.
+
+    The stranded read is <adapter1><barcode><UMI><polyT><cDNA><adapter2>,
+    where the cDNA is the reverse complement of the transcript's 3' end and
+    adapter2 the reverse complement of the TSO. The alignment of the
+    mutated cDNA segment to the reference is tracked to build the BAM
+    record.
+
+    :return: Stranded read sequence and qualities, the length of the
+        unaligned prefix and suffix, the alignment operations of the cDNA
+        segment in stranded read orientation and the number of reference
+        bases at the start and end of the molecule not covered by them
+    :rtype: str, str, int, int, class numpy.ndarray, int, int
+    """
+    genomic = contigs[molecule["contig"]][molecule["start"]:molecule["end"]]
+    # Transcript sense sequence; the stranded read holds its complement
+    cdna = revcomp(genomic) if molecule["strand"] == "+" else genomic
+    prefix = (
+        random_seq(rng, int(rng.integers(0, 20))) + ADAPTER1_SEQ +
+        molecule["barcode"] + molecule["umi"] +
+        "T" * int(rng.integers(20, 31)))
+    suffix = ADAPTER2_SEQ + random_seq(rng, int(rng.integers(0, 20)))
+
+    seq, ops = mutate(prefix + cdna + suffix, args.error_rate, rng)
+    n_prefix, n_suffix, ops, skip_head, skip_tail = split_ops(
+        ops, len(prefix), len(prefix) + len(cdna))
+    if molecule["strand"] == "+":
+        skip_start, skip_end = skip_tail, skip_head
+    else:
+        skip_start, skip_end = skip_head, skip_tail
+    return seq, simulate_qualities(rng, len(seq)), n_prefix, n_suffix, \
+        ops, skip_start, skip_end
+
+
+def write_fixtures(molecules, contigs, genes, barcodes, args, rng):
+    """Simulate reads and write the FASTQ, BAM and TSV fixtures."""
+    header = {
+        "HD": {"VN": "1.6", "SO": "unsorted"},
+        "SQ": [{"SN": name, "LN": len(seq)} for name, seq in contigs.items()],
+    }
+    contig_ids = {name: i for i, name in enumerate(contigs)}
+    unsorted_bam = str(args.output_dir / "aligned.unsorted.bam")
+    truth = {}
+
+    with gzip.open(args.output_dir / "reads.fastq.gz", "wt",
+                   compresslevel=1) as fastq, \
+            pysam.AlignmentFile(unsorted_bam, "wb", header=header) as bam, \
+            open(args.output_dir / "truth.tsv", "w") as f_truth:
+        f_truth.write(
+            "read_id\tbarcode\tumi\tgene\ttranscript\tchr\tstart\tend\t"
+            "read_strand\n")
+        picks = rng.integers(0, len(molecules), args.n_reads)
+        for i, m in enumerate(picks):
+            molecule = molecules[m]
+            read_id = f"read{i:09d}"
+            seq, qual, n_prefix, n_suffix, ops, skip_start, _ = \
+                simulate_read(molecule, contigs, args, rng)
+
+            # Reads are sequenced from either strand of the cDNA
+            read_strand = "+" if rng.random() < 0.5 else "-"
+            if read_strand == "+":
+                fastq.write(f"@{read_id}\n{seq}\n+\n{qual}\n")
+            else:
+                fastq.write(
+                    f"@{read_id}\n{revcomp(seq)}\n+\n{qual[::-1]}\n")
+
+            # The cDNA of a + strand transcript aligns to the reverse
+            # strand of the reference
+            align = pysam.AlignedSegment(bam.header)
+            align.query_name = read_id
+            align.reference_id = contig_ids[molecule["contig"]]
+            align.reference_start = molecule["start"] + skip_start
+            align.mapping_quality = 60
+            cigar = [(4, n_prefix)] + ops_to_cigar(ops) + [(4, n_suffix)]
+            cigar = [(op, n) for op, n in cigar if n > 0]
+            if molecule["strand"] == "+":
+                align.flag = 16
+                align.query_sequence = revcomp(seq)
+                align.query_qualities = pysam.qualitystring_to_array(
+                    qual[::-1])
+                align.cigartuples = cigar[::-1]
+            else:
+                align.flag = 0
+                align.query_sequence = seq
+                align.query_qualities = pysam.qualitystring_to_array(qual)
+                align.cigartuples = cigar
+            bam.write(align)
+
+            truth[read_id] = (molecule["gene"], molecule["transcript"])
+            f_truth.write("\t".join(map(str, [
+                read_id, molecule["barcode"], molecule["umi"],
+                molecule["gene"], molecule["transcript"],
+                molecule["contig"], molecule["start"], molecule["end"],
+                read_strand])) + "\n")
+
+    aligned_bam = str(args.output_dir / "aligned.bam")
+    pysam.sort("-o", aligned_bam, unsorted_bam)
+    pysam.index(aligned_bam)
+    os.remove(unsorted_bam)
+
+    # Gene and transcript assignments follow the sorted BAM order, like
+    # those of the workflow
+    with pysam.AlignmentFile(aligned_bam, "rb") as bam, \
+            open(args.output_dir / "gene_assigns.tsv", "w") as f_genes, \
+            open(args.output_dir / "transcript_assigns.tsv", "w") as f_tr:
+        f_tr.write(
+            "read_id\tqry_id\tref_id\tref_gene_id\tclass_code\tstatus\n")
+        for align in bam.fetch(until_eof=True):
+            gene, transcript = truth[align.query_name]
+            if gene == "NA":
+                f_genes.write(
+                    f"{align.query_name}\tUnassigned_NoFeatures\t60\tNA\n")
+                f_tr.write(f"{align.query_name}\t-\t-\t-\t-\tUnassigned\n")
+            else:
+                f_genes.write(f"{align.query_name}\tAssigned\t60\t{gene}\n")
+                f_tr.write(
+                    f"{align.query_name}\t{transcript}\t{transcript}\t"
+                    f"{gene}\t=\tAssigned\n")
+
+    with open(args.output_dir / "whitelist.tsv", "w") as f:
+        for barcode in barcodes:
+            f.write(f"{barcode}-1\n")
+
+
+def main(args):
+    """Run entry point."""
+    init_logger(args)
+    rng = np.random.default_rng(args.seed)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    logger.info("Simulating reference")
+    contigs, genes = simulate_reference(args, rng)
+    write_reference(contigs, genes, args)
+
+    logger.info(f"Sampling {args.n_cells} cell barcodes")
+    barcodes, cell_weights = load_cell_barcodes(args, rng)
+
+    logger.info(f"Simulating {args.n_reads} reads in {args.output_dir}")
+    molecules = simulate_molecules(
+        contigs, genes, barcodes, cell_weights, args, rng)
+    write_fixtures(molecules, contigs, genes, barcodes, args, rng)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    main(args)
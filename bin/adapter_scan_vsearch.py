@@ -1,21 +1,32 @@
 #!/usr/bin/python3
 """Adapter scan vsearch."""
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import gzip
+import io
+import itertools
+import json
 import logging
 import multiprocessing
 import os
 from pathlib import Path
+import queue
+import re
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import zlib
 
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 import numpy as np
 import pandas as pd
+import parasail
+from profiling import Profiler
 import pysam
 from tqdm import tqdm
 
@@ -94,6 +105,94 @@ def parse_args():
         default="adapter_seqs.fasta",
     )
 
+    parser.add_argument(
+        "--engine",
+        help="Adapter search engine. 'vsearch' starts a VSEARCH process per \
+                        batch, 'vsearch_persistent' keeps one long-lived \
+                        VSEARCH process per thread fed over pipes and \
+                        'native' aligns the adapters in-process with \
+                        parasail; it is experimental until its labels are \
+                        compared with VSEARCH's (benchmarks/ \
+                        run_benchmarks.py --compare_engines). The latter \
+                        two imply --streaming [vsearch]",
+        choices=["vsearch", "vsearch_persistent", "native"],
+        default="vsearch",
+    )
+
+    parser.add_argument(
+        "--output_parquet",
+        help="Write the adapter configurations in Parquet format, with \
+                        categorical orig_strand, adapter_config and lab \
+                        columns, to this file instead of writing \
+                        --output_tsv. Requires pyarrow [None]",
+        type=Path,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--output_stats",
+        help="Output file name for summary statistics of the adapter \
+                        configurations (JSON), computed as batches complete \
+                        [None]",
+        type=Path,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--compression_level",
+        help="gzip compression level (1-9) for the stranded FASTQ [1]",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--compress_threads",
+        help="Threads used by each batch worker to compress the stranded \
+                        FASTQ [1]",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--parser",
+        help="Implementation used to parse adapter hits into subreads. \
+                        'columnar' uses vectorized array operations over the \
+                        whole batch, 'groupby' processes reads one at a time \
+                        with pandas [columnar]",
+        choices=["columnar", "groupby"],
+        default="columnar",
+    )
+
+    parser.add_argument(
+        "--streaming",
+        help="Stream the input FASTQ into batches from a single reader \
+                        thread instead of counting and splitting it into \
+                        temporary files first. No temporary FASTQ/FASTA \
+                        files are written in this mode [False]",
+        action="store_true",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--max_batches_in_flight",
+        help="Maximum number of batches being processed or waiting to be \
+                        merged into the outputs. Batch FASTQs are only \
+                        split from the input when a batch can be submitted \
+                        and merged batches have their temporary files \
+                        deleted, so this caps temporary disk usage \
+                        [2 x threads]",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Write a JSON profile of the time, reads/s and peak memory of \
+                        each stage to this file [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "--verbosity",
         help="logging level: <=2 logs info, <=3 logs warnings",
@@ -123,6 +222,20 @@ def parse_args():
         # Poly-dT RT adapter
         args.adapter2_seq = "GTACTCTGCGTTGATACCACTGCTT"
 
+    if args.engine in ["vsearch_persistent", "native"]:
+        args.streaming = True
+
+    if args.max_batches_in_flight is None:
+        args.max_batches_in_flight = 2 * args.threads
+    elif args.max_batches_in_flight < 1:
+        raise Exception("--max_batches_in_flight must be at least 1.")
+
+    if args.output_parquet:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise Exception("--output_parquet requires pyarrow.")
+
     # Create temp dir and add that to the args object
     p = Path(args.output_tsv)
     tempdir = tempfile.TemporaryDirectory(prefix="tmp.", dir=p.parents[0])
@@ -138,32 +251,52 @@ def parse_args():
 COMPLEMENT_TRANS = str.maketrans(
     "ACGTWSMKRYBDHVNacgtwsmkrybdhvn", "TGCAWSKMYRVHDBNtgcawskmyrvhdbn"
 )
+COMPLEMENT_BYTES_TRANS = bytes.maketrans(
+    b"ACGTWSMKRYBDHVNacgtwsmkrybdhvn", b"TGCAWSKMYRVHDBNtgcawskmyrvhdbn"
+)
 
 
 def run_subprocess(cmd):
-    """Run OS command and return stdout & stderr."""
-    p = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE)
+    """Run OS command and return stdout, stderr & exit status."""
+    p = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
     stdout, stderr = p.communicate()
-    return str(stdout), str(stderr)
+    return stdout, stderr, p.returncode
 
 
 def check_vsearch():
     """Check vsearch."""
-    stdout, stderr = run_subprocess("vsearch --quiet -h")
-    if stderr.find("vsearch: command not found") > -1:
+    try:
+        stdout, stderr, returncode = run_subprocess(
+            ["vsearch", "--quiet", "-h"])
+    except FileNotFoundError:
+        returncode = None
+    if returncode != 0:
         logging.error("Could not load find VSEARCH -- check installation")
         sys.exit(1)
 
 
-def write_adapters_fasta(args):
-    """Write adapters fasta."""
-    adapters = []
-    for adapter, seq in {
+def get_adapter_probes(args):
+    """Get adapter probes.
+
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Adapter sequences, in both orientations, keyed by name
+    :rtype: dict
+    """
+    return {
         "adapter1_f": args.adapter1_seq,
         "adapter1_r": args.adapter1_seq[::-1].translate(COMPLEMENT_TRANS),
         "adapter2_f": args.adapter2_seq,
         "adapter2_r": args.adapter2_seq[::-1].translate(COMPLEMENT_TRANS),
-    }.items():
+    }
+
+
+def write_adapters_fasta(args):
+    """Write adapters fasta."""
+    adapters = []
+    for adapter, seq in get_adapter_probes(args).items():
         entry = SeqRecord(Seq(seq), id=adapter, name="", description="")
 
         adapters.append(entry)
@@ -196,21 +329,327 @@ def call_vsearch(tmp_fastq, args):
 
     tmp_vsearch = tmp_fastq.replace(".fastq", ".vsearch.tsv")
 
-    vsearch_cmd = "vsearch --usearch_global {fasta} --db {adapters} \
-    --threads 1 --minseqlength 20 --maxaccepts 5 --id {id} --strand plus \
-    --wordlength 3 --minwordmatches 10 --output_no_hits --userfields \
-    'query+target+id+alnlen+mism+opens+qilo+qihi+qstrand+tilo+tihi+ql+tl' \
-    --userout {output}".format(
-        fasta=tmp_fasta,
-        id=args.min_adapter_id,
-        adapters=args.adapters_fasta,
-        output=tmp_vsearch,
-    )
-    stdout, stderr = run_subprocess(vsearch_cmd)
+    stdout, stderr, returncode = run_subprocess(
+        vsearch_command(tmp_fasta, tmp_vsearch, args))
+    if returncode != 0:
+        raise RuntimeError(
+            f"VSEARCH exited with status {returncode}: {stderr}")
     os.remove(tmp_fasta)
     return tmp_vsearch
 
 
+def vsearch_command(fasta, output, args):
+    """Build the VSEARCH adapter search command.
+
+    :param fasta: Query FASTA path, or "-" to read from stdin
+    :type fasta: str
+    :param output: Path for the --userout table, or "-" for stdout
+    :type output: str
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Command line as a list of arguments
+    :rtype: list
+    """
+    return [
+        "vsearch", "--usearch_global", fasta,
+        "--db", str(args.adapters_fasta),
+        "--threads", "1",
+        "--minseqlength", "20",
+        "--maxaccepts", "5",
+        "--id", str(args.min_adapter_id),
+        "--strand", "plus",
+        "--wordlength", "3",
+        "--minwordmatches", "10",
+        "--output_no_hits",
+        "--userfields",
+        "query+target+id+alnlen+mism+opens+qilo+qihi+qstrand+tilo+tihi+ql+tl",
+        "--userout", output,
+        "--quiet",
+    ]
+
+
+def call_vsearch_stream(records, args):
+    """Run VSEARCH on in-memory reads.
+
+    The reads are written to VSEARCH as FASTA over stdin and the
+    --userout table is read back from stdout, so no temporary files
+    are needed.
+
+    :param records: Batch of (name, sequence, quality) tuples
+    :type records: list
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: VSEARCH --userout table
+    :rtype: io.StringIO
+    """
+    fasta = "".join(f">{name}\n{seq}\n" for name, seq, _ in records)
+    p = subprocess.run(
+        vsearch_command("-", "-", args),
+        input=fasta, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if p.returncode != 0:
+        raise RuntimeError(
+            f"VSEARCH exited with status {p.returncode}: {p.stderr}")
+    return io.StringIO(p.stdout)
+
+
+# Settings mirroring the VSEARCH defaults and the options given in
+# vsearch_command(), for the native adapter search
+NATIVE_MATCH = 2
+NATIVE_MISMATCH = -4
+# VSEARCH charges 20 to open an interior gap plus 2 per gap position
+NATIVE_GAP_OPEN = 22
+NATIVE_GAP_EXTEND = 2
+NATIVE_MIN_SEQ_LENGTH = 20
+# Approximates --wordlength 3 --minwordmatches 10: at least 10 matching
+# 3-mers need 12 consecutive aligned adapter bases
+NATIVE_MIN_ALIGNED = 12
+NATIVE_MAX_ACCEPTS = 5
+
+CIGAR_RE = re.compile(rb"(\d+)([=XID])")
+
+
+class NativeAdapterSearch:
+    """In-process adapter finder producing VSEARCH --userout records.
+
+    Each adapter probe is aligned semi-globally (free end gaps) against
+    the read with the SIMD prefix-scan parasail aligner (faster than the
+    striped one for probes this short), using a profile that
+    is built once per probe. Terminal gaps are excluded when computing
+    identity and the aligned coordinates, as VSEARCH does.
+    """
+
+    def __init__(self, args):
+        """Build the scoring matrix and a profile for each probe.
+
+        :param args: object containing all supplied arguments
+        :type args: class argparse.Namespace
+        """
+        self.min_id = args.min_adapter_id
+        matrix = parasail.matrix_create(
+            "ACGTN", NATIVE_MATCH, NATIVE_MISMATCH)
+        self.probes = [
+            (name, len(seq), parasail.profile_create_16(seq, matrix))
+            for name, seq in get_adapter_probes(args).items()]
+
+    def align(self, seq, profile):
+        """Align a probe profile to a read.
+
+        :return: Number of matches, mismatches, gap opens and aligned
+            columns, plus 1-based query (read) and target (probe)
+            coordinates of the alignment without terminal gaps
+        :rtype: tuple
+        """
+        result = parasail.sg_trace_scan_profile_16(
+            profile, seq, NATIVE_GAP_OPEN, NATIVE_GAP_EXTEND)
+        cigar = result.cigar
+        ops = [(int(n), op) for n, op in CIGAR_RE.findall(cigar.decode)]
+        # Drop terminal gaps, tracking how far they move into either
+        # sequence
+        qpos = cigar.beg_ref
+        tpos = cigar.beg_query
+        while ops and ops[0][1] in b"ID":
+            n, op = ops.pop(0)
+            if op == b"D":
+                qpos += n
+            else:
+                tpos += n
+        while ops and ops[-1][1] in b"ID":
+            ops.pop()
+
+        matches = mism = opens = cols = qlen = tlen = 0
+        for n, op in ops:
+            cols += n
+            if op == b"=":
+                matches += n
+            elif op == b"X":
+                mism += n
+            else:
+                opens += 1
+            if op != b"I":
+                qlen += n
+            if op != b"D":
+                tlen += n
+        return (
+            matches, mism, opens, cols,
+            qpos + 1, qpos + qlen, tpos + 1, tpos + tlen)
+
+    def search(self, records):
+        """Search a batch of reads for the adapter probes.
+
+        :param records: Batch of (name, sequence, quality) tuples
+        :type records: list
+        :return: Records with VSEARCH_COLUMNS, including a "*" target row
+            for reads without hits
+        :rtype: class pandas.DataFrame
+        """
+        rows = []
+        for name, seq, _ in records:
+            ql = len(seq)
+            if ql < NATIVE_MIN_SEQ_LENGTH:
+                continue
+            hits = []
+            for target, tl, profile in self.probes:
+                matches, mism, opens, cols, qilo, qihi, tilo, tihi = \
+                    self.align(seq, profile)
+                if cols == 0 or tihi - tilo + 1 < NATIVE_MIN_ALIGNED:
+                    continue
+                identity = matches / cols
+                if identity >= self.min_id:
+                    hits.append((
+                        name, target, round(100 * identity, 1), cols, mism,
+                        opens, qilo, qihi, "+", tilo, tihi, ql, tl))
+            if hits:
+                hits.sort(key=lambda hit: hit[2], reverse=True)
+                rows.extend(hits[:NATIVE_MAX_ACCEPTS])
+            else:
+                rows.append(
+                    (name, "*", 0.0, 0, 0, 0, 0, 0, "*", 0, 0, ql, 0))
+        return pd.DataFrame.from_records(rows, columns=VSEARCH_COLUMNS)
+
+
+_native_search = None
+
+
+def call_native_search(records, args):
+    """Search reads with a per-process NativeAdapterSearch.
+
+    parasail profiles cannot be pickled, so the searcher is built on
+    first use in each worker process.
+    """
+    global _native_search
+    if _native_search is None:
+        _native_search = NativeAdapterSearch(args)
+    return _native_search.search(records)
+
+
+class VsearchWorker:
+    """Long-lived VSEARCH process fed with batches of reads over pipes.
+
+    Reads are written to VSEARCH's stdin as FASTA by a feeder thread and
+    the --userout table is consumed from its stdout by a reader thread.
+    Queries are labelled with a running index rather than the read name,
+    so that the reader can tell where each batch ends in the output (with
+    --threads 1 VSEARCH reports queries in input order and, thanks to
+    --output_no_hits, at least once each). As VSEARCH buffers its input
+    and output, a batch is only known to be complete once output for the
+    next batch arrives or the process exits.
+    """
+
+    def __init__(self, args, results):
+        """Start the VSEARCH process and its feeder/reader threads.
+
+        :param args: object containing all supplied arguments
+        :type args: class argparse.Namespace
+        :param results: Queue receiving (batch_id, records, first_label,
+            userout_text) for each searched batch, an exception if VSEARCH
+            fails and finally None once the process has exited
+        :type results: class queue.Queue
+        """
+        self.stderr = tempfile.TemporaryFile(dir=args.tempdir)
+        self.proc = subprocess.Popen(
+            vsearch_command("-", "-", args),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=self.stderr, universal_newlines=True)
+        self.batches = queue.Queue(maxsize=1)
+        self.pending = collections.deque()
+        self.results = results
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.feeder.start()
+        self.reader.start()
+
+    def submit(self, batch_id, records):
+        """Queue a batch of (name, sequence, quality) records for search."""
+        self.batches.put((batch_id, records))
+
+    def close(self):
+        """Signal that no more batches will be submitted."""
+        self.batches.put(None)
+
+    def _feed(self):
+        label = 0
+        try:
+            while True:
+                item = self.batches.get()
+                if item is None:
+                    break
+                batch_id, records = item
+                self.pending.append(
+                    (batch_id, records, label, label + len(records)))
+                self.proc.stdin.write("".join(
+                    f">{label + i}\n{seq}\n"
+                    for i, (_, seq, _) in enumerate(records)))
+                label += len(records)
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            # VSEARCH has died; this is reported from its exit status
+            pass
+
+    def _emit(self, lines):
+        batch_id, records, first_label, _ = self.pending.popleft()
+        self.results.put((batch_id, records, first_label, "".join(lines)))
+
+    def _read(self):
+        lines = []
+        for line in self.proc.stdout:
+            label = int(line[:line.index("\t")])
+            while label >= self.pending[0][3]:
+                self._emit(lines)
+                lines = []
+            lines.append(line)
+        returncode = self.proc.wait()
+        if returncode != 0:
+            self.stderr.seek(0)
+            stderr = self.stderr.read().decode()
+            self.results.put(RuntimeError(
+                f"VSEARCH exited with status {returncode}: {stderr}"))
+        else:
+            while self.pending:
+                self._emit(lines)
+                lines = []
+        self.stderr.close()
+        self.results.put(None)
+
+
+def search_batches_persistent(batches, args):
+    """Search batches of reads with persistent VSEARCH processes.
+
+    :param batches: Iterable of (batch_id, records) tuples
+    :type batches: iterable
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: generator of (batch_id, records, first_label, userout_text)
+        tuples, in order of completion
+    :rtype: generator
+    """
+    # Reader threads block once a window of results is waiting, so that a
+    # slow consumer stalls VSEARCH instead of batches piling up in memory
+    results = queue.Queue(maxsize=args.max_batches_in_flight)
+    workers = [VsearchWorker(args, results) for _ in range(args.threads)]
+
+    def dispatch():
+        try:
+            for i, (batch_id, records) in enumerate(batches):
+                workers[i % len(workers)].submit(batch_id, records)
+        except Exception as e:
+            results.put(e)
+        finally:
+            for worker in workers:
+                worker.close()
+
+    threading.Thread(target=dispatch, daemon=True).start()
+    n_exited = 0
+    while n_exited < len(workers):
+        item = results.get()
+        if item is None:
+            n_exited += 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield item
+
+
 def get_valid_adapter_pair_positions_in_read(read):
     """Get valid adapter positions."""
     valid_pairs_n = 0
@@ -287,26 +726,45 @@ def add_entry_to_read_info(
     return read_info
 
 
-def parse_vsearch(tmp_vsearch, args):
-    """Parse vsearch."""
-    colnames = [
-        "query",
-        "target",
-        "id",
-        "alnlen",
-        "mism",
-        "opens",
-        "qilo",
-        "qihi",
-        "qstrand",
-        "tilo",
-        "tihi",
-        "ql",
-        "tl",
-    ]
+VSEARCH_COLUMNS = [
+    "query",
+    "target",
+    "id",
+    "alnlen",
+    "mism",
+    "opens",
+    "qilo",
+    "qihi",
+    "qstrand",
+    "tilo",
+    "tihi",
+    "ql",
+    "tl",
+]
+
+
+def load_vsearch_table(tmp_vsearch):
+    """Load a VSEARCH --userout table.
+
+    :param tmp_vsearch: Path or buffer of the table
+    :return: Records with VSEARCH_COLUMNS
+    :rtype: class pandas.DataFrame
+    """
+    return pd.read_csv(
+        tmp_vsearch, sep="\t", header=None, names=VSEARCH_COLUMNS)
+
 
-    df = pd.read_csv(tmp_vsearch, sep="\t", header=None, names=colnames)
+def parse_vsearch_table(df, args):
+    """Parse vsearch table.
 
+    :param df: VSEARCH --userout records with VSEARCH_COLUMNS
+    :type df: class pandas.DataFrame
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Subread information keyed by original read ID, and the
+        VSEARCH column names
+    :rtype: dict, list
+    """
     read_info = {}
     for read_id, read in df.groupby("query"):
         # Sort aligned adapters by their position in the read
@@ -430,7 +888,7 @@ def parse_vsearch(tmp_vsearch, args):
                 adapter_config,
                 lab,
             )
-    return read_info, colnames
+    return read_info, VSEARCH_COLUMNS
 
 
 def revcomp_adapter_config(adapters_string):
@@ -446,42 +904,372 @@ def revcomp_adapter_config(adapters_string):
     return rc_string
 
 
-def write_stranded_fastq(tmp_fastq, read_info, args):
-    """Write stranded fastq."""
-    tmp_stranded_fastq = tmp_fastq.replace(".fastq", ".stranded.fastq.gz")
+READ_INFO_COLUMNS = [
+    "readlen",
+    "start",
+    "end",
+    "fl",
+    "stranded",
+    "orig_strand",
+    "orig_adapter_config",
+    "adapter_config",
+    "lab",
+    "read_id",
+]
+
+# Adapter targets encoded as small ints; codes are 1-based so that
+# configs can be packed into integers as base-6 digits
+TARGETS = ["adapter1_f", "adapter1_r", "adapter2_f", "adapter2_r", "*"]
+TARGET_CODES = {target: code for code, target in enumerate(TARGETS, 1)}
+CONFIG_BASE = len(TARGETS) + 1
+
+
+def decode_adapter_config(code):
+    """Decode an adapter config packed by parse_vsearch_columnar.
+
+    :param code: Target codes packed as base-6 digits, first target least
+        significant
+    :type code: int
+    :return: Adapter config, e.g. "adapter1_f-adapter2_f"
+    :rtype: str
+    """
+    targets = []
+    while code:
+        code, digit = divmod(code, CONFIG_BASE)
+        targets.append(TARGETS[digit - 1])
+    return "-".join(targets)
+
+
+def label_adapter_config(config):
+    """Label the adapter config of a read without a valid adapter pair."""
+    if config in ["adapter2_r-adapter2_f", "adapter2_f-adapter2_r"]:
+        return "double_adapter2"
+    elif config in ["adapter1_r-adapter1_f", "adapter1_f-adapter1_r"]:
+        return "double_adapter1"
+    elif config in ["adapter2_f", "adapter2_r"]:
+        return "single_adapter2"
+    elif config in ["adapter1_f", "adapter1_r"]:
+        return "single_adapter1"
+    elif config == "*":
+        return "no_adapters"
+    return "other"
+
+
+def run_starts(values):
+    """Return the indices at which runs of equal values start.
+
+    :param values: 1D array
+    :type values: np.array
+    :return: Index of the first element of each run
+    :rtype: np.array
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=int)
+    return np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+
+
+def rank_in_runs(starts, n):
+    """Return the position of each element within its run.
 
+    :param starts: Run starts, from run_starts
+    :type starts: np.array
+    :param n: Total number of elements
+    :type n: int
+    :return: 0-based position of each element within its run
+    :rtype: np.array
+    """
+    return np.arange(n) - np.repeat(starts, np.diff(np.r_[starts, n]))
+
+
+def parse_vsearch_columnar(df, args):
+    """Parse vsearch table with array operations.
+
+    Columnar equivalent of parse_vsearch_table: hits are sorted once by
+    read and position, valid adjacent adapter pairs are found by comparing
+    each hit with the next one, and reads without pairs are labelled per
+    distinct adapter config rather than per read. Subreads come out in the
+    same order, with the same values, as from parse_vsearch_table
+    followed by write_stranded_records, so adapter_config is already
+    reverse complemented for "-" strand subreads.
+
+    :param df: VSEARCH --userout records with VSEARCH_COLUMNS
+    :type df: class pandas.DataFrame
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Subread table as arrays keyed by READ_INFO_COLUMNS, plus
+        "orig_read_id"
+    :rtype: dict
+    """
+    # Sort once by read (in groupby order) then by position in the read
+    read_codes, read_names = pd.factorize(df["query"], sort=True)
+    qilo = df["qilo"].to_numpy()
+    order = np.lexsort((qilo, read_codes))
+    read_codes = read_codes[order]
+    qilo = qilo[order]
+    qihi = df["qihi"].to_numpy()[order]
+    ql = df["ql"].to_numpy()[order]
+    targets = df["target"].map(TARGET_CODES).to_numpy()[order]
+
+    n_reads = len(read_names)
+    read_start = run_starts(read_codes)
+    pos_in_read = rank_in_runs(read_start, len(read_codes))
+
+    # Pack each read's ordered targets into one integer (VSEARCH reports
+    # at most --maxaccepts 5 hits per read, well within int64)
+    config_codes = np.zeros(n_reads, dtype=np.int64)
+    np.add.at(
+        config_codes, read_codes,
+        targets.astype(np.int64) * CONFIG_BASE ** pos_in_read)
+    unique_codes, config_idx = np.unique(config_codes, return_inverse=True)
+    unique_configs = np.array(
+        [decode_adapter_config(code) for code in unique_codes.tolist()],
+        dtype=object)
+    orig_configs = unique_configs[config_idx]
+
+    # Valid pairs: adapter1_f followed by adapter2_f, or adapter2_r
+    # followed by adapter1_r, within the same read
+    first = targets[:-1]
+    second = targets[1:]
+    is_plus = (first == TARGET_CODES["adapter1_f"]) & \
+        (second == TARGET_CODES["adapter2_f"])
+    is_minus = (first == TARGET_CODES["adapter2_r"]) & \
+        (second == TARGET_CODES["adapter1_r"])
+    pair_idx = np.flatnonzero(
+        (is_plus | is_minus) & (read_codes[:-1] == read_codes[1:]))
+    # Number pairs per read: all adapter1_f pairs, then all adapter2_r
+    # pairs, each by position
+    pair_minus = is_minus[pair_idx]
+    pair_idx = pair_idx[np.lexsort(
+        (pair_idx, pair_minus, read_codes[pair_idx]))]
+    pair_minus = is_minus[pair_idx]
+    pair_reads = read_codes[pair_idx]
+    pair_n = rank_in_runs(run_starts(pair_reads), len(pair_idx))
+    pair_start = qilo[pair_idx]
+    pair_end = qihi[pair_idx + 1]
+    pair_configs = np.where(
+        pair_minus, "adapter2_r-adapter1_r", "adapter1_f-adapter2_f"
+    ).astype(object)
+
+    # Reads without pairs get a single subread covering the whole read,
+    # trimmed at the adapter end if only a single adapter was found
+    has_pair = np.zeros(n_reads, dtype=bool)
+    has_pair[pair_reads] = True
+    single_reads = np.flatnonzero(~has_pair)
+    single_configs = orig_configs[single_reads]
+    unique_labels = np.array(
+        [label_adapter_config(c) for c in unique_configs], dtype=object)
+    single_labs = unique_labels[config_idx[single_reads]]
+    first_hit = read_start[single_reads]
+    single_ql = ql[first_hit]
+    single_start = np.zeros(len(single_reads), dtype=ql.dtype)
+    single_end = single_ql - 1
+    single_readlen = single_ql.copy()
+    single_strand = np.full(len(single_reads), "*", dtype=object)
+    single_stranded = np.zeros(len(single_reads), dtype=bool)
+    if not args.only_strand_full_length:
+        for config, strand, start, end in [
+                ("adapter2_f", "+", None, qihi),
+                ("adapter2_r", "-", qilo, None),
+                ("adapter1_f", "+", qilo, None),
+                ("adapter1_r", "-", None, qihi)]:
+            sel = single_configs == config
+            single_strand[sel] = strand
+            single_stranded[sel] = True
+            if start is not None:
+                single_start[sel] = start[first_hit[sel]]
+            if end is not None:
+                single_end[sel] = end[first_hit[sel]]
+            single_readlen[sel] = single_end[sel] - single_start[sel]
+
+    # Combine pairs and singles into the subread table in read order
+    sub_reads = np.r_[pair_reads, single_reads]
+    sub_n = np.r_[pair_n, np.zeros(len(single_reads), dtype=int)]
+    order = np.lexsort((sub_n, sub_reads))
+    sub_reads = sub_reads[order]
+    n_pairs = len(pair_idx)
+    n_single = len(single_reads)
+    orig_read_ids = np.asarray(read_names, dtype=object)[sub_reads]
+    strand = np.r_[
+        np.where(pair_minus, "-", "+").astype(object), single_strand
+    ][order]
+    adapter_config = np.r_[pair_configs, single_configs][order]
+    minus = strand == "-"
+    adapter_config[minus] = [
+        revcomp_adapter_config(c) for c in adapter_config[minus]]
+    return {
+        "orig_read_id": orig_read_ids,
+        "readlen": np.r_[pair_end - pair_start, single_readlen][order],
+        "start": np.r_[pair_start, single_start][order],
+        "end": np.r_[pair_end, single_end][order],
+        "fl": np.r_[
+            np.ones(n_pairs, dtype=bool), np.zeros(n_single, dtype=bool)
+        ][order],
+        "stranded": np.r_[
+            np.ones(n_pairs, dtype=bool), single_stranded][order],
+        "orig_strand": strand,
+        "orig_adapter_config": orig_configs[sub_reads],
+        "adapter_config": adapter_config,
+        "lab": np.r_[
+            np.full(n_pairs, "full_len", dtype=object), single_labs
+        ][order],
+        "read_id": np.array([
+            f"{read_id}_{n}"
+            for read_id, n in zip(orig_read_ids, sub_n[order].tolist())],
+            dtype=object),
+    }
+
+
+def write_stranded_records_columnar(records, subreads, f_out):
+    """Write stranded records from a columnar subread table.
+
+    :param records: Iterable of (name, sequence, quality) tuples
+    :type records: iterable
+    :param subreads: Subread table from parse_vsearch_columnar
+    :type subreads: dict
+    :param f_out: Binary file object to write FASTQ entries to
+    :type f_out: class ParallelGzipWriter
+    """
+    # Subreads of each read are contiguous; map read to its row range
+    names = subreads["orig_read_id"]
+    first = run_starts(names)
+    last = np.r_[first[1:], len(names)]
+    spans = dict(zip(
+        names[first].tolist(), zip(first.tolist(), last.tolist())))
+
+    # Subreads are sliced and reverse complemented as bytes, then joined
+    # with their header into a single write; this makes fewer copies than
+    # formatting str subreads and encoding the result
+    headers = [f"@{read_id}\n".encode() for read_id in subreads["read_id"]]
+    starts = subreads["start"].tolist()
+    ends = subreads["end"].tolist()
+    minus = (subreads["orig_strand"] == "-").tolist()
+    for name, sequence, quality in records:
+        span = spans.get(name.split(" ")[0])
+        if span is None:
+            # No adapter search results for this read
+            continue
+        sequence = sequence.encode()
+        quality = quality.encode()
+        for i in range(*span):
+            start = starts[i]
+            end = ends[i]
+            if minus[i]:
+                subread_seq = sequence[start:end].translate(
+                    COMPLEMENT_BYTES_TRANS)[::-1]
+                f_out.write(b"".join((
+                    headers[i], subread_seq, b"\n+\n",
+                    quality[start:end][::-1], b"\n")))
+            else:
+                f_out.write(b"".join((
+                    headers[i], sequence[start:end], b"\n+\n",
+                    quality[start:end], b"\n")))
+
+
+def write_stranded_records(records, read_info, f_out):
+    """Write stranded records.
+
+    :param records: Iterable of (name, sequence, quality) tuples
+    :type records: iterable
+    :param read_info: Subread information keyed by original read ID
+    :type read_info: dict
+    :param f_out: Binary file object to write FASTQ entries to
+    :type f_out: class ParallelGzipWriter
+    """
     # Iterate through FASTQ reads and re-write them with proper stranding based
     # the results of the VSEARCH alignments.
-    with pysam.FastxFile(tmp_fastq) as f_in:
-        # with open(tmp_stranded_fastq, "w") as f_out:
-        with gzip.open(tmp_stranded_fastq, "wb") as f_out:
-            for entry in f_in:
-                read_id = entry.name.split(" ")[0]
-                if read_info.get(read_id):
-                    # This read had some VSEARCH hits for adapter sequences
-                    for subread_id in read_info[read_id].keys():
-                        d = read_info[read_id][subread_id]
-                        # subread_info = read_info[read_id][subread_id]
-                        subread_seq = str(entry.sequence[d["start"]: d["end"]])
-                        subread_quals = entry.quality[d["start"]: d["end"]]
-                        if d["orig_strand"] == "-":
-                            rc_config = revcomp_adapter_config(
-                                d["adapter_config"])
-                            d["adapter_config"] = rc_config
-                            subread_seq = subread_seq[::-1].translate(
-                                COMPLEMENT_TRANS)
-                            subread_quals = subread_quals[::-1]
-                        f_out.write(f"@{subread_id}\n".encode())
-                        f_out.write(f"{subread_seq}\n".encode())
-                        f_out.write(b"+\n")
-                        f_out.write(f"{subread_quals}\n".encode())
-                else:
-                    # This read had no VSEARCH hits for adapter sequences,
-                    # so we should omit this read
-                    # from the stranded FASTQ output
-                    pass
+    for name, sequence, quality in records:
+        read_id = name.split(" ")[0]
+        if read_info.get(read_id):
+            # This read had some VSEARCH hits for adapter sequences
+            for subread_id in read_info[read_id].keys():
+                d = read_info[read_id][subread_id]
+                subread_seq = str(sequence[d["start"]: d["end"]])
+                subread_quals = quality[d["start"]: d["end"]]
+                if d["orig_strand"] == "-":
+                    rc_config = revcomp_adapter_config(
+                        d["adapter_config"])
+                    d["adapter_config"] = rc_config
+                    subread_seq = subread_seq[::-1].translate(
+                        COMPLEMENT_TRANS)
+                    subread_quals = subread_quals[::-1]
+                f_out.write(
+                    f"@{subread_id}\n{subread_seq}\n+\n"
+                    f"{subread_quals}\n".encode())
+        else:
+            # This read had no VSEARCH hits for adapter sequences,
+            # so we should omit this read
+            # from the stranded FASTQ output
+            pass
 
-    return tmp_stranded_fastq
+
+class ParallelGzipWriter:
+    """Multi-member gzip writer compressing blocks on a thread pool.
+
+    Writes are collected into blocks of about <block_size> bytes, each of
+    which is compressed into an independent gzip member. zlib releases
+    the GIL while compressing, so blocks are compressed in parallel by
+    <threads> threads; members are written to the file in order. The
+    concatenated members form a valid gzip file.
+    """
+
+    def __init__(self, path, level=1, threads=1, block_size=4 * 1024 ** 2):
+        """Open <path> for writing.
+
+        :param path: Output file path
+        :type path: str
+        :param level: gzip compression level
+        :type level: int
+        :param threads: Number of compression threads
+        :type threads: int
+        :param block_size: Uncompressed size of each gzip member
+        :type block_size: int
+        """
+        self.f = open(path, "wb")
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+
+    def __enter__(self):
+        """Enter context."""
+        return self
+
+    def __exit__(self, *exc):
+        """Exit context."""
+        self.close()
+
+    def _compress(self, block):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def _flush_block(self):
+        block = bytes(self.buffer)
+        self.buffer.clear()
+        if self.pool is None:
+            self.f.write(self._compress(block))
+            return
+        self.pending.append(self.pool.submit(self._compress, block))
+        # Bound the memory held by blocks waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self.f.write(self.pending.popleft().result())
+
+    def write(self, data):
+        """Write bytes."""
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self._flush_block()
+
+    def close(self):
+        """Compress remaining data and close the file."""
+        if self.buffer:
+            self._flush_block()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.f.close()
 
 
 def open_fastq(fastq):
@@ -500,7 +1288,7 @@ def count_reads(fastq):
         for line in tqdm(f, unit_scale=0.25, unit=" reads"):
             number_lines += 1
     f.close()
-    return number_lines / 4
+    return number_lines // 4
 
 
 def batch_iterator(iterator, args):
@@ -531,6 +1319,55 @@ def batch_iterator(iterator, args):
             yield batch, args
 
 
+def stream_fastq_batches(args, max_queued=2):
+    """Stream batches of reads from the input FASTQ.
+
+    A single reader thread decompresses and parses the input, handing
+    batches of at most <args.batch_size> reads over a bounded queue so
+    that reading overlaps with batch processing without holding the
+    whole file in memory.
+
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :param max_queued: Maximum number of batches waiting to be consumed
+    :type max_queued: int
+    :return: generator of (batch_id, records), records being lists of
+        (name, sequence, quality) tuples
+    :rtype: generator
+    """
+    batches = queue.Queue(maxsize=max_queued)
+    done = object()
+
+    def reader():
+        try:
+            batch_id = 1
+            batch = []
+            with pysam.FastxFile(str(args.fastq)) as f_in:
+                for entry in f_in:
+                    batch.append((entry.name, entry.sequence, entry.quality))
+                    if len(batch) == args.batch_size:
+                        batches.put((batch_id, batch))
+                        batch_id += 1
+                        batch = []
+            if batch:
+                batches.put((batch_id, batch))
+        except Exception as e:
+            batches.put(e)
+        finally:
+            batches.put(done)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    while True:
+        item = batches.get()
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+    thread.join()
+
+
 def get_subread_info(read_info):
     """Get subread info."""
     subread_info = []
@@ -541,26 +1378,306 @@ def get_subread_info(read_info):
     return subread_info
 
 
-def write_tmp_table(tmp_fastq, subread_info):
-    """Write temp table."""
-    df = pd.DataFrame.from_records(subread_info)
-    tmp_table = tmp_fastq.replace(".fastq.gz", ".info.tsv")
-    df.to_csv(tmp_table, sep="\t", index=False)
+# Columns of the read configuration table stored as dictionary encoded
+# (categorical) columns in Parquet output
+READ_INFO_CATEGORICAL = ["orig_strand", "adapter_config", "lab"]
+
+
+def read_info_schema():
+    """Arrow schema of the read configuration table.
+
+    Categorical columns use a fixed dictionary index type so that tables of
+    different batches can be written to a single Parquet file.
+
+    :return: Schema with READ_INFO_COLUMNS
+    :rtype: class pyarrow.Schema
+    """
+    import pyarrow as pa
+
+    categorical = pa.dictionary(pa.int32(), pa.string())
+    types = {
+        "readlen": pa.int64(),
+        "start": pa.int64(),
+        "end": pa.int64(),
+        "fl": pa.bool_(),
+        "stranded": pa.bool_(),
+        "orig_adapter_config": pa.string(),
+        "read_id": pa.string(),
+    }
+    return pa.schema([
+        (col, categorical if col in READ_INFO_CATEGORICAL else types[col])
+        for col in READ_INFO_COLUMNS])
+
+
+def write_parquet_table(table, path):
+    """Write a read configuration table in Parquet format.
+
+    :param table: Read configuration table with READ_INFO_COLUMNS
+    :type table: class pandas.DataFrame
+    :param path: Output Parquet file
+    :type path: str
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = read_info_schema()
+    arrays = []
+    for field in schema:
+        if field.name in READ_INFO_CATEGORICAL:
+            arrays.append(pa.array(
+                table[field.name], type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(table[field.name], type=field.type))
+    pq.write_table(pa.Table.from_arrays(arrays, schema=schema), path)
+
+
+class ReadConfigStats:
+    """Summary statistics of read configurations.
+
+    Statistics are kept as counts and sums so that those of separate batches
+    (or separate runs on chunks of a sample) can be merged without going
+    back to the read configuration tables.
+    """
+
+    def __init__(self):
+        """Initialise empty statistics."""
+        self.n_reads = 0
+        self.readlen_sum = 0
+        self.readlen_sum_sq = 0
+        self.n_fl = 0
+        self.n_stranded = 0
+        self.n_plus = 0
+        self.n_minus = 0
+        self.detailed_config = collections.Counter()
+        self.summary_config = collections.Counter()
+
+    @classmethod
+    def from_table(cls, table):
+        """Compute statistics of a read configuration table.
+
+        :param table: Read configuration table with READ_INFO_COLUMNS
+        :type table: class pandas.DataFrame
+        :return: Statistics of the table
+        :rtype: class ReadConfigStats
+        """
+        stats = cls()
+        readlen = table["readlen"].to_numpy(dtype=np.int64)
+        stats.n_reads = len(table)
+        stats.readlen_sum = int(readlen.sum())
+        stats.readlen_sum_sq = int((readlen * readlen).sum())
+        stats.n_fl = int(table["fl"].sum())
+        stats.n_stranded = int(table["stranded"].sum())
+        stats.n_plus = int((table["orig_strand"] == "+").sum())
+        stats.n_minus = int((table["orig_strand"] == "-").sum())
+        stats.detailed_config.update({
+            k: int(v) for k, v in
+            table["orig_adapter_config"].value_counts().items()})
+        stats.summary_config.update({
+            k: int(v) for k, v in table["lab"].value_counts().items()})
+        return stats
+
+    def update(self, other):
+        """Add the statistics of another set of reads.
+
+        :param other: Statistics to merge into these
+        :type other: class ReadConfigStats
+        """
+        self.n_reads += other.n_reads
+        self.readlen_sum += other.readlen_sum
+        self.readlen_sum_sq += other.readlen_sum_sq
+        self.n_fl += other.n_fl
+        self.n_stranded += other.n_stranded
+        self.n_plus += other.n_plus
+        self.n_minus += other.n_minus
+        self.detailed_config.update(other.detailed_config)
+        self.summary_config.update(other.summary_config)
+
+    def write_json(self, path):
+        """Write the statistics to a JSON file.
+
+        :param path: Output JSON file
+        :type path: str
+        """
+        stats = dict(vars(self))
+        stats["detailed_config"] = dict(
+            self.detailed_config.most_common())
+        stats["summary_config"] = dict(self.summary_config.most_common())
+        with open(path, "w") as f:
+            json.dump(stats, f, indent=4)
+
+
+def write_tmp_table(tmp_fastq, table, args):
+    """Write temp table.
+
+    :param tmp_fastq: Path of the batch stranded FASTQ the table belongs to
+    :type tmp_fastq: str
+    :param table: Read configuration table with READ_INFO_COLUMNS
+    :type table: class pandas.DataFrame
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Path of the temp table
+    :rtype: str
+    """
+    if args.output_parquet:
+        tmp_table = tmp_fastq.replace(".fastq.gz", ".info.parquet")
+        write_parquet_table(table, tmp_table)
+    else:
+        tmp_table = tmp_fastq.replace(".fastq.gz", ".info.tsv")
+        table.to_csv(tmp_table, sep="\t", index=False)
     return tmp_table
 
 
+def write_batch_outputs(
+        records, df, stranded_tmp_fastq, args, profiler, n_reads):
+    """Parse the adapter hits of a batch and write its outputs.
+
+    :param records: Iterable of (name, sequence, quality) tuples
+    :type records: iterable
+    :param df: VSEARCH --userout records with VSEARCH_COLUMNS
+    :type df: class pandas.DataFrame
+    :param stranded_tmp_fastq: Path of the gzipped stranded FASTQ to write
+    :type stranded_tmp_fastq: str
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :param profiler: Profiler timing the stages of the batch
+    :type profiler: class profiling.Profiler
+    :param n_reads: Number of reads in the batch
+    :type n_reads: int
+    :return: Path of the subread table and its summary statistics
+    :rtype: str, class ReadConfigStats
+    """
+    f_out = ParallelGzipWriter(
+        stranded_tmp_fastq, args.compression_level, args.compress_threads)
+    if args.parser == "columnar":
+        with profiler.stage("parse_vsearch", reads=n_reads):
+            subreads = parse_vsearch_columnar(df, args)
+        with profiler.stage("write_stranded_fastq", reads=n_reads), f_out:
+            write_stranded_records_columnar(records, subreads, f_out)
+        table = pd.DataFrame(subreads, columns=READ_INFO_COLUMNS)
+    else:
+        with profiler.stage("parse_vsearch", reads=n_reads):
+            read_info, _ = parse_vsearch_table(df, args)
+        with profiler.stage("write_stranded_fastq", reads=n_reads), f_out:
+            write_stranded_records(records, read_info, f_out)
+        table = pd.DataFrame.from_records(get_subread_info(read_info))
+
+    with profiler.stage("write_table", reads=n_reads):
+        stats = ReadConfigStats.from_table(table)
+        tmp_table = write_tmp_table(stranded_tmp_fastq, table, args)
+    return tmp_table, stats
+
+
 def process_batch(tup):
     """Process batch."""
     tmp_fastq = tup[0]
     args = tup[1]
 
-    tmp_vsearch = call_vsearch(tmp_fastq, args)
-    read_info, vsearch_cols = parse_vsearch(tmp_vsearch, args)
-    stranded_tmp_fastq = write_stranded_fastq(tmp_fastq, read_info, args)
-    subread_info = get_subread_info(read_info)
-    tmp_table = write_tmp_table(stranded_tmp_fastq, subread_info)
+    profiler = Profiler()
+    with profiler.stage("call_vsearch") as stage:
+        tmp_vsearch = call_vsearch(tmp_fastq, args)
+        df = load_vsearch_table(tmp_vsearch)
+        n_reads = df["query"].nunique()
+        stage.add_reads(n_reads)
+    os.remove(tmp_vsearch)
+    stranded_tmp_fastq = tmp_fastq.replace(".fastq", ".stranded.fastq.gz")
+    with pysam.FastxFile(tmp_fastq) as f_in:
+        records = (
+            (entry.name, entry.sequence, entry.quality) for entry in f_in)
+        tmp_table, stats = write_batch_outputs(
+            records, df, stranded_tmp_fastq, args, profiler, n_reads)
+    os.remove(tmp_fastq)
+
+    return stranded_tmp_fastq, tmp_table, stats, profiler.stages
+
+
+def process_batch_records(tup):
+    """Process an in-memory batch of reads.
+
+    Used in --streaming mode; unlike process_batch no temporary FASTQ or
+    FASTA files are read or written for the batch.
+    """
+    batch_id, records, args = tup
+
+    profiler = Profiler()
+    if args.engine == "native":
+        with profiler.stage("native_search", reads=len(records)):
+            df = call_native_search(records, args)
+    else:
+        with profiler.stage("call_vsearch", reads=len(records)):
+            df = load_vsearch_table(call_vsearch_stream(records, args))
+    stranded_tmp_fastq = os.path.join(
+        args.tempdir, f"tmp.chunk.{batch_id}.stranded.fastq.gz")
+    tmp_table, stats = write_batch_outputs(
+        records, df, stranded_tmp_fastq, args, profiler, len(records))
+
+    return stranded_tmp_fastq, tmp_table, stats, profiler.stages
 
-    return stranded_tmp_fastq, tmp_table, vsearch_cols
+
+def process_batch_hits(tup):
+    """Process a batch of reads searched by a persistent VSEARCH worker.
+
+    Query labels in the VSEARCH output are indices into the batch and are
+    mapped back to read names before parsing.
+    """
+    batch_id, records, first_label, hits, args = tup
+
+    profiler = Profiler()
+    with profiler.stage("load_vsearch_hits", reads=len(records)):
+        df = load_vsearch_table(io.StringIO(hits))
+        names = np.array([name for name, _, _ in records], dtype=object)
+        df["query"] = names[df["query"].to_numpy() - first_label]
+    stranded_tmp_fastq = os.path.join(
+        args.tempdir, f"tmp.chunk.{batch_id}.stranded.fastq.gz")
+    tmp_table, stats = write_batch_outputs(
+        records, df, stranded_tmp_fastq, args, profiler, len(records))
+
+    return stranded_tmp_fastq, tmp_table, stats, profiler.stages
+
+
+def imap_bounded(pool, func, iterable, max_in_flight):
+    """Ordered equivalent of pool.imap with a bounded number of tasks.
+
+    Unlike pool.imap, which submits tasks as fast as it can consume
+    <iterable>, a task is only submitted once fewer than <max_in_flight>
+    earlier results are still to be consumed. Each result is consumed
+    before the next task is submitted, so the caller can clean up after a
+    result to bound the resources held by outstanding tasks.
+
+    :param pool: Pool of worker processes
+    :type pool: class multiprocessing.pool.Pool
+    :param func: Function to apply to each item
+    :type func: function
+    :param iterable: Items to process
+    :type iterable: iterable
+    :param max_in_flight: Maximum number of submitted, unconsumed tasks
+    :type max_in_flight: int
+    :return: generator of results, in the order of <iterable>
+    :rtype: generator
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def in_batch_order(items):
+    """Reorder (batch_id, ...) tuples by batch_id.
+
+    :param items: Tuples with consecutive batch IDs from 1, in any order
+    :type items: iterable
+    :return: generator of the tuples in batch ID order
+    :rtype: generator
+    """
+    waiting = {}
+    next_batch_id = 1
+    for item in items:
+        waiting[item[0]] = item
+        while next_batch_id in waiting:
+            yield waiting.pop(next_batch_id)
+            next_batch_id += 1
 
 
 def init_logger(args):
@@ -573,100 +1690,183 @@ def init_logger(args):
     logging.root.handlers[0].addFilter(lambda x: "NumExpr" not in x.msg)
 
 
-def write_output_table(tmp_tables, args):
-    """Write output table."""
-    if len(tmp_tables) > 1:
-        pd.concat(
-            [pd.read_csv(
-                d, sep="\t") for d in tmp_tables], axis=0).to_csv(
-                    args.output_tsv, sep="\t", index=False)
-    else:
-        shutil.copy(tmp_tables[0], args.output_tsv)
+def merge_batch_outputs(results, args, profiler):
+    """Append batch outputs to the output files as they complete.
 
+    Temp TSV tables are concatenated as text, keeping the header of the
+    first one; temp Parquet tables are appended as row groups of a single
+    Parquet file. The temp files of a batch are deleted once merged.
 
-def write_output_fastq(tmp_fastqs, args):
-    """Write output fastq."""
-    with open(args.output_fastq, "wb") as f_out:
-        for tmp_fastq in tmp_fastqs:
-            with open(tmp_fastq, "rb") as f_:
-                shutil.copyfileobj(f_, f_out)
-
-    shutil.rmtree(args.tempdir, ignore_errors=True)
-
+    :param results: (tmp_fastq, tmp_table, stats, stages) tuples, in batch
+        order, stages being the Profiler.stages of the batch worker
+    :type results: iterable
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :param profiler: Profiler timing the merge and receiving worker stages
+    :type profiler: class profiling.Profiler
+    :return: Summary statistics of all batches
+    :rtype: class ReadConfigStats
+    """
+    stats = ReadConfigStats()
+    if args.output_parquet:
+        import pyarrow.parquet as pq
 
-def write_tmp_fastx_files_for_processing(n_batches, args):
-    """Write tmp fastx."""
+        table_out = pq.ParquetWriter(
+            args.output_parquet, read_info_schema())
+    else:
+        table_out = open(args.output_tsv, "wb")
+
+    with open(args.output_fastq, "wb") as fastq_out, table_out:
+        for i, (tmp_fastq, tmp_table, batch_stats, stages) in enumerate(
+                results):
+            with profiler.stage("merge_outputs"):
+                with open(tmp_fastq, "rb") as f_:
+                    shutil.copyfileobj(f_, fastq_out)
+                if args.output_parquet:
+                    table_out.write_table(pq.read_table(tmp_table))
+                else:
+                    with open(tmp_table, "rb") as f_:
+                        if i > 0:
+                            f_.readline()
+                        shutil.copyfileobj(f_, table_out)
+                os.remove(tmp_fastq)
+                os.remove(tmp_table)
+            stats.update(batch_stats)
+            profiler.merge(stages)
+
+    return stats
+
+
+def write_output_stats(stats, args):
+    """Write summary statistics of the read configurations, if requested."""
+    if args.output_stats:
+        logging.debug(f"Writing summary statistics to {args.output_stats}")
+        stats.write_json(args.output_stats)
+
+
+def write_tmp_fastx_files_for_processing(args, profiler):
+    """Write tmp fastx.
+
+    Batches are written one at a time as the generator is consumed, so a
+    consumer submitting them with imap_bounded holds at most
+    <max_batches_in_flight> + 1 temporary FASTQ files on disk.
+
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :param profiler: Profiler timing the split_fastq stage
+    :type profiler: class profiling.Profiler
+    :return: generator of temporary FASTQ file names, in batch order
+    :rtype: generator
+    """
     # Write a FASTA file containing the adapter sequences for VSEARCH to use
     write_adapters_fasta(args)
 
-    # Create batched FASTQ temp files that we'll write to next
-    fastq_fns = {}
-    fastq_fs = {}
-    for i in range(1, n_batches + 1):
-        tmp_prefix = f"tmp.chunk.{i}."
-        tmp_fastq = tempfile.NamedTemporaryFile(
-            prefix=tmp_prefix, suffix=".fastq", dir=args.tempdir, delete=False
-        )
-        fastq_fns[i] = tmp_fastq.name
-        fastq_fs[i] = open(tmp_fastq.name, "w")
-
     # Stream through entire input FASTQ and write batched FASTQ files
-    batch_id = 1
     with pysam.FastxFile(args.fastq, "r") as f_in:
-        for i, entry in enumerate(f_in):
-            # Increment batch_id after streaming through <args.batch_size>
-            # reads
-            if (i > 0) & (i % args.batch_size == 0):
-                batch_id += 1
-            f_out = fastq_fs[batch_id]
-            f_out.write("@" + str(entry.name) + "\n")
-            f_out.write(str(entry.sequence) + "\n")
-            f_out.write(str("+\n"))
-            f_out.write(str(entry.quality) + "\n")
-
-    # Close these temporary FASTQ files
-    [f_out.close() for f_out in fastq_fs.values()]
+        entries = iter(f_in)
+        for batch_id in itertools.count(1):
+            with profiler.stage("split_fastq") as stage:
+                batch = list(itertools.islice(entries, args.batch_size))
+                if not batch:
+                    return
+                tmp_fastq = os.path.join(
+                    args.tempdir, f"tmp.chunk.{batch_id}.fastq")
+                with open(tmp_fastq, "w") as f_out:
+                    for entry in batch:
+                        f_out.write("@" + str(entry.name) + "\n")
+                        f_out.write(str(entry.sequence) + "\n")
+                        f_out.write(str("+\n"))
+                        f_out.write(str(entry.quality) + "\n")
+                stage.add_reads(len(batch))
+            yield tmp_fastq
+
+
+def run_streaming(args, profiler):
+    """Process the input FASTQ in streaming mode.
+
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :param profiler: Profiler of the script
+    :type profiler: class profiling.Profiler
+    :return: Summary statistics of all batches
+    :rtype: class ReadConfigStats
+    """
+    write_adapters_fasta(args)
 
-    return fastq_fns
+    logging.info(
+        "Streaming batches of {} reads".format(args.batch_size))
+    batches = stream_fastq_batches(args, args.threads)
+
+    with multiprocessing.Pool(args.threads) as p, profiler.stage(
+            "process_batches"):
+        if args.engine == "vsearch_persistent":
+            # Persistent workers complete batches out of order
+            func_args = (
+                (*searched, args) for searched in in_batch_order(
+                    search_batches_persistent(batches, args)))
+            func = process_batch_hits
+        else:
+            func_args = (
+                (batch_id, records, args)
+                for batch_id, records in batches)
+            func = process_batch_records
+        results = imap_bounded(
+            p, func, func_args, args.max_batches_in_flight)
+        return merge_batch_outputs(
+            tqdm(results, unit=" batches"), args, profiler)
 
 
 def main(args):
     """Entry point."""
     init_logger(args)
-    check_vsearch()
-
-    # If specified batch size is > total number of reads, reduce batch size
-    logging.debug("Counting reads")
-    n_reads = count_reads(args.fastq)
-    args.batch_size = min(n_reads, args.batch_size)
-    n_batches = int(np.ceil(n_reads / args.batch_size))
+    profiler = Profiler(
+        "adapter_scan_vsearch", sample_rss=args.profile is not None)
+    if args.engine != "native":
+        check_vsearch()
 
     # Create temp directory
     if os.path.exists(args.tempdir):
         shutil.rmtree(args.tempdir, ignore_errors=True)
     os.mkdir(args.tempdir)
 
-    fastq_fns = write_tmp_fastx_files_for_processing(n_batches, args)
-
-    logging.info(
-        "Processing {} batches of {} reads".format(
-            n_batches, args.batch_size))
-    func_args = []
-    for batch_id, fn in fastq_fns.items():
-        func_args.append((fn, args))
-
-    with multiprocessing.Pool(args.threads) as p:
-        r = list(tqdm(p.imap(process_batch, func_args), total=n_batches))
-
-    tmp_fastqs, tmp_tables, vsearch_cols = zip(*r)
-    vsearch_cols = vsearch_cols[0]
-
-    # Merge temp tables and fastqs then clean up
-    logging.debug(f"Writing output table to {args.output_tsv}")
-    write_output_table(tmp_tables, args)
-
-    logging.debug(f"Writing stranded fastq to {args.output_fastq}")
-    write_output_fastq(tmp_fastqs, args)
+    if args.streaming:
+        logging.debug("Writing outputs")
+        stats = run_streaming(args, profiler)
+    else:
+        # If specified batch size is > total number of reads, reduce batch
+        # size, keeping it positive for empty inputs
+        logging.debug("Counting reads")
+        with profiler.stage("count_reads") as stage:
+            n_reads = count_reads(args.fastq)
+            stage.add_reads(n_reads)
+        args.batch_size = max(1, min(n_reads, args.batch_size))
+        n_batches = int(np.ceil(n_reads / args.batch_size))
+
+        logging.info(
+            "Processing {} batches of {} reads".format(
+                n_batches, args.batch_size))
+        # Batch FASTQs are split from the input as workers become free
+        func_args = (
+            (fn, args)
+            for fn in write_tmp_fastx_files_for_processing(args, profiler))
+
+        # Merge temp tables and fastqs as batches complete then clean up
+        logging.debug("Writing outputs")
+        with multiprocessing.Pool(args.threads) as p, profiler.stage(
+                "process_batches"):
+            results = imap_bounded(
+                p, process_batch, func_args, args.max_batches_in_flight)
+            stats = merge_batch_outputs(
+                tqdm(results, total=n_batches), args, profiler)
+
+    # Batches are counted by their workers
+    if "write_stranded_fastq" in profiler.worker_stages:
+        profiler.stages["process_batches"].add_reads(
+            profiler.worker_stages["write_stranded_fastq"].reads)
+    write_output_stats(stats, args)
+    shutil.rmtree(args.tempdir, ignore_errors=True)
+    if args.profile:
+        profiler.write(args.profile)
 
 
 if __name__ == "__main__":
@@ -5,7 +5,9 @@ import logging
 import os
 from pathlib import Path
 
+from bam_io import add_bam_args, open_bam
 import numpy as np
+from profiling import Profiler
 import pysam
 from tqdm import tqdm
 
@@ -37,6 +39,16 @@ def parse_args():
         default="gene.sorted.bam",
     )
 
+    add_bam_args(parser)
+
+    parser.add_argument(
+        "--profile",
+        help="Write a JSON profile of the time, reads/s and peak memory of \
+        each stage to this file [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "--verbosity",
         help="logging level: <=2 logs info, <=3 logs warnings",
@@ -86,11 +98,13 @@ def process_bam_entries(args):
 
     :param args: object containing all supplied arguments
     :type args: class argparse.Namespace
+    :return: Number of alignments in the BAM
+    :rtype: int
     """
     n_reads, chroms = get_bam_info(args.bam)
 
-    with pysam.AlignmentFile(args.bam, "rb") as bam:
-        with pysam.AlignmentFile(args.output, "wb", template=bam) as bam_out:
+    with open_bam(args.bam, "rb", args) as bam:
+        with open_bam(args.output, "wb", args, template=bam) as bam_out:
 
             # If input BAM file is empty or there are no gene assignments,
             # write an empty output BAM file
@@ -113,12 +127,19 @@ def process_bam_entries(args):
 
                         bam_out.write(align)
 
+    return n_reads
+
 
 def main(args):
     """Run the entry point."""
     init_logger(args)
+    profiler = Profiler("add_gene_tags", sample_rss=args.profile is not None)
+
+    with profiler.stage("add_gene_tags") as stage:
+        stage.add_reads(process_bam_entries(args))
 
-    process_bam_entries(args)
+    if args.profile:
+        profiler.write(args.profile)
 
 
 if __name__ == "__main__":
@@ -1,23 +1,40 @@
 #!/usr/bin/python3
 """Assign barcodes."""
 import argparse
-import collections
+import functools
 import logging
-import math
 import multiprocessing
 import os
 from pathlib import Path
+import re
 import shutil
 import tempfile
 
+from bam_io import add_bam_args, open_bam, samtools_args
+from barcode_correction import (
+    index_whitelist, KmerIndex, load_arrays, load_whitelist, WhitelistIndex)
+from barcode_encoding import (
+    concat_tag_tables, count_codes, decode, decode_tag_table, most_common,
+    PackedSequences, read_barcode_table, read_tag_table, TAG_COLUMNS,
+    tag_table_columns, unpack, write_tag_table)
 import editdistance as ed
+import numpy as np
 import pandas as pd
 import parasail
+from profiling import Profiler
 import pysam
+from read_features import alignment_read_start, extract_feature
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
+# CIGAR operations before the first aligned base of a CIGAR string, those
+# after the last one in the reversed string, and the deletions and reference
+# skips among them
+CIGAR_HEAD = re.compile(r"(?:\d+[IDNSHP])*")
+CIGAR_TAIL = re.compile(r"(?:[IDNSHP]\d+)*")
+REFERENCE_GAP = re.compile(r"(\d+)[DN]")
+
 
 def parse_args():
     """Create argument parser."""
@@ -27,7 +44,8 @@ def parse_args():
     parser.add_argument(
         "bam",
         help="Sorted BAM file of stranded sequencing reads aligned to \
-            a reference. Alignments must have the CR and CY tags.",
+            a reference. Alignments must have the CR and CY tags, unless \
+            --barcode_table is given.",
         type=Path,
     )
     parser.add_argument(
@@ -45,6 +63,15 @@ def parse_args():
         "-t", "--threads", help="Threads to use [4]", type=int, default=4
     )
 
+    parser.add_argument(
+        "--barcode_table",
+        help="Table of uncorrected barcodes written by extract_barcode.py \
+        --output_table for the alignments of <bam>, which is then the BAM \
+        given to extract_barcode.py [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "-k",
         help="Kmer size to use for whitelist filtering [5]",
@@ -63,7 +90,9 @@ def parse_args():
 
     parser.add_argument(
         "--output_tags",
-        help="Output TSV containing read_id, CB and UR tags [tags.tsv]",
+        help="Output table of the read_id, CB, UR, chr, start and end tags \
+        of the assigned reads: a .npz read tag table with 2-bit encoded \
+        barcodes and UMIs, or a TSV for any other extension [tags.tsv]",
         type=Path,
         default=Path("tags.tsv"),
     )
@@ -179,6 +208,73 @@ def parse_args():
         type=int,
         default=1)
 
+    parser.add_argument(
+        "--tags_chunk_size",
+        help="Number of read tags each worker holds before writing them to \
+        its temporary tag table [100000]",
+        type=int,
+        default=100000,
+    )
+
+    parser.add_argument(
+        "--correction",
+        help="Barcode correction engine: 'index' looks up uncorrected \
+        barcodes in a deletion-neighbourhood index of the whitelist, \
+        'kmer' computes the edit distance to every whitelist barcode \
+        sharing a k-mer with them. Both assign the same barcodes; 'index' \
+        falls back to 'kmer' when --min_ed_diff is 0 or the whitelist has \
+        bases other than A, C, G and T [index]",
+        choices=["index", "kmer"],
+        default="index",
+    )
+
+    parser.add_argument(
+        "--whitelist_index",
+        help="Directory of whitelist indices built by index_whitelist.py \
+        with the same -k, --max_ed and --min_ed_diff, shared by the jobs of \
+        a sample; without it the whitelist is indexed in each job [None]",
+        type=Path,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--correction_cache_size",
+        help="Number of uncorrected barcodes whose corrections each worker \
+        keeps for reuse by later reads with the same uncorrected barcode \
+        [100000]",
+        type=int,
+        default=100000,
+    )
+
+    parser.add_argument(
+        "--aligner",
+        help="UMI probe alignment engine: 'profile' aligns each read with \
+        striped SIMD parasail against a profile of its corrected barcode's \
+        probe, 'scalar' aligns each read with the unvectorised parasail \
+        aligner. Equally scoring alignments may be broken differently \
+        [profile]",
+        choices=["profile", "scalar"],
+        default="profile",
+    )
+
+    parser.add_argument(
+        "--probe_cache_size",
+        help="Number of corrected barcode probe profiles each worker keeps \
+        for reuse by later reads of the same cell [1024]",
+        type=int,
+        default=1024,
+    )
+
+    add_bam_args(parser)
+
+    parser.add_argument(
+        "--profile",
+        help="Write a JSON profile of the time, reads/s and peak memory of \
+        each stage to this file [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "--verbosity",
         help="logging level: <=2 logs info, <=3 logs warnings",
@@ -311,92 +407,31 @@ def calc_ed_with_whitelist(bc_uncorr, whitelist):
     return bc_match, bc_match_ed, next_match_diff
 
 
-LOOKUP = []
-
-for q in range(100):
-    LOOKUP.append(pow(10, -0.1 * q))
-
-
-def compute_mean_qscore(scores):
-    """Compute mean qscore.
-
-    Returns the phred score corresponding to the mean of the probabilities
-    associated with the phred scores provided.
-
-    :param scores: Iterable of phred scores.
-    :returns: Phred score corresponding to the average error rate, as
-        estimated from the input phred scores.
-    """
-    if not scores:
-        return 0.0
-    sum_prob = 0.0
-    for val in scores:
-        sum_prob += LOOKUP[val]
-    mean_prob = sum_prob / len(scores)
-
-    return -10.0 * math.log10(mean_prob)
-
-
-def find_feature_qscores(feature, p_alignment, prefix_seq, prefix_qv):
-    """Find feature qscore.
-
-    Using the parasail alignment results, find the qscores corresponding to the
-    feature (e.g. barcode or UMI) positions in the read.
-
-    :param feature: Feature sequence identified from the parasail alignment
-    :type feature: str
-    :param p_alignment: Parasail alignment object
-    :type p_alignment: class 'parasail.bindings_v2.Result'
-    :param prefix_seq: Nucleotide sequence from the first <args.window> bp of
-        the read
-    :type prefix_seq: str
-    :param prefix_qv: Qscores from the first <args.window> bp of the read
-    :type prefix_qv: np.array
-    :return: Array of phred scale qscores from the identified feature region
-    :rtype: np.array
-    """
-    # Strip feature alignment string of insertions (-)
-    feature_no_ins = feature.replace("-", "")
-
-    # Find where the stripped feature starts and ends in the larger prefis_seq
-    prefix_seq_feature_start = prefix_seq.find(feature_no_ins)
-    prefix_seq_feature_end = prefix_seq_feature_start + len(feature_no_ins)
-
-    # Use these start/end indices to locate the correspoding qscores in
-    # prefix_qv
-    feature_qv = prefix_qv[prefix_seq_feature_start:prefix_seq_feature_end]
-    feature_qv_ascii = "".join(map(lambda x: chr(x + 33), feature_qv))
-
-    return feature_qv_ascii
-
-
-def parse_probe_alignment(p_alignment, align, prefix_seq, prefix_qv):
+def parse_probe_alignment(read_aln, probe_aln, read_start, align, prefix_qv):
     """Parse probe alignment.
 
     Parse a parasail alignment alignment and add uncorrected UMI and UMI QV
     values as tags to the BAM alignment.
 
-    :param p_alignment: parasail alignment
-    :type p_alignment: class 'parasail.bindings_v2.Result'
+    :param read_aln: Aligned read sequence, with gaps as '-'
+    :type read_aln: str
+    :param probe_aln: Aligned probe sequence, with gaps as '-'
+    :type probe_aln: str
+    :param read_start: Position in the read where the alignment starts
+    :type read_start: int
     :param align: pysam BAM alignment
     :type align: class 'pysam.libcalignedsegment.AlignedSegment'
+    :param prefix_qv: Qscores from the first <args.window> bp of the read
+    :type prefix_qv: array.array
     :return: pysam BAM alignment with the UR and UY tags added
     :rtype: class 'pysam.libcalignedsegment.AlignedSegment'
     """
     # Find the position of the Ns in the parasail alignment. These correspond
     # to the UMI sequences bound by the cell barcode and polyT
-    idxs = list(find("N", p_alignment.traceback.ref))
+    idxs = list(find("N", probe_aln))
     if len(idxs) > 0:
-        umi = p_alignment.traceback.query[min(idxs): max(idxs) + 1]
-
-        qscores = find_feature_qscores(umi, p_alignment, prefix_seq, prefix_qv)
-
-        # print(p_alignment.traceback.ref)
-        # print(p_alignment.traceback.comp)
-        # print(p_alignment.traceback.query)
-        # print()
-
-        umi = umi.replace("-", "")
+        umi, _, qscores, _ = extract_feature(
+            read_aln, read_start, min(idxs), max(idxs) + 1, prefix_qv)
 
         # Uncorrected UMI = UR:Z
         align.set_tag("UR", umi, value_type="Z")
@@ -406,7 +441,170 @@ def parse_probe_alignment(p_alignment, align, prefix_seq, prefix_qv):
     return align
 
 
-def get_uncorrected_umi(align, args):
+class BarcodeCorrector:
+    """
+    Correction of uncorrected barcodes against the whitelist.
+
+    The 'index' correction looks barcodes up in a WhitelistIndex of the
+    whitelist, the 'kmer' correction computes the edit distance to every
+    whitelist barcode sharing a k-mer with them. The whitelist and its
+    indices are built once per sample by index_whitelist.py, or per job by
+    BarcodeCorrector.index_whitelist, and memory-mapped by each worker. As
+    the reads of a cell mostly carry the same few uncorrected barcodes,
+    corrections are kept for the <args.correction_cache_size> most
+    recently seen uncorrected barcodes; correct(bc_uncorr) returns the
+    corrected barcode assignment, edit distance, and difference in edit
+    distance between the top match and the next closest match.
+    """
+
+    def __init__(self, args):
+        """Attach to the whitelist indices in <args.whitelist_index>.
+
+        :param args: object containing all supplied arguments
+        :type args: class argparse.Namespace
+        """
+        directory = Path(args.whitelist_index)
+        arrays = load_arrays(directory, ["whitelist", "settings"])
+        settings = arrays["settings"].tolist()
+        if settings != [args.k, args.max_ed, args.min_ed_diff]:
+            raise Exception(
+                f"Whitelist index {directory} was built for -k, --max_ed "
+                f"and --min_ed_diff {settings}, not "
+                f"{[args.k, args.max_ed, args.min_ed_diff]}.")
+        self.whitelist = arrays["whitelist"].astype(str).tolist()
+        self.kmer_index = KmerIndex.load(directory / "kmer")
+        self.k = args.k
+        self.index = None
+        if args.correction == "index" and (directory / "deletion").exists():
+            self.index = WhitelistIndex.load(
+                directory / "deletion", self.whitelist, args.max_ed,
+                args.min_ed_diff, args.k)
+        self.correct = functools.lru_cache(
+            maxsize=args.correction_cache_size)(self._correct)
+
+    @staticmethod
+    def index_whitelist(args, directory):
+        """Build the whitelist indices for the workers to memory-map.
+
+        :param args: object containing all supplied arguments
+        :type args: class argparse.Namespace
+        :param directory: Output directory
+        :type directory: Path
+        :return: Output directory
+        :rtype: Path
+        """
+        indexed = index_whitelist(
+            load_whitelist(args.whitelist), directory, args.k, args.max_ed,
+            args.min_ed_diff, deletion=args.correction == "index")
+        if args.correction == "index" and not indexed:
+            logger.warning(
+                "Cannot index the whitelist for these settings, "
+                "correcting barcodes with the k-mer filter")
+        return directory
+
+    def _correct(self, bc_uncorr):
+        if self.index is not None:
+            # Look up the closest whitelist barcodes in the index
+            return self.index.correct(bc_uncorr)
+
+        # Decompose uncorrected barcode into N k-mers
+        bc_uncorr_kmers = split_seq_into_kmers(bc_uncorr, self.k)
+        # Filter the whitelist to only those with at least one of the k-mers
+        # from the uncorrected barcode
+        filt_whitelist = filter_whitelist_by_kmers(
+            self.whitelist, bc_uncorr_kmers, self.kmer_index)
+
+        # Calc edit distances between uncorrected barcode and the filtered
+        # whitelist barcodes
+        return calc_ed_with_whitelist(bc_uncorr, filt_whitelist)
+
+
+class UmiAligner:
+    """
+    Local alignment of corrected barcode probes to the start of reads.
+
+    The probe of a read is <adapter1_suffix><bc_corr>NNN...N<polyT> for
+    3' and multiome kits, or <adapter1_suffix><bc_corr>NNN...N<TSO> for 5'
+    kits. The scoring matrix and the probe prefix and suffix are built once
+    per worker. With the 'profile' aligner, reads are aligned with the
+    striped SIMD aligner to parasail profiles of the probes, which are
+    kept for the <args.probe_cache_size> most recently seen barcodes, as
+    a cell's reads share its probe. The 'scalar' aligner runs the
+    unvectorised parasail aligner for each read.
+    """
+
+    def __init__(self, args):
+        """Build the scoring matrix and the probe prefix and suffix.
+
+        :param args: object containing all supplied arguments
+        :type args: class argparse.Namespace
+        """
+        # Use only the specified suffix length of adapter1
+        adapter1_probe_seq = args.adapter1_seq[-args.adapter1_suff_length:]
+        if (args.kit == "3prime") or (args.kit == "multiome"):
+            suffix = "T" * args.polyT_length
+        elif args.kit == "5prime":
+            suffix = "TTTCTTATATGGG"
+        else:
+            raise Exception(
+                "Invalid kit name! Specify either 3prime or 5prime.")
+        self.probe_prefix = adapter1_probe_seq
+        self.probe_suffix = "N" * args.umi_length + suffix
+        self.gap_open = args.gap_open
+        self.gap_extend = args.gap_extend
+        self.matrix = update_matrix(args)
+        self.use_profile = args.aligner == "profile"
+        self.profile = functools.lru_cache(maxsize=args.probe_cache_size)(
+            self._create_profile)
+
+    def probe(self, bc_corr):
+        """Compile the probe sequence of a corrected barcode.
+
+        :param bc_corr: Corrected cell barcode
+        :type bc_corr: str
+        :return: Probe sequence
+        :rtype: str
+        """
+        return self.probe_prefix + bc_corr + self.probe_suffix
+
+    def _create_profile(self, bc_corr):
+        # Scores of the 48-62 bp probe fit in 16 bits
+        return parasail.profile_create_16(self.probe(bc_corr), self.matrix)
+
+    def align(self, prefix_seq, bc_corr):
+        """
+        Align the probe of a corrected barcode to a read prefix.
+
+        :param prefix_seq: Nucleotide sequence from the first <args.window>
+            bp of the read
+        :type prefix_seq: str
+        :param bc_corr: Corrected cell barcode
+        :type bc_corr: str
+        :return: Aligned read and probe sequences, with gaps as '-', and
+            the position in the read where the alignment starts
+        :rtype: tuple
+        """
+        if not self.use_profile:
+            p_alignment = parasail.sw_trace(
+                s1=prefix_seq,
+                s2=self.probe(bc_corr),
+                open=self.gap_open,
+                extend=self.gap_extend,
+                matrix=self.matrix,
+            )
+            read_aln = p_alignment.traceback.query
+            return read_aln, p_alignment.traceback.ref, alignment_read_start(
+                read_aln, p_alignment.end_query)
+
+        p_alignment = parasail.sw_trace_striped_profile_16(
+            self.profile(bc_corr), prefix_seq, self.gap_open, self.gap_extend)
+        # The profile makes the probe the query
+        read_aln = p_alignment.traceback.ref
+        return read_aln, p_alignment.traceback.query, alignment_read_start(
+            read_aln, p_alignment.end_ref)
+
+
+def get_uncorrected_umi(align, aligner, args):
     """Get uncorrected umi.
 
     Aligns a probe sequence containing the
@@ -417,6 +615,8 @@ def get_uncorrected_umi(align, args):
 
     :param align: pysam BAM alignment with the CB tag
     :type align: class 'pysam.libcalignedsegment.AlignedSegment'
+    :param aligner: Probe aligner of the worker
+    :type aligner: class UmiAligner
     :param args: object containing all supplied arguments
     :type args: class 'argparse.Namespace'
     :return: pysam BAM alignment with the UR and UY tags added
@@ -425,49 +625,196 @@ def get_uncorrected_umi(align, args):
     prefix_seq = align.get_forward_sequence()[: args.window]
     prefix_qv = align.get_forward_qualities()[: args.window]
 
-    # Use only the specified suffix length of adapter1
-    adapter1_probe_seq = args.adapter1_seq[-args.adapter1_suff_length:]
+    read_aln, probe_aln, read_start = aligner.align(
+        prefix_seq, align.get_tag("CB"))
 
-    if (args.kit == "3prime") or (args.kit == "multiome"):
-        # Compile the actual query sequence of
-        # <adapter1_suffix><bc_corr>NNN...N<TTTTT....>
-        probe_seq = "{r}{bc}{umi}{pT}".format(
-            r=adapter1_probe_seq,
-            bc=align.get_tag("CB"),
-            umi="N" * args.umi_length,
-            pT="T" * args.polyT_length,
-        )
-    elif args.kit == "5prime":
-        # Compile the actual probe sequence of
-        # <adapter1_suffix>NNN...NNN<TTTCTTATATGGG>
-        probe_seq = "{a1}{bc}{umi}{tso}".format(
-            a1=adapter1_probe_seq,
-            bc=align.get_tag("CB"),
-            umi="N" * args.umi_length,
-            tso="TTTCTTATATGGG",
-        )
-    else:
-        raise Exception("Invalid kit name! Specify either 3prime or 5prime.")
+    return parse_probe_alignment(
+        read_aln, probe_aln, read_start, align, prefix_qv)
 
-    matrix = update_matrix(args)
-    parasail_alg = parasail.sw_trace
 
-    p_alignment = parasail_alg(
-        s1=prefix_seq,
-        s2=probe_seq,
-        open=args.gap_open,
-        extend=args.gap_extend,
-        matrix=matrix,
-    )
+def fetch_barcoded_alignments(bam, chrom, barcode_table=None):
+    """
+    Fetch the alignments of a contig that have an uncorrected barcode.
+
+    Without a barcode table, these are all the alignments of the contig,
+    which have the CR and CY tags. With a table, the CR and CY tags of the
+    alignments listed in it are added from the table, as are temporary ur
+    and uy tags of the UMIs the table holds.
+
+    :param bam: BAM file
+    :type bam: class 'pysam.AlignmentFile'
+    :param chrom: Contig to fetch
+    :type chrom: str
+    :param barcode_table: Table written by extract_barcode.py
+        --output_table
+    :type barcode_table: Path
+    :return: Generator of alignments with the CR and CY tags
+    :rtype: class 'pysam.libcalignedsegment.AlignedSegment'
+    """
+    if barcode_table is None:
+        yield from bam.fetch(contig=chrom)
+        return
+
+    table_contig, table = read_barcode_table(barcode_table)
+    if table_contig != chrom:
+        return
+    n_rows = len(table["record"])
+    rows = zip(
+        table["record"].tolist(),
+        table["read_id"].astype(str).tolist(),
+        decode(table["CR"], table["CR_length"], table["CR_n_mask"]),
+        table["CY"].astype(str).tolist(),
+        table["UR"].astype(str).tolist() if "UR" in table else [""] * n_rows,
+        table["UY"].astype(str).tolist() if "UY" in table else [""] * n_rows)
+    row = next(rows, None)
+    for record, align in enumerate(bam.fetch(contig=chrom)):
+        if row is None:
+            break
+        if record != row[0]:
+            continue
+        if align.query_name != row[1]:
+            raise Exception(
+                f"Alignment {record} of {chrom} is of read "
+                f"{align.query_name}, not {row[1]} as in {barcode_table}.")
+        align.set_tag("CR", row[2], value_type="Z")
+        align.set_tag("CY", row[3], value_type="Z")
+        if row[4]:
+            align.set_tag("ur", row[4], value_type="Z")
+            align.set_tag("uy", row[5], value_type="Z")
+        yield align
+        row = next(rows, None)
+    if row is not None:
+        raise Exception(
+            f"{barcode_table} lists more alignments than found for {chrom}.")
 
-    # print(p_alignment.traceback.ref)
-    # print(p_alignment.traceback.comp)
-    # print(p_alignment.traceback.query)
-    # print()
 
-    align = parse_probe_alignment(p_alignment, align, prefix_seq, prefix_qv)
+def has_substitutions_only(bc_uncorr, bc_match, bc_match_ed):
+    """
+    Check whether a barcode was corrected without insertions or deletions.
 
-    return align
+    :param bc_uncorr: Uncorrected barcode
+    :type bc_uncorr: str
+    :param bc_match: Corrected barcode
+    :type bc_match: str
+    :param bc_match_ed: Edit distance between the two
+    :type bc_match_ed: int
+    :return: Whether the edit distance is that of substitutions alone
+    :rtype: bool
+    """
+    if len(bc_uncorr) != len(bc_match):
+        return False
+    return bc_match_ed == sum(a != b for a, b in zip(bc_uncorr, bc_match))
+
+
+def aligned_reference_span(align):
+    """
+    First and last reference positions aligned to a read base.
+
+    These are get_reference_positions()[0] and [-1], taken from the
+    alignment's reference start and end and the CIGAR operations at either
+    end, rather than from a list of every aligned position of the read.
+
+    :param align: Mapped alignment
+    :type align: class pysam.AlignedSegment
+    :return: 0-based first and last aligned reference positions
+    :rtype: int, int
+    """
+    cigar = align.cigarstring
+    start = align.reference_start
+    end = align.reference_end - 1
+    # Skip deletions and reference skips before the first and after the last
+    # aligned base
+    head = CIGAR_HEAD.match(cigar).group()
+    start += sum(map(int, REFERENCE_GAP.findall(head)))
+    tail = CIGAR_TAIL.match(cigar[::-1]).group()[::-1]
+    end -= sum(map(int, REFERENCE_GAP.findall(tail)))
+    return start, end
+
+
+class ReadTagWriter:
+    """
+    Read tags of the alignments of one contig, written out in chunks.
+
+    Rows are held until <chunk_size> have been added, then encoded as a read
+    tag table and saved as the next .npz file of the writer's directory, so
+    that a worker holds one chunk of tags however deep its contig is.
+    """
+
+    def __init__(self, directory, contig, chunk_size=100000):
+        """Start an empty tag table.
+
+        :param directory: Directory of the chunks, created if needed
+        :type directory: Path
+        :param contig: Contig of the alignments
+        :type contig: str
+        :param chunk_size: Number of rows to hold before writing them
+        :type chunk_size: int
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.contig = contig
+        self.chunk_size = chunk_size
+        self.paths = []
+        self.n_rows = 0
+        self._rows = []
+
+    def add(self, read_id, bc_corr, umi_uncorr, start, end):
+        """Add the tags of an alignment.
+
+        :param read_id: Read ID
+        :type read_id: str
+        :param bc_corr: Corrected cell barcode
+        :type bc_corr: str
+        :param umi_uncorr: Uncorrected UMI
+        :type umi_uncorr: str
+        :param start: First aligned reference position
+        :type start: int
+        :param end: Last aligned reference position
+        :type end: int
+        """
+        self._rows.append((read_id, bc_corr, umi_uncorr, start, end))
+        self.n_rows += 1
+        if len(self._rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the held rows as the next chunk.
+
+        :return: Paths of the chunks written so far, in order
+        :rtype: list
+        """
+        if self._rows or not self.paths:
+            read_ids, barcodes, umis, starts, ends = \
+                list(zip(*self._rows)) or [[]] * 5
+            path = self.directory / f"{len(self.paths):06d}.npz"
+            write_tag_table(path, tag_table_columns(
+                read_ids, barcodes, umis, self.contig, starts, ends))
+            self.paths.append(path)
+            self._rows = []
+        return self.paths
+
+
+def write_read_tags(paths, output):
+    """
+    Merge read tag table chunks, in order, into the output tags.
+
+    :param paths: Read tag table chunks
+    :type paths: list
+    :param output: Output .npz read tag table, or TSV for any other
+        extension
+    :type output: Path
+    """
+    if Path(output).suffix == ".npz":
+        write_tag_table(
+            output, concat_tag_tables([read_tag_table(p) for p in paths]))
+        return
+
+    # Stream one chunk at a time into the TSV
+    with open(output, "w") as f:
+        f.write("\t".join(TAG_COLUMNS) + "\n")
+        for path in paths:
+            pd.DataFrame(decode_tag_table(read_tag_table(path))).to_csv(
+                f, sep="\t", header=False, index=False)
 
 
 def process_bam_records(tup):
@@ -483,21 +830,30 @@ def process_bam_records(tup):
 
     :param tup: Tuple containing the input arguments
     :type tup: tup
-    :return: Path to a temporary BAM file
-    :rtype: str
+    :return: Path to a temporary BAM file, the packed codes of the
+        corrected barcodes of the written alignments, in order, the paths
+        of the chunks of their read tag table, and the profiled stages
+    :rtype: str, np.array, list, dict
     """
     input_bam = tup[0]
     chrom = tup[1]
     args = tup[2]
 
-    read_tags = []
+    profiler = Profiler()
+    read_tags = ReadTagWriter(
+        Path(args.tempdir) / f"tags.{chrom}", chrom, args.tags_chunk_size)
 
-    # Load barcode whitelist and map kmers to indices in whitelist for faster
-    # barcode matching
-    whitelist, kmer_to_bc_index = load_whitelist(args.whitelist, args.k)
+    # Attach to the barcode whitelist and its indices for faster barcode
+    # matching
+    with profiler.stage("load_whitelist"):
+        corrector = BarcodeCorrector(args)
+    aligner = UmiAligner(args)
 
-    # Write temp file or straight to output file depending on use case
+    # Write temp file or straight to output file depending on use case;
+    # temp files are only read by the merge, so are left uncompressed
+    level = None
     if args.threads > 1:
+        level = 0
         # Open temporary output BAM file for writing
         suff = f".{chrom}.bam"
         chrom_bam = tempfile.NamedTemporaryFile(
@@ -508,36 +864,30 @@ def process_bam_records(tup):
         bam_out_fn = args.output_bam
 
     # Open BAMs
-    with pysam.AlignmentFile(input_bam, "rb") as bam:
-        with pysam.AlignmentFile(bam_out_fn, "wb", template=bam) as bam_out:
-
-            barcode_counter = collections.Counter()
-
-            for align in bam.fetch(contig=chrom):
+    with open_bam(input_bam, "rb", args) as bam, profiler.stage(
+            "assign_barcodes") as stage:
+        with open_bam(
+                bam_out_fn, "wb", args, template=bam, level=level) as bam_out:
+
+            assigned_barcodes = PackedSequences(args.barcode_length)
+
+            n_reads = 0
+            n_umi_reused = 0
+            for align in fetch_barcoded_alignments(
+                    bam, chrom, args.barcode_table):
+                n_reads += 1
                 # Make sure each alignment in this BAM has an uncorrected
                 # barcode and barcode QV
                 assert align.has_tag("CR") and align.has_tag(
                     "CY"), "CR or CY tags not found"
 
-                align.flag ^= 16  # reverse read alignment flag
-
                 bc_uncorr = align.get_tag("CR")
 
                 # Don't consider any uncorrected barcodes shorter than k
                 if len(bc_uncorr) >= args.k:
-                    # Decompose uncorrected barcode into N k-mers
-                    bc_uncorr_kmers = split_seq_into_kmers(bc_uncorr, args.k)
-                    # Filter the whitelist to only those with at
-                    # least one of the k-mers
-                    # from the uncorrected barcode
-                    filt_whitelist = filter_whitelist_by_kmers(
-                        whitelist, bc_uncorr_kmers, kmer_to_bc_index
-                    )
-
-                    # Calc edit distances between uncorrected barcode and the
-                    # filtered whitelist barcodes
+                    # Find the closest and runner-up whitelist barcodes
                     bc_match, bc_match_ed, next_match_diff = \
-                        calc_ed_with_whitelist(bc_uncorr, filt_whitelist)
+                        corrector.correct(bc_uncorr)
 
                     # Check barcode match edit distance and difference to
                     # runner-up edit distance
@@ -547,28 +897,61 @@ def process_bam_records(tup):
                         # Add corrected cell barcode = CB:Z
                         align.set_tag("CB", bc_match, value_type="Z")
 
-                        # Add corrected barcode to probe sequence to fish out
-                        # uncorrected UMI
-                        align = get_uncorrected_umi(align, args)
+                        if align.has_tag("ur") and has_substitutions_only(
+                                bc_uncorr, bc_match, bc_match_ed):
+                            # The UMI aligned by extract_barcode.py is in
+                            # place, as the barcode kept its length
+                            align.set_tag(
+                                "UR", align.get_tag("ur"), value_type="Z")
+                            align.set_tag(
+                                "UY", align.get_tag("uy"), value_type="Z")
+                            n_umi_reused += 1
+                        else:
+                            # Add corrected barcode to probe sequence to fish
+                            # out uncorrected UMI
+                            align = get_uncorrected_umi(
+                                align, aligner, args)
+
+                    # Drop the temporary UMI tags of extract_barcode.py
+                    align.set_tag("ur", None)
+                    align.set_tag("uy", None)
+                    # Reverse the read alignment flag, only once the UMI has
+                    # been aligned to the forward read sequence
+                    align.flag ^= 16
 
                     # Only write BAM entry in output file if we've assigned a
                     # corrected barcode and an uncorrected UMI
                     if align.has_tag("CB") and align.has_tag("UR"):
-                        read_tags.append(
-                            [align.query_name,
-                             align.get_tag("CB"),
-                             align.get_tag('UR'),
-                             align.reference_name,
-                             align.get_reference_positions()[0],
-                             align.get_reference_positions()[-1]])
+                        read_tags.add(
+                            align.query_name,
+                            align.get_tag("CB"),
+                            align.get_tag("UR"),
+                            *aligned_reference_span(align))
                         bam_out.write(align)
-                        barcode_counter[bc_match] += 1
-
-    tags_df = pd.DataFrame.from_records(
-        read_tags, columns=['read_id', 'CB', 'UR', 'chr', 'start', 'end'])
-    tags_df.to_csv(args.output_tags, index=None, sep='\t')
-
-    return bam_out_fn, barcode_counter
+                        assigned_barcodes.append(bc_match)
+
+            stage.add_reads(n_reads)
+            if n_umi_reused:
+                logger.info(
+                    f"Reused the extracted UMI of {n_umi_reused} of "
+                    f"{n_reads} alignments of {chrom}")
+            cache_info = corrector.correct.cache_info()
+            n_lookups = cache_info.hits + cache_info.misses
+            if n_lookups:
+                logger.info(
+                    f"Barcode correction cache of {chrom}: "
+                    f"{cache_info.hits} hits, {cache_info.misses} misses "
+                    f"({cache_info.hits / n_lookups:.1%} hit rate)")
+            if aligner.use_profile:
+                logger.debug(
+                    f"Probe profile cache of {chrom}: "
+                    f"{aligner.profile.cache_info()}")
+
+    with profiler.stage("write_tags", reads=read_tags.n_rows):
+        tag_paths = read_tags.flush()
+
+    return (
+        bam_out_fn, assigned_barcodes.codes(), tag_paths, profiler.stages)
 
 
 def launch_pool(func, func_args, procs=1):
@@ -597,7 +980,7 @@ def launch_pool(func, func_args, procs=1):
     return results
 
 
-def filter_whitelist_by_kmers(wl, kmers, kmer_to_bc_index):
+def filter_whitelist_by_kmers(wl, kmers, kmer_index):
     """Filter whitelist by kmers.
 
     Given a list of whitelisted barcodes, return just the
@@ -608,23 +991,14 @@ def filter_whitelist_by_kmers(wl, kmers, kmer_to_bc_index):
     :type wl: list
     :param kmers: K-mers to use for whitelist filtering
     :type kmers: list
-    :param kmer_to_bc_index: Map of k-mers to the whitelist
-        indices corresponding
-        to all barcodes containing that k-mer
-    :type kmer_to_bc_index: dict
-    :return: List of filtered barcodes
+    :param kmer_index: Index of the whitelist barcodes containing each k-mer
+    :type kmer_index: KmerIndex
+    :return: List of filtered barcodes, in whitelist order
     :rtype: list
     """
-    # collect sets of indices that each kmer points to
-    id_sets = [
-        kmer_to_bc_index[kmer] for
-        kmer in kmers if kmer in kmer_to_bc_index.keys()]
-
     # retain all barcodes that have at least one kmer match with the query
     # barcode
-    all_filt_indices = list(set().union(*id_sets))
-    filt_wl = [wl[i] for i in all_filt_indices]
-    return filt_wl
+    return [wl[i] for i in kmer_index.lookup(kmers).tolist()]
 
 
 def split_seq_into_kmers(seq, k):
@@ -647,39 +1021,6 @@ def split_seq_into_kmers(seq, k):
     return kmers
 
 
-def load_whitelist(whitelist, k=5):
-    """Load whitelist.
-
-    Read in barcode whitelist and create dictionary mapping each k-mer to all
-    barcodes in the whitelist containing that k-mer.
-
-    :param whitelist: Path to the barcode whitelist
-    :type whitelist: str
-    :param k: k-mer length
-    :type k: int
-    :return: List of whitelisted barcodes and dictionary mapping
-        all k-mers to indices in the whitelist corresponding
-        to barcodes containing that k-mer
-    :rtype: list, dict
-    """
-    wl = []
-    with open(whitelist) as file:
-        for line in file:
-            bc = line.strip().split("-")[0]
-            wl.append(bc)
-
-    wl.sort()
-    kmer_to_bc_index = {}
-    for index, bc in enumerate(wl):
-        bc_kmers = split_seq_into_kmers(bc, k)
-        for bc_kmer in bc_kmers:
-            if bc_kmer not in kmer_to_bc_index.keys():
-                kmer_to_bc_index[bc_kmer] = set([index])
-            else:
-                kmer_to_bc_index[bc_kmer].add(index)
-    return wl, kmer_to_bc_index
-
-
 def get_bam_info(bam):
     """Get bam info.
 
@@ -703,15 +1044,23 @@ def get_bam_info(bam):
 def main(args):
     """Run main entry point."""
     init_logger(args)
+    profiler = Profiler("assign_barcodes", sample_rss=args.profile is not None)
     # logger.info("Getting BAM statistics")
     n_reads, chroms = get_bam_info(args.bam)
 
-    if args.threads > 1:
-        # Create temporary directory
-        if os.path.exists(args.tempdir):
-            shutil.rmtree(args.tempdir, ignore_errors=True)
-        os.mkdir(args.tempdir)
+    # Create temporary directory
+    if os.path.exists(args.tempdir):
+        shutil.rmtree(args.tempdir, ignore_errors=True)
+    os.mkdir(args.tempdir)
+
+    # Index the whitelist once for all workers, unless indexed for the
+    # sample already
+    if args.whitelist_index is None:
+        with profiler.stage("index_whitelist"):
+            args.whitelist_index = BarcodeCorrector.index_whitelist(
+                args, Path(args.tempdir) / "whitelist")
 
+    if args.threads > 1:
         # Process BAM alignments from each chrom separately
         logger.info(f"Assigning barcodes to reads in {args.bam}")
         func_args = []
@@ -719,35 +1068,56 @@ def main(args):
         for chrom in chroms_sorted.keys():
             func_args.append((args.bam, chrom, args))
 
-        results = launch_pool(process_bam_records, func_args, args.threads)
-        chrom_bam_fns, barcode_counters = zip(*results)
+        with profiler.stage("assign", reads=n_reads):
+            results = launch_pool(
+                process_bam_records, func_args, args.threads)
+        chrom_bam_fns, chrom_barcodes, chrom_tag_paths, worker_stages = \
+            zip(*results)
+        for stages in worker_stages:
+            profiler.merge(stages)
+        # Merge the tags of each chrom in reference order
+        tag_paths = dict(zip(chroms_sorted.keys(), chrom_tag_paths))
+        tag_paths = [
+            path for chrom in chroms.keys() for path in tag_paths[chrom]]
 
-        barcode_counter = sum(barcode_counters, collections.Counter())
+        assigned_barcodes = np.concatenate(chrom_barcodes)
 
         tmp_bam = tempfile.NamedTemporaryFile(
             prefix="tmp.align.",
             suffix=".unsorted.bam",
             dir=args.tempdir,
             delete=False)
-        merge_parameters = ["-f", tmp_bam.name] + list(chrom_bam_fns)
-        pysam.merge(*merge_parameters)
-
-        pysam.sort(
-            "-@", str(args.threads),
-            "-o", args.output_bam, tmp_bam.name)
+        merge_parameters = samtools_args(args, level=0) + [
+            "-f", tmp_bam.name] + list(chrom_bam_fns)
+        with profiler.stage("merge_bam", reads=n_reads):
+            pysam.merge(*merge_parameters)
 
-        logger.info("Cleaning up temporary files")
-        shutil.rmtree(args.tempdir, ignore_errors=True)
+        with profiler.stage("sort_bam", reads=n_reads):
+            pysam.sort(
+                *samtools_args(args, threads=args.threads),
+                "-o", str(args.output_bam), tmp_bam.name)
 
     else:
         chrom = args.contig
         func_args = (args.bam, chrom, args)
-        _, barcode_counter = process_bam_records(func_args)
+        _, assigned_barcodes, tag_paths, stages = process_bam_records(
+            func_args)
+        profiler.stages.update(stages)
 
+    with profiler.stage("merge_tags", reads=len(assigned_barcodes)):
+        write_read_tags(tag_paths, args.output_tags)
+
+    logger.info("Cleaning up temporary files")
+    shutil.rmtree(args.tempdir, ignore_errors=True)
+
+    codes, counts = most_common(*count_codes(assigned_barcodes))
     with open(args.output_counts, "w") as f:
-        for bc, n in barcode_counter.most_common():
+        for bc, n in zip(unpack(codes, args.barcode_length), counts):
             f.write(f"{bc}\t{n}\n")
 
+    if args.profile:
+        profiler.write(args.profile)
+
 
 if __name__ == "__main__":
     args = parse_args()
@@ -8,6 +8,7 @@ from pathlib import Path
 import bioframe as bf
 import numpy as np
 import pandas as pd
+from profiling import Profiler
 
 
 logger = logging.getLogger(__name__)
@@ -54,6 +55,14 @@ def parse_args():
         default=200000,
     )
 
+    parser.add_argument(
+        "--profile",
+        help="Write a JSON profile of the time, reads/s and peak memory of \
+        each stage to this file [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "--verbosity",
         help="logging level: <=2 logs info, <=3 logs warnings",
@@ -314,8 +323,12 @@ def process_bed_chunk(bed_chunk, gtf, args):
 
 def main(args):
     """Run main entry point."""
-    gtf = load_gtf(args)
-    bed = load_bed(args)
+    profiler = Profiler("assign_genes", sample_rss=args.profile is not None)
+    with profiler.stage("load_gtf"):
+        gtf = load_gtf(args)
+    with profiler.stage("load_bed") as stage:
+        bed = load_bed(args)
+        stage.add_reads(bed.shape[0])
 
     ext = args.output.suffix
     if (bed.shape[0] > 0) & (gtf.shape[0] > 0):
@@ -323,15 +336,17 @@ def main(args):
         n = int(np.ceil(bed.shape[0] / args.chunk_size))
         chunk_fns = []
         for i, bed_chunk in enumerate(np.array_split(bed, n)):
-            df_chunk = process_bed_chunk(bed_chunk, gtf, args)
+            with profiler.stage("assign_genes", reads=bed_chunk.shape[0]):
+                df_chunk = process_bed_chunk(bed_chunk, gtf, args)
 
             fn = args.output.with_suffix(f".{i}{ext}")
 
             chunk_fns.append(fn)
-            df_chunk.to_csv(fn, sep="\t", index=False, header=False)
+            with profiler.stage("write_chunks", reads=df_chunk.shape[0]):
+                df_chunk.to_csv(fn, sep="\t", index=False, header=False)
 
         # Concatenate chunked output files
-        with args.output.open("w") as f_out:
+        with args.output.open("w") as f_out, profiler.stage("merge_chunks"):
             for fn in chunk_fns:
                 with open(fn) as f_in:
                     for line in f_in:
@@ -346,6 +361,9 @@ def main(args):
         f = args.output.open("w")
         f.close()
 
+    if args.profile:
+        profiler.write(args.profile)
+
 
 if __name__ == "__main__":
     args = parse_args()
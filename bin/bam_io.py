@@ -0,0 +1,86 @@
+"""htslib threads and compression levels for the BAM files of bin/ scripts.
+
+pysam decompresses and compresses BGZF blocks on the calling thread unless
+a file is opened with an htslib thread pool, which for tag-only rewrites
+makes deflate a large share of the run time. Scripts add --bam_threads and
+--bam_compression_level with add_bam_args and open their BAMs with
+open_bam; samtools commands run through pysam take the same settings from
+samtools_args. A compression level of 0 writes uncompressed BAM, for BAMs
+that are only read by the next step of the workflow.
+"""
+import pysam
+
+
+def add_bam_args(parser):
+    """
+    Add the BAM threading and compression arguments to a parser.
+
+    :param parser: Argument parser of a script
+    :type parser: class argparse.ArgumentParser
+    """
+    parser.add_argument(
+        "--bam_threads",
+        help="htslib threads decompressing or compressing each BAM file \
+        read or written, in each worker process [1]",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--bam_compression_level",
+        help="BGZF compression level of output BAMs, from 0 (uncompressed) \
+        to 9 [htslib default]",
+        type=int,
+        choices=range(10),
+        default=None,
+    )
+
+
+def open_bam(path, mode, args, template=None, level=None):
+    """
+    Open a BAM file with the htslib threads and compression level of args.
+
+    :param path: BAM file path
+    :type path: str or Path
+    :param mode: "rb" to read, "wb" to write
+    :type mode: str
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :param template: Alignment file whose header is written
+    :type template: class pysam.AlignmentFile
+    :param level: Compression level overriding --bam_compression_level
+    :type level: int
+    :return: Open alignment file
+    :rtype: class pysam.AlignmentFile
+    """
+    if level is None:
+        level = args.bam_compression_level
+    format_options = []
+    if "w" in mode and level is not None:
+        format_options.append(f"level={level}".encode())
+    return pysam.AlignmentFile(
+        str(path), mode, template=template, threads=args.bam_threads,
+        format_options=format_options)
+
+
+def samtools_args(args, level=None, threads=None):
+    """
+    Build samtools merge/sort options for the threads and compression level.
+
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :param level: Compression level overriding --bam_compression_level
+    :type level: int
+    :param threads: Threads overriding --bam_threads
+    :type threads: int
+    :return: Command line options
+    :rtype: list
+    """
+    if threads is None:
+        threads = args.bam_threads
+    options = ["-@", str(threads)]
+    if level is None:
+        level = args.bam_compression_level
+    if level is not None:
+        options += ["-l", str(level)]
+    return options
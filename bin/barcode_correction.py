@@ -0,0 +1,610 @@
+"""Correct uncorrected barcodes against a whitelist with a deletion index.
+
+Any two sequences within edit distance d of each other share a sequence
+obtained by deleting at most d bases from each (SymSpell). The
+WhitelistIndex holds the 2-bit codes of all such deletion variants of the
+whitelist barcodes, sorted, so that the whitelist barcodes within a given
+distance of a query are found by looking up the query's own deletion
+variants and verifying the few hits with editdistance.
+
+The correction reproduces that of assign_barcodes.py's k-mer filter: the
+best and runner-up matches are taken among whitelist barcodes sharing a
+k-mer with the query, and the index is searched to the distance needed to
+decide --max_ed and --min_ed_diff, so that the same reads are assigned
+the same barcodes.
+
+The indices are flat CSR arrays, built once per job and saved as .npy
+files that workers memory-map rather than rebuild.
+"""
+import itertools
+from pathlib import Path
+
+from barcode_encoding import ENCODE, IS_OTHER, MAX_LENGTH
+import editdistance as ed
+import numpy as np
+
+# Base to 2-bit code, with other bases as OTHER_CODE, as a bytes.translate
+# table
+OTHER_CODE = 4
+QUERY_CODES = bytes(
+    b"ACGT".index(base) if base in b"ACGT" else OTHER_CODE
+    for base in range(256))
+
+
+def base_codes(seqs, length):
+    """
+    2-bit codes of the bases of sequences of one length.
+
+    :param seqs: Sequences of <length> bases
+    :type seqs: list
+    :param length: Sequence length
+    :type length: int
+    :return: Base codes and whether each base is other than A, C, G and T
+    :rtype: np.array(uint64), np.array(bool), both of shape
+        (len(seqs), length)
+    """
+    bases = np.array(seqs, dtype=f"S{length}").view(np.uint8).reshape(
+        len(seqs), length)
+    return ENCODE[bases], IS_OTHER[bases]
+
+
+def deletion_combinations(length, max_deletions):
+    """
+    Positions kept by each way of deleting up to <max_deletions> bases.
+
+    :param length: Sequence length
+    :type length: int
+    :param max_deletions: Maximum number of deleted bases
+    :type max_deletions: int
+    :return: For each number of deletions, from 0, an array with a row of
+        the kept positions for each combination of deleted positions
+    :rtype: list
+    """
+    combinations = []
+    for n_del in range(min(max_deletions, length - 1) + 1):
+        combinations.append(np.array([
+            [p for p in range(length) if p not in deleted]
+            for deleted in itertools.combinations(range(length), n_del)
+        ], dtype=np.intp))
+    return combinations
+
+
+def variant_keys(codes, other, kept):
+    """
+    Length tagged 2-bit codes of the deletion variants of sequences.
+
+    :param codes: Base codes from base_codes
+    :type codes: np.array(uint64)
+    :param other: Bases other than A, C, G and T, from base_codes
+    :type other: np.array(bool)
+    :param kept: Kept positions of each variant, as rows
+    :type kept: np.array
+    :return: Codes of each variant of each sequence and whether the variant
+        has only A, C, G and T
+    :rtype: np.array(uint64), np.array(bool), both of shape
+        (len(codes), len(kept))
+    """
+    keys = np.zeros((len(codes), len(kept)), dtype=np.uint64)
+    valid = np.ones((len(codes), len(kept)), dtype=bool)
+    for p in range(kept.shape[1]):
+        keys = (keys << np.uint64(2)) | codes[:, kept[:, p]]
+        valid &= ~other[:, kept[:, p]]
+    keys |= np.uint64(1) << np.uint64(2 * kept.shape[1])
+    return keys, valid
+
+
+def unique_rows(keys, indices):
+    """
+    Group the whitelist indices of sorted keys into CSR arrays.
+
+    :param keys: Keys, sorted
+    :type keys: np.array
+    :param indices: Whitelist index of each key, sorted within each key
+    :type indices: np.array
+    :return: Unique keys, start of the indices of each key and the end of
+        the last, and the indices without repeats within a key
+    :rtype: np.array, np.array, np.array(uint32)
+    """
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]) | (indices[1:] != indices[:-1])
+    keys, indices = keys[first], indices[first].astype(np.uint32)
+    new_key = np.ones(len(keys), dtype=bool)
+    new_key[1:] = keys[1:] != keys[:-1]
+    return (
+        keys[new_key], np.append(np.flatnonzero(new_key), len(keys)),
+        indices)
+
+
+def gather_rows(offsets, indices, rows):
+    """
+    Concatenate the whitelist indices of rows of CSR arrays.
+
+    :param offsets: Start of the indices of each row, and the end of the last
+    :type offsets: np.array
+    :param indices: Whitelist indices of all rows
+    :type indices: np.array
+    :param rows: Rows to gather
+    :type rows: np.array
+    :return: Indices of the rows, one row after the other
+    :rtype: np.array
+    """
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    if len(counts) and counts.max() > 1:
+        starts = np.repeat(starts, counts) + np.arange(counts.sum()) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+    return indices[starts]
+
+
+def save_arrays(directory, arrays):
+    """
+    Save arrays as .npy files named after them.
+
+    :param directory: Output directory, created if needed
+    :type directory: Path
+    :param arrays: Arrays by name
+    :type arrays: dict
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(directory / f"{name}.npy", np.asarray(array))
+
+
+def load_arrays(directory, names):
+    """
+    Memory-map arrays saved with save_arrays.
+
+    :param directory: Directory of the arrays
+    :type directory: Path
+    :param names: Array names
+    :type names: iterable
+    :return: Read-only arrays by name
+    :rtype: dict
+    """
+    return {
+        name: np.load(Path(directory) / f"{name}.npy", mmap_mode="r")
+        for name in names}
+
+
+class KmerIndex:
+    """
+    Whitelist barcodes containing each k-mer, as CSR arrays.
+
+    k-mers are held as fixed width bytes, so whitelists with bases other
+    than A, C, G and T are indexed too.
+    """
+
+    ARRAYS = ("kmers", "offsets", "indices")
+
+    def __init__(self, kmers, offsets, indices):
+        """Wrap the index arrays of a whitelist.
+
+        :param kmers: Sorted unique k-mers of the whitelist barcodes
+        :type kmers: np.array(bytes)
+        :param offsets: Start of the barcodes of each k-mer in <indices>, and
+            the end of the last
+        :type offsets: np.array
+        :param indices: Whitelist indices of the barcodes with each k-mer
+        :type indices: np.array(uint32)
+        """
+        self.kmers = np.asarray(kmers)
+        self.offsets = np.asarray(offsets)
+        self.indices = np.asarray(indices)
+        self.k = self.kmers.dtype.itemsize
+
+    @classmethod
+    def from_whitelist(cls, whitelist, k):
+        """Index the k-mers of the whitelist barcodes.
+
+        :param whitelist: Whitelist barcodes
+        :type whitelist: list
+        :param k: k-mer length
+        :type k: int
+        :return: k-mer index
+        :rtype: KmerIndex
+        """
+        kmers, indices = [], []
+        for index, bc in enumerate(whitelist):
+            for i in range(len(bc) - k + 1):
+                kmers.append(bc[i:i + k])
+                indices.append(index)
+        kmers = np.array(kmers, dtype=f"S{k}")
+        indices = np.array(indices, dtype=np.uint32)
+        order = np.lexsort((indices, kmers))
+        return cls(*unique_rows(kmers[order], indices[order]))
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-map an index saved with KmerIndex.save.
+
+        :param directory: Directory of the saved index
+        :type directory: Path
+        :return: k-mer index
+        :rtype: KmerIndex
+        """
+        return cls(**load_arrays(directory, cls.ARRAYS))
+
+    def save(self, directory):
+        """Save the index arrays as .npy files.
+
+        :param directory: Output directory
+        :type directory: Path
+        """
+        save_arrays(directory, {
+            name: getattr(self, name) for name in self.ARRAYS})
+
+    def lookup(self, kmers):
+        """
+        Find the whitelist barcodes containing any of a list of k-mers.
+
+        :param kmers: k-mers
+        :type kmers: list
+        :return: Whitelist indices of the barcodes, in ascending order
+        :rtype: np.array
+        """
+        if len(self.kmers) == 0 or len(kmers) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        queries = np.array(kmers, dtype=self.kmers.dtype)
+        pos = np.minimum(
+            np.searchsorted(self.kmers, queries), len(self.kmers) - 1)
+        pos = pos[self.kmers[pos] == queries]
+        return np.unique(gather_rows(self.offsets, self.indices, pos))
+
+
+class WhitelistIndex:
+    """
+    Deletion-neighbourhood index of a barcode whitelist.
+
+    Use WhitelistIndex.supports to check that the index can reproduce the
+    k-mer filtered correction for the given whitelist and settings.
+    """
+
+    ARRAYS = ("keys", "offsets", "indices")
+
+    def __init__(
+            self, whitelist, max_ed, min_ed_diff, k, keys, offsets, indices):
+        """Wrap the index arrays of a whitelist.
+
+        :param whitelist: Whitelist barcodes
+        :type whitelist: list
+        :param max_ed: Max edit distance of a barcode match
+        :type max_ed: int
+        :param min_ed_diff: Min difference in edit distance between the top
+            and runner-up matches
+        :type min_ed_diff: int
+        :param k: k-mer length of the whitelist filter
+        :type k: int
+        :param keys: Sorted unique codes of the deletion variants
+        :type keys: np.array(uint64)
+        :param offsets: Start of the barcodes of each variant in <indices>,
+            and the end of the last
+        :type offsets: np.array
+        :param indices: Whitelist indices of the barcodes of each variant
+        :type indices: np.array(uint32)
+        """
+        self.whitelist = whitelist
+        self.k = k
+        self.max_ed = max_ed
+        self.min_ed_diff = min_ed_diff
+        # Matches further than this are too far to be assigned or to stop
+        # the best match from being assigned
+        self.max_dist = max_ed + min_ed_diff - 1
+        self.keys = np.asarray(keys)
+        self.offsets = np.asarray(offsets)
+        self.indices = np.asarray(indices)
+        self._query_plans = {}
+
+    @classmethod
+    def from_whitelist(cls, whitelist, max_ed, min_ed_diff, k):
+        """Index the deletion variants of the whitelist barcodes.
+
+        :param whitelist: Whitelist barcodes
+        :type whitelist: list
+        :param max_ed: Max edit distance of a barcode match
+        :type max_ed: int
+        :param min_ed_diff: Min difference in edit distance between the top
+            and runner-up matches
+        :type min_ed_diff: int
+        :param k: k-mer length of the whitelist filter
+        :type k: int
+        :return: Whitelist index
+        :rtype: WhitelistIndex
+        """
+        max_dist = max_ed + min_ed_diff - 1
+        keys, indices = [], []
+        lengths = np.fromiter(
+            map(len, whitelist), dtype=np.intp, count=len(whitelist))
+        for length in np.unique(lengths).tolist():
+            members = np.flatnonzero(lengths == length)
+            codes, other = base_codes(
+                [whitelist[i] for i in members], length)
+            for kept in deletion_combinations(length, max_dist):
+                variants, valid = variant_keys(codes, other, kept)
+                keys.append(variants[valid])
+                indices.append(np.broadcast_to(
+                    members[:, None], variants.shape)[valid])
+        keys = np.concatenate(keys) if keys else np.zeros(0, np.uint64)
+        indices = (
+            np.concatenate(indices) if indices else np.zeros(0, np.intp))
+
+        # Sort by variant, dropping the repeats of a barcode's variants,
+        # e.g. from deletions in homopolymers, with the barcodes of variant
+        # i at indices[offsets[i]:offsets[i + 1]]
+        order = np.lexsort((indices, keys))
+        return cls(
+            whitelist, max_ed, min_ed_diff, k,
+            *unique_rows(keys[order], indices[order]))
+
+    @classmethod
+    def load(cls, directory, whitelist, max_ed, min_ed_diff, k):
+        """Memory-map an index saved with WhitelistIndex.save.
+
+        :param directory: Directory of the saved index
+        :type directory: Path
+        :param whitelist: Whitelist barcodes the index was built from
+        :type whitelist: list
+        :param max_ed: Max edit distance the index was built for
+        :type max_ed: int
+        :param min_ed_diff: Min edit distance difference the index was built
+            for
+        :type min_ed_diff: int
+        :param k: k-mer length of the whitelist filter
+        :type k: int
+        :return: Whitelist index
+        :rtype: WhitelistIndex
+        """
+        return cls(
+            whitelist, max_ed, min_ed_diff, k,
+            **load_arrays(directory, cls.ARRAYS))
+
+    def save(self, directory):
+        """Save the index arrays as .npy files.
+
+        :param directory: Output directory
+        :type directory: Path
+        """
+        save_arrays(directory, {
+            name: getattr(self, name) for name in self.ARRAYS})
+
+    @staticmethod
+    def supports(whitelist, max_ed, min_ed_diff):
+        """
+        Check whether the index reproduces the k-mer filtered correction.
+
+        Equally good matches are only broken in the order of the k-mer
+        filter's candidates, so <min_ed_diff> must be at least 1, and
+        whitelist barcodes must have only A, C, G and T.
+
+        :param whitelist: Whitelist barcodes
+        :type whitelist: list
+        :param max_ed: Max edit distance of a barcode match
+        :type max_ed: int
+        :param min_ed_diff: Min difference in edit distance between the top
+            and runner-up matches
+        :type min_ed_diff: int
+        :return: Whether the index can be used
+        :rtype: bool
+        """
+        if min_ed_diff < 1 or max_ed < 0:
+            return False
+        return all(
+            len(bc) < MAX_LENGTH and set(bc) <= set("ACGT")
+            for bc in whitelist)
+
+    def query_plan(self, length, min_del, max_del):
+        """
+        Get the segments between the deleted bases of each deletion variant.
+
+        A variant's code is the sum of the codes of its segments, shifted
+        into place, and a segment's code is the difference of two prefix
+        codes of the sequence, so a variant is computed from its segments
+        rather than from all of its bases.
+
+        :param length: Sequence length
+        :type length: int
+        :param min_del: Min number of deleted bases
+        :type min_del: int
+        :param max_del: Max number of deleted bases
+        :type max_del: int
+        :return: Start and end of each segment of each variant, the shift of
+            the prefix code at the start of the segment and the shift of the
+            segment in the variant's code, all of shape
+            (number of variants, max_del + 1) with empty segments as
+            padding, and the length tag of each variant
+        :rtype: tuple
+        """
+        plan = (length, min_del, max_del)
+        if plan not in self._query_plans:
+            starts, ends, tags = [], [], []
+            for n_del in range(min_del, max_del + 1):
+                padding = (0,) * (max_del - n_del)
+                for deleted in itertools.combinations(range(length), n_del):
+                    starts.append(
+                        padding + (0,) + tuple(p + 1 for p in deleted))
+                    ends.append(padding + deleted + (length,))
+                    tags.append(1 << 2 * (length - n_del))
+            starts = np.array(starts, dtype=np.intp)
+            ends = np.array(ends, dtype=np.intp)
+            # Bases kept after each segment
+            after = np.cumsum(
+                (ends - starts)[:, ::-1], axis=1)[:, ::-1] - (ends - starts)
+            self._query_plans[plan] = (
+                starts, ends,
+                (2 * (ends - starts)).astype(np.uint64),
+                (2 * after).astype(np.uint64),
+                np.array(tags, dtype=np.uint64))
+        return self._query_plans[plan]
+
+    def lookup(self, prefixes, n_other, min_del, max_del):
+        """
+        Find the whitelist barcodes sharing a deletion variant with a query.
+
+        :param prefixes: Codes of the prefixes of the query, from 0 bases
+        :type prefixes: np.array(uint64)
+        :param n_other: Number of bases other than A, C, G and T in each
+            prefix of the query, or None if there are none
+        :type n_other: np.array
+        :param min_del: Min number of bases deleted from the query
+        :type min_del: int
+        :param max_del: Max number of bases deleted from the query
+        :type max_del: int
+        :return: Indices of the whitelist barcodes, possibly repeated
+        :rtype: list
+        """
+        if len(self.keys) == 0:
+            return []
+        starts, ends, prefix_shifts, shifts, tags = self.query_plan(
+            len(prefixes) - 1, min_del, max_del)
+        queries = (
+            (prefixes[ends] - (prefixes[starts] << prefix_shifts)) << shifts
+        ).sum(axis=1) | tags
+        pos = np.minimum(
+            np.searchsorted(self.keys, queries), len(self.keys) - 1)
+        hit = self.keys[pos] == queries
+        if n_other is not None:
+            hit &= (n_other[ends] - n_other[starts]).sum(axis=1) == 0
+        return gather_rows(self.offsets, self.indices, pos[hit]).tolist()
+
+    def correct(self, bc_uncorr):
+        """
+        Find the best and runner-up whitelist matches of a barcode.
+
+        Barcodes within r edits share a variant with at most r deletions,
+        so the index is searched one deletion more at a time, until the
+        best match is too far to be assigned or all matches that could stop
+        it from being assigned have been found.
+
+        :param bc_uncorr: Uncorrected cell barcode, of at least k bases
+        :type bc_uncorr: str
+        :return: Corrected barcode assignment, edit distance, and difference
+            in edit distance between the top match and the next closest
+            match, as returned by calc_ed_with_whitelist for the k-mer
+            filtered whitelist whenever the match passes --max_ed and
+            --min_ed_diff
+        :rtype: str, int, int
+        """
+        length = len(bc_uncorr)
+        kmers = {bc_uncorr[i:i + self.k] for i in range(length - self.k + 1)}
+
+        def distance(i):
+            # Edit distance of a whitelist barcode, None for those without a
+            # k-mer of the barcode, which the k-mer filter leaves out
+            wl_bc = self.whitelist[i]
+            if any(
+                    wl_bc[j:j + self.k] in kmers
+                    for j in range(len(wl_bc) - self.k + 1)):
+                return ed.eval(bc_uncorr, wl_bc)
+            return None
+
+        if length >= MAX_LENGTH:
+            # Too long to encode, compare with the whole whitelist
+            distances = {i: distance(i) for i in range(len(self.whitelist))}
+            radius = length
+        else:
+            distances = {}
+            radius = -1
+            codes = bc_uncorr.encode().translate(QUERY_CODES)
+            prefixes = [0]
+            for code in codes:
+                prefixes.append(prefixes[-1] << 2 | code & 3)
+            prefixes = np.array(prefixes, dtype=np.uint64)
+            n_other = np.cumsum(np.frombuffer(b"\0" + codes, np.uint8) >> 2) \
+                if OTHER_CODE in codes else None
+            # Search the distances that cannot decide the match at once,
+            # then one more deletion at a time
+            top = min(self.max_dist, length - 1)
+            first = min(self.max_ed, self.min_ed_diff - 1, top)
+            for radius in range(first, top + 1):
+                for i in self.lookup(
+                        prefixes, n_other, 0 if radius == first else radius,
+                        radius):
+                    if i not in distances:
+                        distances[i] = distance(i)
+                best = min((
+                    d for d in distances.values()
+                    if d is not None and d <= radius), default=None)
+                if best is None:
+                    if radius >= self.max_ed:
+                        break
+                elif best > self.max_ed or \
+                        radius >= best + self.min_ed_diff - 1:
+                    break
+
+        bc_match = "X" * length
+        bc_match_ed = length
+        next_bc_match_ed = length
+        for i in sorted(distances):
+            d = distances[i]
+            if d is None or d > radius:
+                continue
+            if d < bc_match_ed:
+                next_bc_match_ed = bc_match_ed
+                bc_match_ed = d
+                bc_match = self.whitelist[i]
+            elif d < next_bc_match_ed:
+                next_bc_match_ed = d
+        next_match_diff = next_bc_match_ed - bc_match_ed
+
+        return bc_match, bc_match_ed, next_match_diff
+
+
+def load_whitelist(whitelist):
+    """Load whitelist.
+
+    Read in barcode whitelist, dropping any -1 style suffix of the
+    barcodes.
+
+    :param whitelist: Path to the barcode whitelist
+    :type whitelist: str
+    :return: Sorted list of whitelisted barcodes
+    :rtype: list
+    """
+    wl = []
+    with open(whitelist) as file:
+        for line in file:
+            bc = line.strip().split("-")[0]
+            wl.append(bc)
+
+    wl.sort()
+    return wl
+
+
+def index_whitelist(
+        whitelist, directory, k, max_ed, min_ed_diff, deletion=True):
+    """
+    Build the whitelist indices of a job for its workers to memory-map.
+
+    The directory holds the sorted whitelist, its KmerIndex and, if
+    <deletion> and WhitelistIndex.supports the settings, its WhitelistIndex,
+    with the settings they were built for.
+
+    :param whitelist: Sorted whitelist barcodes
+    :type whitelist: list
+    :param directory: Output directory
+    :type directory: Path
+    :param k: k-mer length of the whitelist filter
+    :type k: int
+    :param max_ed: Max edit distance of a barcode match
+    :type max_ed: int
+    :param min_ed_diff: Min difference in edit distance between the top and
+        runner-up matches
+    :type min_ed_diff: int
+    :param deletion: Whether to build the WhitelistIndex
+    :type deletion: bool
+    :return: Whether the WhitelistIndex was built
+    :rtype: bool
+    """
+    directory = Path(directory)
+    save_arrays(directory, {
+        "whitelist": np.array(
+            whitelist, dtype=f"S{max(map(len, whitelist), default=1)}"),
+        "settings": np.array([k, max_ed, min_ed_diff]),
+    })
+    KmerIndex.from_whitelist(whitelist, k).save(directory / "kmer")
+    if not (deletion and WhitelistIndex.supports(
+            whitelist, max_ed, min_ed_diff)):
+        return False
+    WhitelistIndex.from_whitelist(
+        whitelist, max_ed, min_ed_diff, k).save(directory / "deletion")
+    return True
@@ -0,0 +1,530 @@
+"""2-bit encoding of barcode sequences and the uncorrected barcode table.
+
+A sequence of up to 32 bases is packed into a uint64 with two bits per
+base (A=0, C=1, G=2, T=3), the first base in the most significant bits
+used. Bases other than A, C, G and T are encoded as A, with their
+positions flagged in a uint32 mask, and decode to N.
+
+The uncorrected barcode table written by extract_barcode.py stores, for
+each alignment with a barcode, its position in the contig's alignments,
+its read ID, the 2-bit encoded uncorrected barcode (CR), the barcode QVs
+(CY) and the barcode start in the read, as arrays in a .npz file. Tables
+written with extract_barcode.py --extract_umi also hold the uncorrected
+UMI (UR) and UMI QVs (UY) aligned to the probe.
+
+The read tag table written by assign_barcodes.py stores, for each
+assigned alignment, its read ID, the 2-bit encoded corrected barcode (CB)
+and uncorrected UMI (UR), the index of its contig among the table's
+contigs and its first and last aligned reference positions.
+
+Barcodes and UMIs of a known length are packed with pack, into uint32
+for up to 16 bases, with a mask flagging sequences that cannot be packed
+(other lengths or bases). Packed codes can be counted and compared as
+NumPy arrays.
+
+Barcode superlists compiled with compile_superlist.py are BarcodeSet
+arrays of sorted codes, memory-mapped by the tasks that use them.
+"""
+import numpy as np
+
+MAX_LENGTH = 32
+
+ENCODE = np.zeros(256, dtype=np.uint64)
+IS_OTHER = np.ones(256, dtype=bool)
+for i, base in enumerate(b"ACGT"):
+    ENCODE[base] = i
+    IS_OTHER[base] = False
+DECODE = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+TABLE_COLUMNS = [
+    "record", "read_id", "CR", "CR_length", "CR_n_mask", "CY", "bc_start"]
+UMI_COLUMNS = ["UR", "UY"]
+TAG_COLUMNS = ["read_id", "CB", "UR", "chr", "start", "end"]
+
+
+def encode(seqs):
+    """
+    Pack sequences into 2-bit integer codes.
+
+    :param seqs: Sequences of up to 32 bases
+    :type seqs: list
+    :return: 2-bit codes, lengths and masks of the positions of bases other
+        than A, C, G and T
+    :rtype: np.array(uint64), np.array(uint8), np.array(uint32)
+    """
+    n = len(seqs)
+    lengths = np.fromiter(map(len, seqs), dtype=np.uint8, count=n)
+    codes = np.zeros(n, dtype=np.uint64)
+    n_mask = np.zeros(n, dtype=np.uint32)
+    width = int(lengths.max()) if n else 0
+    if width > MAX_LENGTH:
+        raise ValueError(
+            f"Cannot encode sequences longer than {MAX_LENGTH} bases.")
+    if width == 0:
+        return codes, lengths, n_mask
+
+    # Rows of bases, padded with zero bytes
+    bases = np.array(seqs, dtype=f"S{width}").view(np.uint8).reshape(
+        n, width)
+    valid = np.arange(width) < lengths[:, None]
+    for j in range(width):
+        codes = (codes << np.uint64(2)) | ENCODE[bases[:, j]]
+        n_mask |= (
+            (IS_OTHER[bases[:, j]] & valid[:, j]).astype(np.uint32)
+            << np.uint32(j))
+    # Right-align the codes of sequences shorter than the widest
+    codes >>= (2 * (width - lengths)).astype(np.uint64)
+    return codes, lengths, n_mask
+
+
+def decode(codes, lengths, n_mask):
+    """
+    Unpack 2-bit integer codes into sequences.
+
+    :param codes: 2-bit codes
+    :type codes: np.array(uint64)
+    :param lengths: Sequence lengths
+    :type lengths: np.array(uint8)
+    :param n_mask: Masks of the positions of N bases
+    :type n_mask: np.array(uint32)
+    :return: Sequences
+    :rtype: list
+    """
+    n = len(codes)
+    width = int(lengths.max()) if n else 0
+    if width == 0:
+        return [""] * n
+
+    bases = np.zeros((n, width), dtype=np.uint8)
+    lengths = lengths.astype(np.int64)
+    for j in range(width):
+        in_seq = j < lengths
+        shift = (2 * np.maximum(lengths - 1 - j, 0)).astype(np.uint64)
+        base = DECODE[(codes >> shift) & np.uint64(3)]
+        is_n = (n_mask >> np.uint32(j)) & np.uint32(1) == 1
+        bases[:, j] = np.where(in_seq, np.where(is_n, ord("N"), base), 0)
+    return bases.view(f"S{width}").ravel().astype(str).tolist()
+
+
+def pack(seqs, length):
+    """
+    Pack sequences of a known length into 2-bit integer codes.
+
+    Codes of sequences of up to 16 bases are uint32, longer ones uint64.
+
+    :param seqs: Sequences
+    :type seqs: list
+    :param length: Sequence length, at most 32
+    :type length: int
+    :return: Codes and whether each sequence could be packed, i.e. has the
+        given length and only A, C, G and T; codes of the others are 0
+    :rtype: np.array(uint32 or uint64), np.array(bool)
+    """
+    if length > MAX_LENGTH:
+        raise ValueError(
+            f"Cannot pack sequences longer than {MAX_LENGTH} bases.")
+    # Sequences too long to encode cannot be packed either
+    seqs = [seq if len(seq) <= length else "" for seq in seqs]
+    codes, lengths, n_mask = encode(seqs)
+    valid = (lengths == length) & (n_mask == 0)
+    dtype = np.uint32 if length <= 16 else np.uint64
+    return np.where(valid, codes, np.uint64(0)).astype(dtype), valid
+
+
+def unpack(codes, length):
+    """
+    Unpack integer codes of sequences of a known length.
+
+    :param codes: Codes from pack
+    :type codes: np.array(uint32 or uint64)
+    :param length: Sequence length
+    :type length: int
+    :return: Sequences
+    :rtype: list
+    """
+    n = len(codes)
+    return decode(
+        np.asarray(codes, dtype=np.uint64),
+        np.full(n, length, dtype=np.uint8),
+        np.zeros(n, dtype=np.uint32))
+
+
+def count_codes(codes):
+    """
+    Count the occurrences of each code, like collections.Counter.
+
+    :param codes: Codes
+    :type codes: np.array
+    :return: Unique codes in order of their first occurrence and their
+        counts
+    :rtype: np.array, np.array(int64)
+    """
+    unique, first, inverse = np.unique(
+        codes, return_index=True, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), minlength=len(unique))
+    order = np.argsort(first, kind="stable")
+    return unique[order], counts[order]
+
+
+def most_common(codes, counts):
+    """
+    Order counted codes by decreasing count, like Counter.most_common.
+
+    Codes with equal counts keep their order.
+
+    :param codes: Unique codes
+    :type codes: np.array
+    :param counts: Counts of the codes
+    :type counts: np.array
+    :return: Codes and counts by decreasing count
+    :rtype: np.array, np.array
+    """
+    order = np.argsort(-counts, kind="stable")
+    return codes[order], counts[order]
+
+
+class PackedSequences:
+    """
+    Sequences of a known length accumulated as packed codes.
+
+    Sequences are packed in chunks as they are added, keeping only the codes
+    of those that could be packed, so that a long run of them takes 4 bytes
+    per barcode rather than a Python string or Counter entry each.
+    """
+
+    def __init__(self, length, chunk_size=100000):
+        """Start an empty array.
+
+        :param length: Sequence length
+        :type length: int
+        :param chunk_size: Number of sequences to hold before packing them
+        :type chunk_size: int
+        """
+        self.length = length
+        self.chunk_size = chunk_size
+        self._pending = []
+        self._chunks = []
+
+    def append(self, seq):
+        """Add a sequence, to be dropped if it cannot be packed.
+
+        :param seq: Sequence
+        :type seq: str
+        """
+        self._pending.append(seq)
+        if len(self._pending) >= self.chunk_size:
+            self._pack_pending()
+
+    def _pack_pending(self):
+        codes, valid = pack(self._pending, self.length)
+        self._chunks.append(codes[valid])
+        self._pending = []
+
+    def codes(self):
+        """Return the codes of the packed sequences, in order of addition.
+
+        :return: Codes
+        :rtype: np.array(uint32 or uint64)
+        """
+        self._pack_pending()
+        codes = np.concatenate(self._chunks)
+        self._chunks = [codes]
+        return codes
+
+
+def write_barcode_table(path, contig, columns):
+    """
+    Write an uncorrected barcode table.
+
+    :param path: Output .npz file
+    :type path: str
+    :param contig: Contig of the alignments
+    :type contig: str
+    :param columns: Arrays of TABLE_COLUMNS
+    :type columns: dict
+    """
+    with open(path, "wb") as f:
+        np.savez(f, contig=np.array(contig), **columns)
+
+
+def barcode_table_columns(
+        records, read_ids, barcodes, qscores, bc_starts, umis=None,
+        umi_qscores=None):
+    """
+    Build the arrays of an uncorrected barcode table.
+
+    :param records: Positions of the alignments among those of the contig
+    :type records: list
+    :param read_ids: Read IDs
+    :type read_ids: list
+    :param barcodes: Uncorrected barcodes
+    :type barcodes: list
+    :param qscores: Barcode QVs as phred+33 strings
+    :type qscores: list
+    :param bc_starts: Barcode start positions in the reads
+    :type bc_starts: list
+    :param umis: Uncorrected UMIs, empty where none aligned
+    :type umis: list
+    :param umi_qscores: UMI QVs as phred+33 strings
+    :type umi_qscores: list
+    :return: Arrays of TABLE_COLUMNS, and of UMI_COLUMNS with umis
+    :rtype: dict
+    """
+    cr, cr_length, cr_n_mask = encode(barcodes)
+    columns = {
+        "record": np.array(records, dtype=np.uint32),
+        "read_id": np.array(read_ids, dtype=np.bytes_),
+        "CR": cr,
+        "CR_length": cr_length,
+        "CR_n_mask": cr_n_mask,
+        "CY": np.array(qscores, dtype=np.bytes_),
+        "bc_start": np.array(bc_starts, dtype=np.uint16),
+    }
+    if umis is not None:
+        columns["UR"] = np.array(umis, dtype=np.bytes_)
+        columns["UY"] = np.array(umi_qscores, dtype=np.bytes_)
+    return columns
+
+
+def read_barcode_table(path):
+    """
+    Read an uncorrected barcode table.
+
+    :param path: .npz file written by write_barcode_table
+    :type path: str
+    :return: Contig of the alignments and arrays of TABLE_COLUMNS, and of
+        UMI_COLUMNS if the table has them
+    :rtype: str, dict
+    """
+    with np.load(path) as table:
+        contig = str(table["contig"])
+        columns = {
+            column: table[column]
+            for column in TABLE_COLUMNS + UMI_COLUMNS
+            if column in table.files}
+    return contig, columns
+
+
+def tag_table_columns(read_ids, barcodes, umis, contig, starts, ends):
+    """
+    Build the arrays of a read tag table of the alignments of one contig.
+
+    :param read_ids: Read IDs
+    :type read_ids: list
+    :param barcodes: Corrected barcodes
+    :type barcodes: list
+    :param umis: Uncorrected UMIs
+    :type umis: list
+    :param contig: Contig of the alignments
+    :type contig: str
+    :param starts: First aligned reference positions
+    :type starts: list
+    :param ends: Last aligned reference positions
+    :type ends: list
+    :return: Arrays of the table
+    :rtype: dict
+    """
+    cb, cb_length, cb_n_mask = encode(barcodes)
+    ur, ur_length, ur_n_mask = encode(umis)
+    return {
+        "read_id": np.array(read_ids, dtype=np.bytes_),
+        "CB": cb,
+        "CB_length": cb_length,
+        "CB_n_mask": cb_n_mask,
+        "UR": ur,
+        "UR_length": ur_length,
+        "UR_n_mask": ur_n_mask,
+        "contigs": np.array([contig], dtype=np.bytes_),
+        "chr": np.zeros(len(read_ids), dtype=np.uint16),
+        "start": np.array(starts, dtype=np.int64),
+        "end": np.array(ends, dtype=np.int64),
+    }
+
+
+def concat_tag_tables(tables):
+    """
+    Concatenate read tag tables, in order.
+
+    :param tables: Arrays of read tag tables
+    :type tables: list
+    :return: Arrays of the concatenated table
+    :rtype: dict
+    """
+    if not tables:
+        columns = tag_table_columns([], [], [], "", [], [])
+        columns["contigs"] = np.array([], dtype=np.bytes_)
+        return columns
+    contigs = list(dict.fromkeys(
+        contig for table in tables for contig in table["contigs"].tolist()))
+    columns = {
+        column: np.concatenate([table[column] for table in tables])
+        for column in tables[0] if column not in ("contigs", "chr")}
+    # Renumber the contigs of each table into the concatenated contigs
+    columns["contigs"] = np.array(contigs, dtype=np.bytes_)
+    columns["chr"] = np.concatenate([
+        np.array([
+            contigs.index(contig) for contig in table["contigs"].tolist()],
+            dtype=np.uint16)[table["chr"]]
+        for table in tables])
+    return columns
+
+
+def write_tag_table(path, columns):
+    """
+    Write a read tag table.
+
+    :param path: Output .npz file
+    :type path: str
+    :param columns: Arrays of the table
+    :type columns: dict
+    """
+    with open(path, "wb") as f:
+        np.savez(f, **columns)
+
+
+def read_tag_table(path):
+    """
+    Read a read tag table.
+
+    :param path: .npz file written by write_tag_table
+    :type path: str
+    :return: Arrays of the table
+    :rtype: dict
+    """
+    with np.load(path) as table:
+        return {column: table[column] for column in table.files}
+
+
+def decode_tag_table(columns):
+    """
+    Decode the arrays of a read tag table into its tags.
+
+    :param columns: Arrays of a read tag table
+    :type columns: dict
+    :return: TAG_COLUMNS, as lists of strings and arrays of positions
+    :rtype: dict
+    """
+    return {
+        "read_id": columns["read_id"].astype(str).tolist(),
+        "CB": decode(
+            columns["CB"], columns["CB_length"], columns["CB_n_mask"]),
+        "UR": decode(
+            columns["UR"], columns["UR_length"], columns["UR_n_mask"]),
+        "chr": columns["contigs"].astype(str)[columns["chr"]].tolist(),
+        "start": columns["start"],
+        "end": columns["end"],
+    }
+
+
+def length_tagged(codes, lengths):
+    """
+    Mark the length of 2-bit codes with a set bit above the first base.
+
+    Tagged codes of sequences of different lengths differ, so they can be
+    compared without the lengths. Sequences longer than 31 bases, whose
+    tagged codes would not fit 64 bits, are tagged as 0.
+
+    :param codes: 2-bit codes
+    :type codes: np.array(uint64)
+    :param lengths: Sequence lengths
+    :type lengths: np.array(uint8)
+    :return: Length tagged codes
+    :rtype: np.array(uint64)
+    """
+    fits = lengths < MAX_LENGTH
+    shift = (2 * np.where(fits, lengths, 0)).astype(np.uint64)
+    return np.where(fits, codes | (np.uint64(1) << shift), np.uint64(0))
+
+
+class BarcodeSet:
+    """
+    Set of barcodes stored as a sorted array of length tagged 2-bit codes.
+
+    The array can be saved as a .npy file and memory-mapped when loaded, so
+    that membership tests only read the pages they search.
+    """
+
+    def __init__(self, codes):
+        """Wrap a sorted array of unique length tagged codes.
+
+        :param codes: Length tagged codes
+        :type codes: np.array(uint64)
+        """
+        self.codes = codes
+
+    @classmethod
+    def from_sequences(cls, seqs):
+        """
+        Build the set from barcode sequences.
+
+        Sequences with bases other than A, C, G and T are left out, as are
+        sequences longer than 31 bases.
+
+        :param seqs: Barcode sequences
+        :type seqs: list
+        :return: Barcode set
+        :rtype: class BarcodeSet
+        """
+        codes, lengths, n_mask = encode(seqs)
+        tagged = length_tagged(codes, lengths)
+        return cls(np.unique(tagged[(n_mask == 0) & (tagged > 0)]))
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a set saved with BarcodeSet.save.
+
+        :param path: .npy file
+        :type path: str
+        :return: Barcode set
+        :rtype: class BarcodeSet
+        """
+        return cls(np.load(path, mmap_mode="r"))
+
+    def save(self, path):
+        """Save the set as a .npy file.
+
+        :param path: Output .npy file
+        :type path: str
+        """
+        np.save(path, np.asarray(self.codes))
+
+    def __len__(self):
+        """Return the number of barcodes in the set."""
+        return len(self.codes)
+
+    def contains_codes(self, codes, length):
+        """
+        Test which packed sequences of a known length are in the set.
+
+        :param codes: Codes from pack
+        :type codes: np.array(uint32 or uint64)
+        :param length: Sequence length, at most 31
+        :type length: int
+        :return: Whether each sequence is in the set
+        :rtype: np.array(bool)
+        """
+        if len(self.codes) == 0:
+            return np.zeros(len(codes), dtype=bool)
+        tagged = length_tagged(
+            np.asarray(codes, dtype=np.uint64),
+            np.full(len(codes), length, dtype=np.uint8))
+        idx = np.searchsorted(self.codes, tagged)
+        found = self.codes[np.minimum(idx, len(self.codes) - 1)] == tagged
+        return found & (tagged > 0)
+
+    def contains(self, seqs):
+        """
+        Test which sequences are in the set.
+
+        :param seqs: Sequences of up to 32 characters
+        :type seqs: list
+        :return: Whether each sequence is in the set
+        :rtype: np.array(bool)
+        """
+        codes, lengths, n_mask = encode(seqs)
+        if len(self.codes) == 0:
+            return np.zeros(len(seqs), dtype=bool)
+        tagged = length_tagged(codes, lengths)
+        idx = np.searchsorted(self.codes, tagged)
+        found = self.codes[np.minimum(idx, len(self.codes) - 1)] == tagged
+        return found & (n_mask == 0) & (tagged > 0)
@@ -8,16 +8,18 @@
 # The specific functions borrowed or modified are documented below in comments
 
 import argparse
-import collections
 import itertools
 import logging
 import multiprocessing
 from pathlib import Path
 import tempfile
 
+from bam_io import add_bam_args, open_bam
+from barcode_encoding import decode_tag_table, read_tag_table
 from editdistance import eval as edit_distance
 import numpy as np
 import pandas as pd
+from profiling import Profiler
 import pysam
 from tqdm import tqdm
 
@@ -97,7 +99,8 @@ def parse_args():
 
     parser.add_argument(
         "--bc_ur_tags",
-        help="TSV read/BC/UR tag assignments file. \
+        help="Read/BC/UR tag assignments file from assign_barcodes.py, as \
+        a .npz read tag table or a TSV. \
         IMPORTANT: reads in the input BAM and gene_assigns file must have the \
         same order? .",
         type=Path,
@@ -107,6 +110,16 @@ def parse_args():
         "-t", "--threads", help="Threads to use [4]", type=int, default=4
     )
 
+    add_bam_args(parser)
+
+    parser.add_argument(
+        "--profile",
+        help="Write a JSON profile of the time, reads/s and peak memory of \
+        each stage to this file [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "--verbosity",
         help="logging level: <=2 logs info, <=3 logs warnings",
@@ -275,8 +288,8 @@ def add_tags(chrom, umis, genes, transcripts, args):
     bam_out_fn = args.output
     read_tags = []
 
-    with pysam.AlignmentFile(args.bam, "rb") as bam:
-        with pysam.AlignmentFile(bam_out_fn, "wb", template=bam) as bam_out:
+    with open_bam(args.bam, "rb", args) as bam:
+        with open_bam(bam_out_fn, "wb", args, template=bam) as bam_out:
 
             for align in bam.fetch(chrom):
                 read_id = align.query_name
@@ -398,7 +411,7 @@ def run_groupby(df):
     return df
 
 
-def process_records(tag_file, args):
+def process_records(tag_file, args, profiler):
     """
     Process bam records.
 
@@ -409,8 +422,64 @@ def process_records(tag_file, args):
 
     :param tag_file: TSV file path with read_id, CB and UR tags
     :type tag_file: str
+    :param profiler: Profiler of the script
+    :type profiler: class profiling.Profiler
+    """
+    with profiler.stage("load_tables") as stage:
+        tags, gene_assigns, transcript_assigns = load_tables(tag_file, args)
+        stage.add_reads(tags.shape[0])
+
+    df = gene_assigns.merge(
+        transcript_assigns,
+        left_index=True,
+        right_index=True,
+    ).merge(
+        tags,
+        left_index=True,
+        right_index=True,
+    )
+
+    with profiler.stage("group_reads", reads=df.shape[0]):
+        df = group_reads(df, transcript_assigns, args)
+
+    with profiler.stage("cluster_umis", reads=df.shape[0]):
+        df = cluster_umis(df, args)
+
+    # Simplify to a read_id:umi_corr dictionary
+    df = df.drop(["bc", "umi_uncorr"], axis=1).set_index("read_id")
+
+    # Dict of corrected UMI for each read ID
+    umis = df.replace({np.nan:None}).to_dict()["umi_corr"]
+
+    # Dict of gene names to add <chr>_<start>_<end> in place of NA
+    genes = df.replace({np.nan:None}).to_dict()["gene"]
+
+    transcripts = df.replace({np.nan:None}).to_dict()["transcript"]
+
+    # Add corrected UMIs to each chrom-specific BAM entry via the UB:Z tag
+    with profiler.stage("add_tags") as stage:
+        read_tags = add_tags(args.chrom, umis, genes, transcripts, args)
+        read_tags.to_csv(args.output_read_tags, sep='\t', index=False)
+        stage.add_reads(read_tags.shape[0])
+
+
+def load_tables(tag_file, args):
+    """Load the barcode/UMI tags and gene and transcript assignments.
+
+    :param tag_file: TSV file path with read_id, CB and UR tags
+    :type tag_file: str
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: tags, gene assignments and transcript assignments indexed by
+        read ID
+    :rtype: class pandas.DataFrame, class pandas.DataFrame,
+        class pandas.DataFrame
     """
-    tags = pd.read_csv(tag_file, sep='\t', index_col=0)
+    if Path(tag_file).suffix == ".npz":
+        tags = pd.DataFrame(
+            decode_tag_table(read_tag_table(tag_file))).set_index("read_id")
+    else:
+        tags = pd.read_csv(tag_file, sep='\t', index_col=0)
 
     ga_header = ['read_id', 'status', 'mapq', 'gene']
     gene_assigns = pd.read_csv(
@@ -424,18 +493,23 @@ def process_records(tag_file, args):
     except pd.errors.EmptyDataError:
         transcript_assigns = pd.DataFrame()
 
-    df = gene_assigns.merge(
-        transcript_assigns,
-        left_index=True,
-        right_index=True,
-    ).merge(
-        tags,
-        left_index=True,
-        right_index=True,
-    )
+    return tags, gene_assigns, transcript_assigns
+
 
+def group_reads(df, transcript_assigns, args):
+    """Collect the gene, barcode and uncorrected UMI of each read.
+
+    :param df: Tags and assignments of each read, indexed by read ID
+    :type df: class pandas.DataFrame
+    :param transcript_assigns: Transcript assignments indexed by read ID
+    :type transcript_assigns: class pandas.DataFrame
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Reads with read_id, gene, transcript, bc and umi_uncorr,
+        indexed by <gene>:<barcode>
+    :rtype: class pandas.DataFrame
+    """
     records = []
-    cell_gene_counter = collections.Counter()
 
     for row in df.itertuples():
         read_id = row.Index
@@ -458,19 +532,34 @@ def process_records(tag_file, args):
             # Group by region if no gene annotation
             gene = create_region_name(row, args)
 
-        cell_gene_counter[(bc_corr, gene)] += 1
-        if cell_gene_counter[(bc_corr, gene)] <= args.cell_gene_max_reads:
-            records.append(
-                (read_id, gene, transcript, bc_corr, umi_uncorr))
+        records.append((read_id, gene, transcript, bc_corr, umi_uncorr))
 
     # Create a dataframe with chrom-specific data
     df = pd.DataFrame.from_records(
         records, columns=["read_id", "gene", "transcript", "bc", "umi_uncorr"]
     )
 
+    # Keep the first reads of each cell and gene, counting them per group
+    # in one pass rather than with a Counter of (barcode, gene) tuples
+    n_cell_gene = df.groupby(["bc", "gene"], sort=False).cumcount()
+    df = df[(n_cell_gene < args.cell_gene_max_reads).to_numpy()]
+    df = df.reset_index(drop=True)
+
     # This is the chunked pandas implementation using multiprocessing module
     df["gene_cell"] = df["gene"] + ":" + df["bc"]
-    df = df.set_index("gene_cell")
+    return df.set_index("gene_cell")
+
+
+def cluster_umis(df, args):
+    """Cluster the UMIs of each gene and cell barcode.
+
+    :param df: Reads indexed by <gene>:<barcode> from group_reads
+    :type df: class pandas.DataFrame
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Reads with their corrected UMI (umi_corr)
+    :rtype: class pandas.DataFrame
+    """
     gene_cell_unique = list(set(df.index))
     gene_cell_per_chunk = 50
     gene_cell_chunks = chunks(gene_cell_unique, gene_cell_per_chunk)
@@ -491,29 +580,19 @@ def process_records(tag_file, args):
                 "bc",
                 "umi_uncorr",
                 "umi_corr"])
-
-    # Simplify to a read_id:umi_corr dictionary
-    df = df.drop(["bc", "umi_uncorr"], axis=1).set_index("read_id")
-
-    # Dict of corrected UMI for each read ID
-    umis = df.replace({np.nan:None}).to_dict()["umi_corr"]
-
-    # Dict of gene names to add <chr>_<start>_<end> in place of NA
-    genes = df.replace({np.nan:None}).to_dict()["gene"]
-
-    transcripts = df.replace({np.nan:None}).to_dict()["transcript"]
-
-    # Add corrected UMIs to each chrom-specific BAM entry via the UB:Z tag
-    read_tags = add_tags(args.chrom, umis, genes, transcripts, args)
-    read_tags.to_csv(args.output_read_tags, sep='\t', index=False)
+    return df
 
 
 def main(args):
     """Run entry point."""
     init_logger(args)
+    profiler = Profiler("cluster_umis", sample_rss=args.profile is not None)
 
     tag_file = args.bc_ur_tags
-    process_records(tag_file, args)
+    process_records(tag_file, args, profiler)
+
+    if args.profile:
+        profiler.write(args.profile)
 
 
 if __name__ == "__main__":
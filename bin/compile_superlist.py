@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+"""Compile a barcode superlist into a memory-mappable barcode set."""
+import argparse
+import gzip
+import logging
+from pathlib import Path
+
+from barcode_encoding import BarcodeSet
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """Create argument parser."""
+    parser = argparse.ArgumentParser()
+
+    # Positional mandatory arguments
+    parser.add_argument(
+        "superlist",
+        help="Comprehensive whitelist of all possible cell barcodes, one \
+        per line, uncompressed or gzipped, e.g. \
+        data/737K-august-2016.txt.gz",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "output",
+        help="Output .npy file of the compiled barcode set, to pass to \
+        extract_barcode.py as the superlist",
+        type=Path,
+    )
+
+    # Optional arguments
+    parser.add_argument(
+        "--verbosity",
+        help="logging level: <=2 logs info, <=3 logs warnings",
+        type=int,
+        default=2,
+    )
+
+    return parser.parse_args()
+
+
+def init_logger(args):
+    """Initiate logger."""
+    logging.basicConfig(
+        format="%(asctime)s -- %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    logging_level = args.verbosity * 10
+    logging.root.setLevel(logging_level)
+
+
+def main(args):
+    """Run entry point."""
+    init_logger(args)
+    opener = gzip.open if args.superlist.suffix == ".gz" else open
+    with opener(args.superlist, "rt") as f:
+        barcodes = f.read().split()
+
+    barcode_set = BarcodeSet.from_sequences(barcodes)
+    if len(barcode_set) < len(set(barcodes)):
+        logger.warning(
+            f"Left out {len(set(barcodes)) - len(barcode_set)} barcodes "
+            "with bases other than A, C, G and T")
+    barcode_set.save(args.output)
+    logger.info(
+        f"Wrote {len(barcode_set)} barcodes from {args.superlist} "
+        f"to {args.output}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    main(args)
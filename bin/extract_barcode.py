@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 """Extract barcode."""
 import argparse
-import collections
 import gzip
 import logging
 import multiprocessing
@@ -10,16 +9,32 @@ from pathlib import Path
 import shutil
 import tempfile
 
+from bam_io import add_bam_args, open_bam
+from barcode_encoding import (
+    barcode_table_columns, BarcodeSet, count_codes, most_common,
+    PackedSequences, TABLE_COLUMNS, UMI_COLUMNS, unpack,
+    write_barcode_table)
 import editdistance as ed
+import numpy as np
 import parasail
+from profiling import Profiler
 import pysam
-from pysam import AlignmentFile
+from read_features import alignment_read_start, extract_feature
 from tqdm import tqdm
 
 
 # Make logger globally accessible to all functions
 logger = logging.getLogger(__name__)
 
+# Contigs are split into this many regions per thread so that regions
+# that are slow to align are balanced out across the pool
+REGIONS_PER_THREAD = 4
+# Smallest number of reads worth sending to a worker as a region
+MIN_REGION_READS = 10000
+# Positions of a contig at which the BAM index is queried per region, to
+# place the region boundaries
+REGION_SAMPLES = 32
+
 
 def parse_args():
     """
@@ -55,7 +70,9 @@ def parse_args():
         For 5' single cell gene expression \
         kit: data/737K-august-2016.txt.gz. \
         For single cell multiome (ATAC + GEX) \
-        kit: data/737K-arc-v1.txt.gz",
+        kit: data/737K-arc-v1.txt.gz. \
+        A superlist compiled to .npy with compile_superlist.py loads \
+        much faster",
         type=Path,
         default=None,
     )
@@ -166,6 +183,31 @@ def parse_args():
         default=100,
     )
 
+    parser.add_argument(
+        "--aligner",
+        help="Probe alignment engine: 'profile' aligns each read with \
+        striped SIMD parasail against a probe profile built once per \
+        worker, 'scalar' aligns each read with the unvectorised parasail \
+        aligner. Equally scoring alignments may be broken differently \
+        [profile]",
+        choices=["profile", "scalar"],
+        default="profile",
+    )
+
+    parser.add_argument(
+        "--min_probe_score",
+        help="With --aligner profile, skip the traceback for reads whose \
+        score-only probe alignment scores below this. The prefilter is \
+        opt-in, 0 tracing back every read: most of the probe score comes \
+        from its N and T wildcards, so random sequence can outscore a read \
+        whose adapter passes --max_adapter1_ed but whose polyT is \
+        degraded, and no threshold is safe for every read. On simulated \
+        reads with the default scoring, reads passing the adapter check \
+        scored 107 or more and 99%% of random windows 97 or less [0]",
+        type=int,
+        default=0,
+    )
+
     parser.add_argument(
         "--max_adapter1_ed",
         help="Max edit distance with the adapter1 sequence (upstream of cell \
@@ -178,11 +220,30 @@ def parse_args():
         "--output_bam",
         help="Output BAM file containing aligned reads with tags \
         for uncorrected \
-        barcodes (CR) and barcode QVs (CY) [bc_uncorr.sorted.bam]",
+        barcodes (CR) and barcode QVs (CY), indexed as <output_bam>.bai \
+        [bc_uncorr.sorted.bam]",
         type=Path,
         default=Path("bc_uncorr.sorted.bam"),
     )
 
+    parser.add_argument(
+        "--output_table",
+        help="Instead of --output_bam, write the read ID, uncorrected \
+        barcode (CR), barcode QVs (CY) and barcode start of reads with a \
+        barcode to this compact .npz table, for assign_barcodes.py \
+        --barcode_table [None]",
+        type=Path,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--extract_umi",
+        help="Also extract the UMI aligned to the probe, as temporary ur \
+        and uy tags or UR and UY table columns, so that assign_barcodes.py \
+        only re-aligns reads whose barcode is corrected with indels",
+        action="store_true",
+    )
+
     parser.add_argument(
         "--output_barcodes",
         help="Output TSV file containing high-quality barcode counts \
@@ -191,6 +252,16 @@ def parse_args():
         default=Path("barcodes_counts.tsv"),
     )
 
+    add_bam_args(parser)
+
+    parser.add_argument(
+        "--profile",
+        help="Write a JSON profile of the time, reads/s and peak memory of \
+        each stage to this file [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "--verbosity",
         help="logging level: <=2 logs info, <=3 logs warnings",
@@ -336,24 +407,139 @@ def edit_distance(query, target):
     return d
 
 
-def parse_probe_alignment(p_alignment, adapter1_probe_seq, args):
-    """Parse probe alignment."""
+def get_probe_seq(adapter1_probe_seq, args):
+    """
+    Compile the probe sequence that is aligned to the start of each read.
+
+    :param adapter1_probe_seq: Suffix of the read1 adapter to include
+    :type adapter1_probe_seq: str
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Probe sequence
+    :rtype: str
+    """
+    if (args.kit == "3prime") or (args.kit == "multiome"):
+        # Compile the actual probe sequence of
+        # <adapter1_suffix>NNN...NNN<TTTTT....>
+        probe_seq = "{a1}{bc}{umi}{pT}".format(
+            a1=adapter1_probe_seq,
+            bc="N" * args.barcode_length,
+            umi="N" * args.umi_length,
+            pT="T" * args.polyT_length,
+        )
+    elif args.kit == "5prime":
+        # Compile the actual probe sequence of
+        # <adapter1_suffix>NNN...NNN<TTTCTTATATGGG>
+        probe_seq = "{a1}{bc}{umi}{tso}".format(
+            a1=adapter1_probe_seq,
+            bc="N" * args.barcode_length,
+            umi="N" * args.umi_length,
+            tso="TTTCTTATATGGG",
+        )
+    else:
+        raise Exception("Invalid kit name! Specify either 3prime or 5prime.")
+    return probe_seq
+
+
+class ProbeAligner:
+    """
+    Local alignment of the probe sequence to the start of reads.
+
+    With the 'profile' aligner the parasail query profile of the probe is
+    built once and each read is aligned to it with the striped SIMD
+    aligner, the read being the database sequence. Reads whose score-only
+    alignment is below <args.min_probe_score> are not traced back. The
+    'scalar' aligner runs the unvectorised parasail aligner for each read
+    with the read as the query.
+    """
+
+    def __init__(self, probe_seq, args):
+        """Build the scoring matrix and, if needed, the probe profile.
+
+        :param probe_seq: Probe sequence
+        :type probe_seq: str
+        :param args: object containing all supplied arguments
+        :type args: class argparse.Namespace
+        """
+        self.probe_seq = probe_seq
+        self.gap_open = args.gap_open
+        self.gap_extend = args.gap_extend
+        self.min_score = args.min_probe_score
+        self.matrix = update_matrix(args)
+        self.profile = None
+        if args.aligner == "profile":
+            # Scores of the 48-62 bp probe fit in 16 bits
+            self.profile = parasail.profile_create_16(
+                probe_seq, self.matrix)
+
+    def align(self, prefix_seq):
+        """
+        Align the probe to a read prefix.
+
+        :param prefix_seq: Nucleotide sequence from the first <args.window>
+            bp of the read
+        :type prefix_seq: str
+        :return: Aligned read and probe sequences, with gaps as '-', and
+            the position in the read where the alignment starts, or None if
+            the read scored below the prefilter threshold
+        :rtype: tuple
+        """
+        if self.profile is None:
+            p_alignment = parasail.sw_trace(
+                s1=prefix_seq,
+                s2=self.probe_seq,
+                open=self.gap_open,
+                extend=self.gap_extend,
+                matrix=self.matrix,
+            )
+            read_aln = p_alignment.traceback.query
+            return read_aln, p_alignment.traceback.ref, alignment_read_start(
+                read_aln, p_alignment.end_query)
+
+        if self.min_score > 0:
+            score = parasail.sw_striped_profile_16(
+                self.profile, prefix_seq, self.gap_open, self.gap_extend
+            ).score
+            if score < self.min_score:
+                return None
+        p_alignment = parasail.sw_trace_striped_profile_16(
+            self.profile, prefix_seq, self.gap_open, self.gap_extend)
+        # The profile makes the probe the query
+        read_aln = p_alignment.traceback.ref
+        return read_aln, p_alignment.traceback.query, alignment_read_start(
+            read_aln, p_alignment.end_ref)
+
+
+def parse_probe_alignment(read_aln, probe_aln, adapter1_probe_seq, args):
+    """
+    Parse probe alignment.
+
+    :param read_aln: Aligned read sequence, with gaps as '-'
+    :type read_aln: str
+    :param probe_aln: Aligned probe sequence, with gaps as '-'
+    :type probe_aln: str
+    :param adapter1_probe_seq: Suffix of the read1 adapter in the probe
+    :type adapter1_probe_seq: str
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: Edit distance of the read1 adapter, aligned barcode and its
+        position in the alignment
+    :rtype: int, str, int
+    """
     # Find the position of the Ns in the alignment. These correspond
     # to the cell barcode + UMI sequences bound by the read1 and polyT
-    idxs = list(find("N", p_alignment.traceback.ref))
+    idxs = list(find("N", probe_aln))
     if len(idxs) > 0:
         # The Ns in the probe successfully aligned to sequence
         bc_start = min(idxs)
 
         # The read1 adapter comprises the first part of the alignment
-        adapter1 = p_alignment.traceback.query[0:bc_start]
+        adapter1 = read_aln[0:bc_start]
         adapter1_ed = edit_distance(adapter1, adapter1_probe_seq)
 
         # The barcode + UMI sequences in the read correspond to the
         # positions of the aligned Ns in the probe sequence
-        barcode = p_alignment.traceback.query[
-            bc_start: (bc_start + args.barcode_length)
-        ]
+        barcode = read_aln[bc_start: (bc_start + args.barcode_length)]
     else:
         # No Ns in the probe successfully aligned -- we will ignore this read
         adapter1_ed = len(adapter1_probe_seq)
@@ -363,36 +549,94 @@ def parse_probe_alignment(p_alignment, adapter1_probe_seq, args):
     return adapter1_ed, barcode, bc_start
 
 
-def find_feature_qscores(feature, p_alignment, prefix_seq, prefix_qv):
+def get_umi_columns(probe_aln, args):
     """
-    Use the parasail alignment results, find the qscores corresponding \
-    to the feature (e.g. barcode or UMI) positions in the read.
-
-    :param feature: Feature sequence identified from the parasail alignment
-    :type feature: str
-    :param p_alignment: Parasail alignment object
-    :type p_alignment: class 'parasail.bindings_v2.Result'
-    :param prefix_seq: Nucleotide sequence from the first <args.window> bp of
-        the read
-    :type prefix_seq: str
-    :param prefix_qv: Qscores from the first <args.window> bp of the read
-    :type prefix_qv: np.array
-    :return: Array of phred scale qscores from the identified feature region
-    :rtype: np.array
-    """
-    # Strip feature alignment string of insertions (-)
-    feature_no_ins = feature.replace("-", "")
+    Find the alignment columns of the probe's UMI Ns.
+
+    The probe holds <args.barcode_length> Ns for the barcode followed by
+    the UMI Ns, so the UMI columns are those of the Ns after the barcode's.
 
-    # Find where the stripped feature starts and ends in the larger prefis_seq
-    prefix_seq_feature_start = prefix_seq.find(feature_no_ins)
-    prefix_seq_feature_end = prefix_seq_feature_start + len(feature_no_ins)
+    :param probe_aln: Aligned probe sequence, with gaps as '-'
+    :type probe_aln: str
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: First UMI column and the column after the last, or None if no
+        UMI N aligned
+    :rtype: tuple
+    """
+    idxs = list(find("N", probe_aln))[args.barcode_length:]
+    if len(idxs) == 0:
+        return None
+    return idxs[0], idxs[-1] + 1
 
-    # Use these start/end indices to locate the correspoding qscores in
-    # prefix_qv
-    feature_qv = prefix_qv[prefix_seq_feature_start:prefix_seq_feature_end]
-    feature_qv_ascii = "".join(map(lambda x: chr(x + 33), feature_qv))
 
-    return feature_qv_ascii, min(feature_qv)
+def get_contig_regions(bam_path, contig, n_regions, args):
+    """
+    Split a contig into regions holding similar numbers of reads.
+
+    Regions are consecutive half-open intervals of read start positions,
+    so that each read belongs to exactly one region and concatenating the
+    regions preserves the coordinate order of the BAM. The contig is not
+    read through: the BAM index is queried at <REGION_SAMPLES> evenly
+    spaced positions per region, and the compressed file offsets of the
+    reads found there, which grow with the number of reads before them,
+    are used to place the cuts.
+
+    :param bam_path: Path to the sorted and indexed input BAM
+    :type bam_path: str
+    :param contig: Contig to split
+    :type contig: str
+    :param n_regions: Maximum number of regions
+    :type n_regions: int
+    :param args: object containing all supplied arguments
+    :type args: class argparse.Namespace
+    :return: (contig, start, end) tuples in coordinate order; start and end
+        are None for a region covering the whole contig
+    :rtype: list
+    """
+    if n_regions <= 1:
+        return [(contig, None, None)]
+
+    with open_bam(bam_path, "rb", args) as bam:
+        contig_length = bam.get_reference_length(contig)
+        n_reads = sum(
+            stats.total for stats in bam.get_index_statistics()
+            if stats.contig == contig)
+        n_regions = min(n_regions, n_reads // MIN_REGION_READS)
+        if n_regions <= 1:
+            return [(contig, None, None)]
+
+        positions = np.linspace(
+            0, contig_length, n_regions * REGION_SAMPLES, endpoint=False,
+            dtype=np.int64)
+        offsets = []
+        for position in positions:
+            reads = bam.fetch(contig, int(position))
+            if next(reads, None) is None:
+                break
+            offsets.append(bam.tell() >> 16)
+        positions = positions[:len(offsets)]
+        # The end of the contig's reads is found by reading past the last
+        # sampled position, i.e. a small fraction of the contig
+        for _ in reads:
+            pass
+        end_offset = bam.tell() >> 16
+    if not offsets:
+        return [(contig, None, None)]
+
+    # Cut where the fraction of the contig's compressed reads passes each
+    # multiple of 1 / n_regions. Offsets are only block addresses and reads
+    # overlapping a sampled position may start before it, so cuts are
+    # estimates and some may coincide
+    offsets = np.maximum.accumulate(np.array(offsets, dtype=np.int64))
+    span = max(end_offset - offsets[0], 1)
+    fractions = (offsets - offsets[0]) / span
+    cuts = np.unique(positions[np.minimum(
+        np.searchsorted(fractions, np.arange(1, n_regions) / n_regions),
+        len(positions) - 1)])
+    bounds = [0] + [int(cut) for cut in cuts if cut > 0] + [contig_length]
+    return [
+        (contig, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
 
 
 def align_adapter(tup):
@@ -402,107 +646,177 @@ def align_adapter(tup):
 
     :param tup: Tuple containing the function arguments
     :type tup: tup
-    :return: Path to temporary BAM containing CR and CY tags, plus a counter
-        tracking the number of each barcode that we encounter
-    :rtype: str, class 'collections.Counter'
+    :return: Path to temporary BAM containing CR and CY tags, or with
+        --output_table the columns of the barcode table, the number of
+        alignments in the region, the packed codes of the high-quality
+        barcodes that we encounter, in order, and the profiled stages
+    :rtype: str or dict, int, np.array, dict
     """
     bam_path = tup[0]
-    chrom = tup[1]
+    chrom, start, end = tup[1]
     args = tup[2]
 
-    # Build align matrix and define the probe sequence for alignments
-    matrix = update_matrix(args)
-    parasail_alg = parasail.sw_trace
-
     # Use only the specified suffix length of adapter1
     adapter1_probe_seq = args.adapter1_seq[-args.adapter1_suff_length:]
+    aligner = ProbeAligner(get_probe_seq(adapter1_probe_seq, args), args)
 
-    if (args.kit == "3prime") or (args.kit == "multiome"):
-        # Compile the actual probe sequence of
-        # <adapter1_suffix>NNN...NNN<TTTTT....>
-        probe_seq = "{a1}{bc}{umi}{pT}".format(
-            a1=adapter1_probe_seq,
-            bc="N" * args.barcode_length,
-            umi="N" * args.umi_length,
-            pT="T" * args.polyT_length,
-        )
-    elif args.kit == "5prime":
-        # Compile the actual probe sequence of
-        # <adapter1_suffix>NNN...NNN<TTTCTTATATGGG>
-        probe_seq = "{a1}{bc}{umi}{tso}".format(
-            a1=adapter1_probe_seq,
-            bc="N" * args.barcode_length,
-            umi="N" * args.umi_length,
-            tso="TTTCTTATATGGG",
+    # Write output BAM file, unless writing a barcode table
+    if args.output_table is None:
+        suff = f".{chrom}.{start or 0}.bam"
+        chrom_bam = tempfile.NamedTemporaryFile(
+            prefix="tmp.align.", suffix=suff, dir=args.tempdir, delete=False
         )
+        bam_out_fn = chrom_bam.name
     else:
-        raise Exception("Invalid kit name! Specify either 3prime or 5prime.")
-
-    # Write output BAM file
-    suff = f".{chrom}.bam"
-    chrom_bam = tempfile.NamedTemporaryFile(
-        prefix="tmp.align.", suffix=suff, dir=args.tempdir, delete=False
-    )
-
-    with AlignmentFile(str(bam_path), "rb") as bam:
-        with AlignmentFile(chrom_bam.name, "wb", template=bam) as bam_out:
-
-            chrom_barcode_counts = collections.Counter()
-
-            for align in bam.fetch(contig=chrom):
-
-                prefix_seq = align.get_forward_sequence()[: args.window]
-                prefix_qv = align.get_forward_qualities()[: args.window]
-
-                p_alignment = parasail_alg(
-                    s1=prefix_seq,
-                    s2=probe_seq,
-                    open=args.gap_open,
-                    extend=args.gap_extend,
-                    matrix=matrix,
-                )
+        bam_out_fn = None
+    # Barcode table rows: alignment index, read ID, CR, CY and barcode
+    # start, and with --extract_umi UR and UY
+    table_rows = tuple([] for _ in range(7 if args.extract_umi else 5))
+
+    profiler = Profiler()
+    with open_bam(bam_path, "rb", args) as bam, profiler.stage(
+            "align_adapter") as stage:
+        bam_out = None
+        if bam_out_fn is not None:
+            bam_out = open_bam(bam_out_fn, "wb", args, template=bam)
+
+        # Barcodes with gaps or Ns cannot be packed, nor be in the
+        # superlist, and are dropped
+        chrom_barcodes = PackedSequences(args.barcode_length)
+
+        n_reads = 0
+        for align in bam.fetch(contig=chrom, start=start, end=end):
+            # Reads overlapping the start of the region belong to the
+            # previous one
+            if start is not None and align.reference_start < start:
+                continue
+            n_reads += 1
+
+            prefix_seq = align.get_forward_sequence()[: args.window]
+            prefix_qv = align.get_forward_qualities()[: args.window]
+
+            p_alignment = aligner.align(prefix_seq)
+            if p_alignment is None:
+                continue
+            read_aln, probe_aln, read_start = p_alignment
+
+            adapter1_ed, barcode, bc_start = parse_probe_alignment(
+                read_aln, probe_aln, adapter1_probe_seq, args
+            )
+
+            # Require minimum read1 edit distance
+            if adapter1_ed <= args.max_adapter1_ed:
+                # Barcode seq without insertions, located in the read from
+                # the alignment columns
+                bc_uncorr, bc_read_start, qscores, min_qv = extract_feature(
+                    read_aln, read_start, bc_start,
+                    bc_start + args.barcode_length, prefix_qv)
+
+                if min_qv >= args.min_barcode_qv:
+                    chrom_barcodes.append(barcode)
+                barcode = bc_uncorr
+
+                umi, umi_qscores = "", ""
+                if args.extract_umi:
+                    umi_columns = get_umi_columns(probe_aln, args)
+                    if umi_columns is not None:
+                        umi, _, umi_qscores, _ = extract_feature(
+                            read_aln, read_start, *umi_columns, prefix_qv)
+
+                if bam_out is None:
+                    for column, value in zip(table_rows, (
+                            n_reads - 1, align.query_name, barcode,
+                            qscores, bc_read_start, umi, umi_qscores)):
+                        column.append(value)
+                    continue
+
+                # Uncorrected cell barcode = CR:Z
+                align.set_tag("CR", barcode, value_type="Z")
+                # Cell barcode quality score = CY:Z
+                align.set_tag("CY", qscores, value_type="Z")
+                if umi:
+                    # Temporary uncorrected UMI and UMI quality score tags,
+                    # replaced by UR and UY in assign_barcodes.py
+                    align.set_tag("ur", umi, value_type="Z")
+                    align.set_tag("uy", umi_qscores, value_type="Z")
+
+                # Only write BAM entry in output file if it will have
+                # CR and CY tags
+                bam_out.write(align)
+
+        stage.add_reads(n_reads)
+        if bam_out is not None:
+            bam_out.close()
+
+    if bam_out_fn is None:
+        output = barcode_table_columns(*table_rows)
+    else:
+        output = bam_out_fn
+    return output, n_reads, chrom_barcodes.codes(), profiler.stages
 
-                adapter1_ed, barcode, bc_start = parse_probe_alignment(
-                    p_alignment, adapter1_probe_seq, args
-                )
 
-                # Require minimum read1 edit distance
-                if adapter1_ed <= args.max_adapter1_ed:
-                    qscores, min_qv = find_feature_qscores(
-                        barcode, p_alignment, prefix_seq, prefix_qv)
+def concatenate_tables(tables, region_reads):
+    """
+    Concatenate the barcode tables of consecutive regions.
+
+    :param tables: Columns of the barcode table of each region, in
+        coordinate order
+    :type tables: list
+    :param region_reads: Number of alignments in each region
+    :type region_reads: list
+    :return: Columns of the barcode table of the contig, with alignment
+        indices counted from the start of the contig
+    :rtype: dict
+    """
+    offsets = np.cumsum([0] + list(region_reads[:-1]))
+    columns = {
+        column: np.concatenate([table[column] for table in tables])
+        for column in TABLE_COLUMNS + UMI_COLUMNS if column in tables[0]}
+    columns["record"] = np.concatenate([
+        table["record"] + np.uint32(offset)
+        for table, offset in zip(tables, offsets)])
+    return columns
 
-                    if min_qv >= args.min_barcode_qv:
-                        chrom_barcode_counts[barcode] += 1
-                    # Strip out insertions from align to get read barcode seq
-                    barcode = barcode.replace("-", "")
 
-                    # Uncorrected cell barcode = CR:Z
-                    align.set_tag("CR", barcode, value_type="Z")
-                    # Cell barcode quality score = CY:Z
-                    align.set_tag("CY", qscores, value_type="Z")
+def concatenate_bams(bam_fns, output_bam):
+    """
+    Concatenate sorted BAMs of consecutive regions into the output BAM.
 
-                    # Only write BAM entry in output file if it will have
-                    # CR and CY tags
-                    bam_out.write(align)
+    The region BAMs are in coordinate order and do not overlap, so their
+    compressed blocks are concatenated as they are, without merging or
+    sorting the records.
 
-    return chrom_bam.name, chrom_barcode_counts
+    :param bam_fns: Paths to the region BAMs, in coordinate order
+    :type bam_fns: list
+    :param output_bam: Output BAM
+    :type output_bam: class pathlib.Path
+    """
+    if len(bam_fns) == 1:
+        shutil.move(bam_fns[0], output_bam)
+    else:
+        pysam.cat("-o", str(output_bam), *bam_fns)
 
 
 def load_superlist(superlist):
     """
     Read contents of the file containing all possible cell barcode sequences. \
-    File can be uncompressed or gzipped.
+    File can be uncompressed or gzipped, or a compiled .npy barcode set.
+
+    Barcode sets compiled with compile_superlist.py are memory-mapped
+    rather than read.
 
     :param superlist: Path to file containing all possible cell barcodes, e.g.
         3M-february-2018.txt
     :type superlist: Path
     :return: Set of all possible cell barcodes
-    :rtype: set
+    :rtype: set or class 'barcode_encoding.BarcodeSet'
     """
     ext = superlist.suffix
     fn = superlist.name
     wl = []
-    if ext == ".gz":
+    if ext == ".npy":
+        return BarcodeSet.load(superlist)
+    elif ext == ".gz":
         with gzip.open(superlist, "rt") as file:
             for line in tqdm(
                     file,
@@ -523,54 +837,81 @@ def load_superlist(superlist):
 def main(args):
     """Run entry point."""
     init_logger(args)
+    profiler = Profiler("extract_barcode", sample_rss=args.profile is not None)
     # logger.info("Getting BAM statistics")
     # n_reads, chroms = get_bam_info(args.bam)
 
     # logger.info("Loading barcode superlist")
-    wl = load_superlist(args.superlist)
+    with profiler.stage("load_superlist"):
+        wl = load_superlist(args.superlist)
 
     # Create temporary directory
     if os.path.exists(args.tempdir):
         shutil.rmtree(args.tempdir, ignore_errors=True)
     os.mkdir(args.tempdir)
 
-    # Process BAM alignments from each chrom separately
-    logger.info(f"Extracting uncorrected barcodes from {args.bam}")
-    func_args = []
-
-    func_args.append((str(args.bam), args.contig, args))
-
-    results = launch_pool(align_adapter, func_args, args.threads)
-    chrom_bam_fns, chrom_barcode_counts = list(zip(*results))
-    barcode_counts = sum(chrom_barcode_counts, collections.Counter())
-
+    # Process BAM alignments from regions of the contig in parallel
+    n_regions = args.threads * REGIONS_PER_THREAD if args.threads > 1 else 1
+    with profiler.stage("split_regions"):
+        regions = get_contig_regions(
+            str(args.bam), args.contig, n_regions, args)
+    logger.info(
+        f"Extracting uncorrected barcodes from {args.bam} in "
+        f"{len(regions)} regions")
+    func_args = [(str(args.bam), region, args) for region in regions]
+
+    with profiler.stage("align") as stage:
+        results = launch_pool(align_adapter, func_args, args.threads)
+        outputs, region_reads, chrom_barcodes, worker_stages = list(
+            zip(*results))
+        for stages in worker_stages:
+            profiler.merge(stages)
+        stage.add_reads(profiler.worker_stages["align_adapter"].reads)
     # Filter barcode counts against barcode superlist
     logger.info(
         f"Writing superlist-filtered barcode counts to {args.output_barcodes}")
-    f_barcode_counts = open(args.output_barcodes, "w")
-    barcode_counts_sorted = sorted(
-        barcode_counts.items(), key=lambda item: item[1], reverse=True
-    )
-    for barcode, n in barcode_counts_sorted:
-        if barcode in wl:
-            f_barcode_counts.write(f"{barcode}\t{n}\n")
-    f_barcode_counts.close()
-
-    logger.info(
-        f"Writing BAM with uncorrected barcode tags to {args.output_bam}")
-    tmp_bam = tempfile.NamedTemporaryFile(
-        prefix="tmp.align.",
-        suffix=".unsorted.bam",
-        dir=args.tempdir,
-        delete=False)
-    merge_parameters = ["-f", tmp_bam.name] + list(chrom_bam_fns)
-    pysam.merge(*merge_parameters)
-
-    pysam.sort(
-        "-@", str(args.threads), "-o", str(args.output_bam), tmp_bam.name)
+    with profiler.stage("write_barcode_counts"):
+        # Count in order of first occurrence, so that barcodes with equal
+        # counts are written in the order they were seen
+        codes, counts = most_common(
+            *count_codes(np.concatenate(chrom_barcodes)))
+        if isinstance(wl, BarcodeSet):
+            keep = wl.contains_codes(codes, args.barcode_length)
+            codes, counts = codes[keep], counts[keep]
+            barcodes = unpack(codes, args.barcode_length)
+        else:
+            barcodes = unpack(codes, args.barcode_length)
+            keep = np.array(
+                [barcode in wl for barcode in barcodes], dtype=bool)
+            barcodes = [b for b, k in zip(barcodes, keep) if k]
+            counts = counts[keep]
+        with open(args.output_barcodes, "w") as f_barcode_counts:
+            for barcode, n in zip(barcodes, counts):
+                f_barcode_counts.write(f"{barcode}\t{n}\n")
+
+    if args.output_table is not None:
+        logger.info(
+            f"Writing uncorrected barcode table to {args.output_table}")
+        with profiler.stage("write_table"):
+            write_barcode_table(
+                args.output_table, args.contig,
+                concatenate_tables(outputs, region_reads))
+    else:
+        logger.info(
+            f"Writing BAM with uncorrected barcode tags to {args.output_bam}")
+        with profiler.stage("concatenate_bam"):
+            concatenate_bams(outputs, args.output_bam)
+        # samtools cat copies compressed blocks and cannot write an index,
+        # and writing the records again to index them as they are written
+        # would recompress them, so the output is indexed in a second,
+        # read-only pass
+        with profiler.stage("index_bam"):
+            pysam.index("-@", str(args.threads), str(args.output_bam))
 
     logger.info("Cleaning up temporary files")
     shutil.rmtree(args.tempdir, ignore_errors=True)
+    if args.profile:
+        profiler.write(args.profile)
 
 
 if __name__ == "__main__":
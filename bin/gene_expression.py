@@ -5,6 +5,7 @@ import logging
 from pathlib import Path
 
 import pandas as pd
+from profiling import Profiler
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +28,14 @@ def parse_args():
         default="gene_expression.tsv",
     )
 
+    parser.add_argument(
+        "--profile",
+        help="Write a JSON profile of the time, reads/s and peak memory of \
+        each stage to this file [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "--verbosity",
         help="logging level: <=2 logs info, <=3 logs warnings",
@@ -50,16 +59,20 @@ def init_logger(args):
     logging.root.handlers[0].addFilter(lambda x: "NumExpr" not in x.msg)
 
 
-def process_tag_tsv(read_tags_tsv):
+def process_tag_tsv(read_tags_tsv, profiler):
     """Convert TSV of read data to gene and transcript expression matrices.
 
     :param read_tags_tsv: read_tags_tsv.
     :type read_tags_tsv: Path
+    :param profiler: Profiler of the script
+    :type profiler: class profiling.Profiler
     """
     # Build regular expression for "gene" annotations where no gene was found
     REGEX = r"[a-zA-Z0-9]+_\d+_\d+"  # e.g. chr7_44468000_44469000
 
-    df = pd.read_csv(read_tags_tsv, sep='\t', index_col=0)
+    with profiler.stage("load_read_tags") as stage:
+        df = pd.read_csv(read_tags_tsv, sep='\t', index_col=0)
+        stage.add_reads(df.shape[0])
 
     def process_dataframe(feature='gene'):
         dfg = df[[feature, 'barcode', 'umi']]
@@ -70,40 +83,48 @@ def process_tag_tsv(read_tags_tsv):
         dfg = dfg.loc[~dfg.index.str.contains(REGEX, regex=True)]
         return dfg
 
-    df_gene = process_dataframe('gene')
-    df_transcript = process_dataframe('transcript')
-    df_transcript = df_transcript.drop('-')
+    with profiler.stage("build_matrices", reads=df.shape[0]):
+        df_gene = process_dataframe('gene')
+        df_transcript = process_dataframe('transcript')
+        df_transcript = df_transcript.drop('-')
 
     return df_gene, df_transcript
 
 
-def process_reads(args):
+def process_reads(args, profiler):
     """
     Iterate through the BAM file and count unique UMIs (UB tag) \
     associated with each gene (GN tag) and cell barcode (CB tag).
 
     :param args: object containing all supplied arguments
     :type args: class argparse.Namespace
+    :param profiler: Profiler of the script
+    :type profiler: class profiling.Profiler
     """
     logger.info(
         f"Building gene/transcript expression matrices from {args.read_tags}")
 
     gene_expression_df, transcript_expression_df = \
-        process_tag_tsv(args.read_tags)
+        process_tag_tsv(args.read_tags, profiler)
 
-    gene_expression_df.to_csv(
-        f'{args.output_prefix}.gene_expression.counts.tsv',
-        sep="\t", index_label="gene")
-    transcript_expression_df.to_csv(
-        f'{args.output_prefix}.transcript_expression.counts.tsv',
-        sep="\t", index_label="transcript")
+    with profiler.stage("write_matrices"):
+        gene_expression_df.to_csv(
+            f'{args.output_prefix}.gene_expression.counts.tsv',
+            sep="\t", index_label="gene")
+        transcript_expression_df.to_csv(
+            f'{args.output_prefix}.transcript_expression.counts.tsv',
+            sep="\t", index_label="transcript")
 
 
 def main(args):
     """Run entry point."""
     init_logger(args)
+    profiler = Profiler("gene_expression", sample_rss=args.profile is not None)
+
+    process_reads(args, profiler)
 
-    process_reads(args)
+    if args.profile:
+        profiler.write(args.profile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+"""Index a barcode whitelist for the assign_barcodes.py jobs of a sample."""
+import argparse
+import logging
+from pathlib import Path
+
+from barcode_correction import index_whitelist, load_whitelist
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """Create argument parser."""
+    parser = argparse.ArgumentParser()
+
+    # Positional mandatory arguments
+    parser.add_argument(
+        "whitelist",
+        help="File containing list of expected cell barcodes",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "output",
+        help="Output directory of the whitelist indices, to pass to \
+        assign_barcodes.py as --whitelist_index",
+        type=Path,
+    )
+
+    # Optional arguments
+    parser.add_argument(
+        "-k",
+        help="Kmer size to use for whitelist filtering [5]",
+        type=int,
+        default=5)
+
+    parser.add_argument(
+        "--max_ed",
+        help="Max edit distance between putative barcode \
+                        and the matching whitelist barcode [2]",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--min_ed_diff",
+        help="Min difference in edit distance between the \
+                        (1) putative barcode vs top hit and (2) putative \
+                        barcode vs runner-up hit [2]",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--verbosity",
+        help="logging level: <=2 logs info, <=3 logs warnings",
+        type=int,
+        default=2,
+    )
+
+    return parser.parse_args()
+
+
+def init_logger(args):
+    """Initiate logger."""
+    logging.basicConfig(
+        format="%(asctime)s -- %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    logging_level = args.verbosity * 10
+    logging.root.setLevel(logging_level)
+
+
+def main(args):
+    """Run entry point."""
+    init_logger(args)
+    whitelist = load_whitelist(args.whitelist)
+    if not index_whitelist(
+            whitelist, args.output, args.k, args.max_ed, args.min_ed_diff):
+        logger.warning(
+            "Cannot index the whitelist for these settings, "
+            "assign_barcodes.py will correct barcodes with the k-mer filter")
+    logger.info(
+        f"Indexed {len(whitelist)} barcodes from {args.whitelist} "
+        f"in {args.output}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    main(args)
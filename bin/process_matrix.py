@@ -2,9 +2,11 @@
 """Process matrix."""
 import argparse
 import logging
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
+from profiling import Profiler
 
 
 logger = logging.getLogger(__name__)
@@ -73,6 +75,14 @@ def parse_args():
         required=True
     )
 
+    parser.add_argument(
+        "--profile",
+        help="Write a JSON profile of the time, reads/s and peak memory of \
+        each stage to this file [None]",
+        type=Path,
+        default=None,
+    )
+
     parser.add_argument(
         "--verbosity",
         help="logging level: <=2 logs info, <=3 logs warnings",
@@ -184,34 +194,44 @@ def normalize(df_gene, args):
 def main(args):
     """Run entry point."""
     init_logger(args)
-
-    df_gene = pd.read_csv(
-        args.gene_counts, sep="\t").set_index("gene")
-    df_transcript = pd.read_csv(
-        args.transcript_counts, sep="\t").set_index("transcript")
-
-    df_gene, df_transcript = filter_cells(df_gene, df_transcript, args)
-
-    df_gene = filter_genes(df_gene, args)
-    df_transcript = filter_genes(df_transcript, args)
-
-    df_gene = normalize(df_gene, args)
-    df_transcript = normalize(df_transcript, args)
-
-    df_gene = np.log10(df_gene + 1)
-    df_transcript = np.log10(df_transcript + 1)
-
-    logger.info(
-        f"Processed gene matrix: {df_gene.shape[0]} "
-        f"genes x {df_gene.shape[1]} cells")
-    df_gene.to_csv(
-        f"{args.output_prefix}.gene_expression.processed.tsv", sep="\t")
-
-    logger.info(
-        f"Processed transcript matrix: {df_transcript.shape[0]} "
-        f"transcripts x {df_transcript.shape[1]} cells")
-    df_transcript.to_csv(
-        f"{args.output_prefix}.transcript_expression.processed.tsv", sep="\t")
+    profiler = Profiler("process_matrix", sample_rss=args.profile is not None)
+
+    with profiler.stage("load_matrices"):
+        df_gene = pd.read_csv(
+            args.gene_counts, sep="\t").set_index("gene")
+        df_transcript = pd.read_csv(
+            args.transcript_counts, sep="\t").set_index("transcript")
+
+    with profiler.stage("filter_cells"):
+        df_gene, df_transcript = filter_cells(df_gene, df_transcript, args)
+
+    with profiler.stage("filter_genes"):
+        df_gene = filter_genes(df_gene, args)
+        df_transcript = filter_genes(df_transcript, args)
+
+    with profiler.stage("normalize"):
+        df_gene = normalize(df_gene, args)
+        df_transcript = normalize(df_transcript, args)
+
+        df_gene = np.log10(df_gene + 1)
+        df_transcript = np.log10(df_transcript + 1)
+
+    with profiler.stage("write_matrices"):
+        logger.info(
+            f"Processed gene matrix: {df_gene.shape[0]} "
+            f"genes x {df_gene.shape[1]} cells")
+        df_gene.to_csv(
+            f"{args.output_prefix}.gene_expression.processed.tsv", sep="\t")
+
+        logger.info(
+            f"Processed transcript matrix: {df_transcript.shape[0]} "
+            f"transcripts x {df_transcript.shape[1]} cells")
+        df_transcript.to_csv(
+            f"{args.output_prefix}.transcript_expression.processed.tsv",
+            sep="\t")
+
+    if args.profile:
+        profiler.write(args.profile)
 
 
 if __name__ == "__main__":
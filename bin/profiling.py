@@ -0,0 +1,233 @@
+"""Per-stage timing, throughput and memory instrumentation for bin/ scripts.
+
+A script creates a Profiler, wraps each of its phases in Profiler.stage and
+writes the profile as JSON on request, e.g.::
+
+    profiler = Profiler("extract_barcode", sample_rss=bool(args.profile))
+    with profiler.stage("align", reads=n_reads):
+        ...
+    if args.profile:
+        profiler.write(args.profile)
+
+Stages run by worker processes are timed by a Profiler in the worker and
+their Profiler.stages returned to the parent, which adds them with
+Profiler.merge. Their times are summed over workers, so they measure
+compute time rather than wall time.
+"""
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+class Stage:
+    """Timing, read count and peak memory of a named stage."""
+
+    def __init__(self, name):
+        """Initialise an empty stage.
+
+        :param name: Name of the stage
+        :type name: str
+        """
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.reads = 0
+        self.peak_rss = 0
+
+    def add_reads(self, n):
+        """Count reads processed by the stage."""
+        self.reads += n
+
+    def merge(self, other):
+        """Add the calls, time and reads of another record of this stage."""
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.reads += other.reads
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+
+    def to_dict(self):
+        """Return the stage as a JSON serialisable dict."""
+        d = {
+            "calls": self.calls,
+            "seconds": round(self.seconds, 6),
+            "reads": self.reads,
+            "reads_per_second": (
+                round(self.reads / self.seconds, 3)
+                if self.reads and self.seconds > 0 else None),
+        }
+        if self.peak_rss:
+            d["peak_rss_mb"] = round(self.peak_rss / 2**20, 3)
+        return d
+
+
+def process_tree_rss(pid=None):
+    """Resident set size of a process and all of its descendants.
+
+    Only available where /proc is, i.e. on Linux.
+
+    :param pid: Process ID, defaults to the current process
+    :type pid: int
+    :return: Total resident set size in bytes, or None without /proc
+    :rtype: int
+    """
+    if pid is None:
+        pid = os.getpid()
+    if not os.path.isdir("/proc"):
+        return None
+
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The process name in the second field may contain spaces
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        pids.extend(children.get(p, []))
+        try:
+            with open(f"/proc/{p}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except OSError:
+            continue
+    return total
+
+
+def max_rss(who):
+    """Peak resident set size reported by getrusage, in bytes."""
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Profiler:
+    """Collect per-stage timings, read throughput and peak memory.
+
+    With sample_rss, a background thread samples the resident set size of
+    the process and its descendants (e.g. pool workers and VSEARCH) every
+    <interval> seconds, recording the peak overall and per running stage.
+    """
+
+    def __init__(self, script=None, sample_rss=False, interval=0.5):
+        """Start profiling.
+
+        :param script: Name of the profiled script
+        :type script: str
+        :param sample_rss: Sample memory usage in a background thread
+        :type sample_rss: bool
+        :param interval: Seconds between memory samples
+        :type interval: float
+        """
+        self.script = script
+        self.stages = {}
+        self.worker_stages = {}
+        self.peak_rss = 0
+        self._active = []
+        self._start = time.perf_counter()
+        self._stopped = threading.Event()
+        self._sampler = None
+        if sample_rss and process_tree_rss() is not None:
+            self._interval = interval
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        while not self._stopped.wait(self._interval):
+            self._record_rss()
+
+    def _record_rss(self):
+        rss = process_tree_rss()
+        if rss is None:
+            return
+        self.peak_rss = max(self.peak_rss, rss)
+        for stage in list(self._active):
+            stage.peak_rss = max(stage.peak_rss, rss)
+
+    @contextlib.contextmanager
+    def stage(self, name, reads=0):
+        """Time a stage of the script.
+
+        Repeated stages of the same name are accumulated.
+
+        :param name: Name of the stage
+        :type name: str
+        :param reads: Number of reads processed by the stage; more can be
+            counted with Stage.add_reads on the yielded stage
+        :type reads: int
+        :return: context manager yielding the stage record
+        :rtype: class Stage
+        """
+        stage = self.stages.setdefault(name, Stage(name))
+        stage.calls += 1
+        stage.add_reads(reads)
+        self._active.append(stage)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - start
+            if self._sampler is not None:
+                self._record_rss()
+            self._active.remove(stage)
+
+    def merge(self, stages):
+        """Add stages timed in a worker process.
+
+        :param stages: Stages of a worker's Profiler, keyed by name
+        :type stages: dict
+        """
+        for name, stage in stages.items():
+            self.worker_stages.setdefault(name, Stage(name)).merge(stage)
+
+    def to_dict(self):
+        """Return the profile as a JSON serialisable dict."""
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        profile = {
+            "script": self.script,
+            "argv": sys.argv,
+            "wall_seconds": round(time.perf_counter() - self._start, 6),
+            "cpu_seconds": {
+                "self": round(usage_self.ru_utime + usage_self.ru_stime, 3),
+                "children": round(
+                    usage_children.ru_utime + usage_children.ru_stime, 3),
+            },
+            "peak_rss_mb": {
+                "self": round(max_rss(resource.RUSAGE_SELF) / 2**20, 3),
+                "children": round(
+                    max_rss(resource.RUSAGE_CHILDREN) / 2**20, 3),
+            },
+            "stages": {
+                name: stage.to_dict() for name, stage in self.stages.items()},
+        }
+        if self._sampler is not None:
+            profile["peak_rss_mb"]["sampled_total"] = round(
+                self.peak_rss / 2**20, 3)
+        if self.worker_stages:
+            profile["worker_stages"] = {
+                name: stage.to_dict()
+                for name, stage in self.worker_stages.items()}
+        return profile
+
+    def write(self, path):
+        """Stop sampling memory and write the profile to a JSON file.
+
+        :param path: Output JSON file
+        :type path: str
+        """
+        self._stopped.set()
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
@@ -0,0 +1,69 @@
+"""Locate features such as barcodes and UMIs in reads from probe alignments.
+
+The probe alignment traceback gives the columns of a feature; these are
+mapped to positions in the read by counting the gaps before them, rather
+than searching the read for the feature sequence, which finds an earlier
+copy of the sequence if there is one.
+"""
+import numpy as np
+
+# Phred score to phred+33 character, as a bytes.translate table
+PHRED33 = bytes((q + 33) & 0xFF for q in range(256))
+
+
+def alignment_read_start(read_aln, read_end):
+    """
+    Position in the read where a local alignment starts.
+
+    :param read_aln: Aligned read sequence, with gaps as '-'
+    :type read_aln: str
+    :param read_end: Position of the last aligned read base, as reported by
+        parasail (end_query or end_ref)
+    :type read_end: int
+    :return: 0-based position of the first aligned read base
+    :rtype: int
+    """
+    return read_end + 1 - (len(read_aln) - read_aln.count("-"))
+
+
+def extract_feature(read_aln, read_start, aln_start, aln_end, qualities):
+    """
+    Extract a feature aligned to columns of a probe alignment.
+
+    :param read_aln: Aligned read sequence, with gaps as '-'
+    :type read_aln: str
+    :param read_start: Position in the read where the alignment starts
+    :type read_start: int
+    :param aln_start: First alignment column of the feature
+    :type aln_start: int
+    :param aln_end: Alignment column after the feature
+    :type aln_end: int
+    :param qualities: Phred scores of the read, or of a prefix of it that
+        contains the alignment
+    :type qualities: array.array or np.array(uint8)
+    :return: Feature sequence without gaps, its 0-based start in the read,
+        its qscores as a phred+33 string and its minimum qscore (0 if the
+        feature is empty)
+    :rtype: str, int, str, int
+    """
+    feature = read_aln[aln_start:aln_end].replace("-", "")
+    start = read_start + aln_start - read_aln.count("-", 0, aln_start)
+    qv = np.frombuffer(qualities, dtype=np.uint8)[start:start + len(feature)]
+    qscores = qv.tobytes().translate(PHRED33).decode("ascii")
+    return feature, start, qscores, int(qv.min()) if len(qv) else 0
+
+
+def mean_qscore(qv):
+    """
+    Phred score of the mean error probability of a set of qscores.
+
+    :param qv: Phred scores
+    :type qv: np.array
+    :return: Phred score corresponding to the average error rate, or 0 for
+        no qscores
+    :rtype: float
+    """
+    if len(qv) == 0:
+        return 0.0
+    mean_prob = np.mean(np.power(10.0, -0.1 * np.asarray(qv, dtype=float)))
+    return float(-10.0 * np.log10(mean_prob))
@@ -18,6 +18,22 @@ process get_contigs {
     """
 }
 
+process compile_superlists {
+    label "singlecell"
+    cpus 1
+    input:
+        path "bc_longlist_dir"
+    output:
+        path "superlists", emit: superlists
+    """
+    mkdir superlists
+    for superlist in bc_longlist_dir/*.txt.gz; do
+        compile_superlist.py "\$superlist" \
+            "superlists/\$(basename "\$superlist" .txt.gz).npy"
+    done
+    """
+}
+
 process extract_barcodes{
     /*
     Build minimap index from reference genome
@@ -29,32 +45,29 @@ process extract_barcodes{
               path("sort.bam.bai"),
               val(meta),
               val(chrom)
-        path "bc_longlist_dir"
+        path "superlists"
 
     output:
-        // TODO: Do not write bams. Write mapping of read_id to barcode
         tuple val(meta.sample_id), 
-              path("*.bc_extract.sorted.bam"), 
-              path("*.bc_extract.sorted.bam.bai"), 
+              path("*.bc_extract.npz"), 
               val(chrom),
-              emit: bam_bc_uncorr
+              emit: bc_uncorr
         tuple val(meta.sample_id),
               path("*.tsv"), emit: barcode_counts
 
     """
     extract_barcode.py \
-    sort.bam bc_longlist_dir/${meta['bc_long_list']}\
+    sort.bam superlists/${meta['bc_long_list'].replace('.txt.gz', '.npy')} \
     -t $task.cpus \
     --kit ${meta['kit_name']} \
     --adapter1_suff_length $params.barcode_adapter1_suff_length \
     --min_barcode_qv $params.barcode_min_quality \
     --barcode_length ${meta['barcode_length']} \
     --umi_length ${meta['umi_length']} \
-    --output_bam "${meta.sample_id}.bc_extract.sorted.bam" \
+    --extract_umi \
+    --output_table "${meta.sample_id}.${chrom}.bc_extract.npz" \
     --output_barcodes "${meta.sample_id}.${chrom}.uncorrected_bc_counts.tsv" \
     --contig ${chrom}
-
-    samtools index "${meta.sample_id}.bc_extract.sorted.bam"
     """
 }
 
@@ -80,14 +93,35 @@ process generate_whitelist{
     """
 }
 
+process index_whitelist{
+    // Index the whitelist once per sample for all assign_barcodes tasks
+    label "singlecell"
+    cpus 1
+    input:
+        tuple val(sample_id),
+              path("whitelist.tsv")
+    output:
+        tuple val(sample_id),
+              path("whitelist_index"),
+              emit: whitelist_index
+    """
+    index_whitelist.py \
+        whitelist.tsv whitelist_index \
+        --max_ed $params.barcode_max_ed \
+        --min_ed_diff $params.barcode_min_ed_diff
+    """
+}
+
 process assign_barcodes{
     label "singlecell"
     cpus 1
     input:
          tuple path("whitelist.tsv"),
+               path("whitelist_index"),
                val(meta),
                path("align.bam"),
                path("align.bam.bai"),
+               path("bc_extract.npz"),
                val(chr)
     output:
         tuple val(meta.sample_id), 
@@ -101,13 +135,13 @@ process assign_barcodes{
               emit: chrom_assigned_barcode_counts
         tuple val(meta.sample_id),
               val(chr),
-              path("*bc_ur_tags.tsv"),
+              path("*bc_ur_tags.npz"),
               emit: bc_ur_tags
     """
     assign_barcodes.py \
         -t ${task.cpus} \
         --output_bam "${meta.sample_id}_${chr}.bc_assign.bam" \
-        --output_tags "${meta.sample_id}_${chr}.bc_ur_tags.tsv" \
+        --output_tags "${meta.sample_id}_${chr}.bc_ur_tags.npz" \
         --output_counts "${meta.sample_id}_${chr}.bc_assign_counts.tsv" \
         --max_ed $params.barcode_max_ed \
         --min_ed_diff $params.barcode_min_ed_diff \
@@ -116,6 +150,9 @@ process assign_barcodes{
         --barcode_length ${meta['barcode_length']} \
         --umi_length ${meta['umi_length']} \
         --contig ${chr} \
+        --barcode_table bc_extract.npz \
+        --whitelist_index whitelist_index \
+        ${params.uncompressed_bams ? '--bam_compression_level 0' : ''} \
         align.bam whitelist.tsv
     
     samtools index "${meta.sample_id}_${chr}.bc_assign.bam"
@@ -184,7 +221,8 @@ process cluster_umis {
     --transcript_assigns chrom_tr_assigns.tsv \
     --bc_ur_tags ${bc_ur_tags} \
     --output "${sample_id}_${chr}.tagged.bam" \
-    --output_read_tags "${sample_id}_${chr}.read_tags.tsv"
+    --output_read_tags "${sample_id}_${chr}.read_tags.tsv" \
+    ${params.uncompressed_bams && params.merge_bam ? '--bam_compression_level 0' : ''}
 
     samtools index "${sample_id}_${chr}.tagged.bam"
     """
@@ -537,13 +575,15 @@ workflow process_bams {
             .map {it -> it.flatten()[2, 3]}
         
         // barcodes()
+        compile_superlists(bc_longlist_dir)
+
         extract_barcodes(
             bam
             .cross(
                 meta
                 .cross(contigs).map{it -> it.flatten()})
                 .map{it -> it.flatten()[1, 2, 4, 6]},
-            bc_longlist_dir)
+            compile_superlists.out.superlists)
 
         generate_whitelist(
             extract_barcodes.out.barcode_counts
@@ -552,10 +592,14 @@ workflow process_bams {
             .join(meta).map {it -> it.tail()} // Remove sample_id
         )
 
+        index_whitelist(generate_whitelist.out.whitelist)
+
         assign_barcodes(generate_whitelist.out.whitelist
+            .join(index_whitelist.out.whitelist_index)
             .join(meta)
-            .cross(extract_barcodes.out.bam_bc_uncorr)
-            .map {it -> it.flatten()[1, 2, 4, 5, 6]})
+            .join(bam)
+            .cross(extract_barcodes.out.bc_uncorr)
+            .map {it -> it.flatten()[1, 2, 3, 4, 5, 7, 8]})
 
         // combine all chr bams with chr gtfs
         chr_beds_gtf = chr_gtf.cross(
@@ -8,72 +8,72 @@ process call_adapter_scan {
     output:
         tuple val(sample_id), path("*.fastq"), emit: stranded_fq_chunked
         tuple val(sample_id), path("*.tsv"), emit: read_config_chunked
+        tuple val(sample_id), path("*.stats.json"), emit: read_config_stats
     
     """    
     adapter_scan_vsearch.py \
     chunk.fq.gz \
     -t 1 \
+    --streaming \
     --kit ${meta['kit_name']} \
     --output_fastq "${sample_id}_adapt_scan.fastq" \
     --output_tsv  "${sample_id}_adapt_scan.tsv" \
+    --output_stats "${sample_id}_adapt_scan.stats.json" \
     --batch_size $params.read_structure_batch_size \
     """
 }
 
 
-process combine_adapter_tables {
-    label "singlecell"
-    cpus 1
-    input:
-        tuple val(sample_id), path("adapters.tsv")
-    output:
-        tuple val(sample_id), path("*read_config.tsv"), emit: read_config
-    """
-    # Concatenate tsv file keeping header from first file.
-    awk 'FNR==1 && NR!=1{next;}{print}' adapters.tsv* > "${sample_id}_read_config.tsv"
-    """
-}
-
-
 process summarize_adapter_table {
     label "singlecell"
     cpus 1
     input:
-        tuple val(sample_id), path(read_config)
+        tuple val(sample_id), path("adapter_stats*.json")
     output:
         tuple val(sample_id), path('*config_stats.json'), emit: config_stats
     """
     #!/usr/bin/python3
-    import pandas as pd
+    import collections
+    import glob
     import json
+    import math
+
+    # Merge the counts and read length sums of each chunk
+    totals = collections.Counter()
+    detailed_config = collections.Counter()
+    summary_config = collections.Counter()
+    for fn in glob.glob("adapter_stats*.json"):
+        with open(fn) as f:
+            chunk = json.load(f)
+        detailed_config.update(chunk.pop("detailed_config"))
+        summary_config.update(chunk.pop("summary_config"))
+        totals.update(chunk)
+
+    n = totals["n_reads"]
+    rl_sum = totals["readlen_sum"]
+    rl_mean = rl_sum / n if n > 0 else float("nan")
+    rl_std_dev = float("nan")
+    if n > 1:
+        rl_std_dev = math.sqrt(
+            (n * totals["readlen_sum_sq"] - rl_sum * rl_sum) / (n * (n - 1)))
 
-    df = pd.read_csv("${read_config}", sep="\t")
     stats = {}
     stats["{$sample_id}"] = {}
     stats["{$sample_id}"]["general"] = {}
-    stats["{$sample_id}"]["general"]["n_reads"] = df.shape[0]
-    stats["{$sample_id}"]["general"]["rl_mean"] = df["readlen"].mean()
-    stats["{$sample_id}"]["general"]["rl_std_dev"] = df["readlen"].std()
-    stats["{$sample_id}"]["general"]["n_fl"] = df[df["fl"] == True].shape[0]
-    stats["{$sample_id}"]["general"]["n_stranded"] = df[
-        df["stranded"] == True
-    ].shape[0]
+    stats["{$sample_id}"]["general"]["n_reads"] = n
+    stats["{$sample_id}"]["general"]["rl_mean"] = rl_mean
+    stats["{$sample_id}"]["general"]["rl_std_dev"] = rl_std_dev
+    stats["{$sample_id}"]["general"]["n_fl"] = totals["n_fl"]
+    stats["{$sample_id}"]["general"]["n_stranded"] = totals["n_stranded"]
 
     stats["{$sample_id}"]["strand_counts"] = {}
-    stats["{$sample_id}"]["strand_counts"]["n_plus"] = df[
-        df["orig_strand"] == "+"
-    ].shape[0]
-    stats["{$sample_id}"]["strand_counts"]["n_minus"] = df[
-        df["orig_strand"] == "-"
-    ].shape[0]
-
-    stats["{$sample_id}"]["detailed_config"] = {}
-    for category, n in df["orig_adapter_config"].value_counts().items():
-        stats["{$sample_id}"]["detailed_config"][category] = n
+    stats["{$sample_id}"]["strand_counts"]["n_plus"] = totals["n_plus"]
+    stats["{$sample_id}"]["strand_counts"]["n_minus"] = totals["n_minus"]
 
-    stats["{$sample_id}"]["summary_config"] = {}
-    for label, n in df["lab"].value_counts().items():
-        stats["{$sample_id}"]["summary_config"][label] = n
+    stats["{$sample_id}"]["detailed_config"] = dict(
+        detailed_config.most_common())
+    stats["{$sample_id}"]["summary_config"] = dict(
+        summary_config.most_common())
 
     with open("${sample_id}.config_stats.json", "w") as f:
         json.dump(stats, f, indent=4)
@@ -106,8 +106,8 @@ workflow stranding {
         .map {it -> tuple(it[0][0], it[0][1], it[1][1])}
 
         call_adapter_scan(chunks)
-        combine_adapter_tables(call_adapter_scan.out.read_config_chunked.groupTuple())
-        summarize_adapter_table(combine_adapter_tables.out.read_config)
+        summarize_adapter_table(
+            call_adapter_scan.out.read_config_stats.groupTuple())
             
     emit:
         stranded_fq = call_adapter_scan.out.stranded_fq_chunked